@@ -0,0 +1,67 @@
+"""
+Time the margin and Split Cycle defeat computation of polls.voting against pref_voting on random
+linear ballots.
+
+    python -m benchmarks.margins
+    python -m benchmarks.margins --candidates 10 50 --ballots 1000000
+
+By default polls.voting is timed on 10, 50 and 200 candidates with 1,000, 100,000 and 1,000,000
+ballots, the largest of which takes a few minutes.  pref_voting is only timed, and its margins and
+defeats compared, on profiles with at most 50 candidates and --pref-voting-max ballots, 1,000 by
+default, since it takes minutes on the larger ones.
+"""
+import argparse
+import time
+
+import numpy as np
+from pref_voting.profiles_with_ties import ProfileWithTies
+from pref_voting.voting_methods import split_cycle_defeat
+
+from polls.voting import rank_array, support_matrix, margin_matrix, split_cycle_defeat_matrix
+
+
+def random_ranks(num_cands, num_ballots, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.argsort(rng.random((num_ballots, num_cands)), axis=1).astype(float) + 1
+
+
+def time_numpy(ranks):
+    started_at = time.perf_counter()
+    M = margin_matrix(support_matrix(ranks))
+    D = split_cycle_defeat_matrix(M)
+    return time.perf_counter() - started_at, M, D
+
+
+def time_pref_voting(ranks):
+    cands = list(range(ranks.shape[1]))
+    rankings = [{c: int(r[c]) for c in cands} for r in ranks]
+    started_at = time.perf_counter()
+    prof = ProfileWithTies(rankings, candidates=cands)
+    margins = [[prof.margin(c1, c2) for c2 in cands] for c1 in cands]
+    defeat = split_cycle_defeat(prof.margin_graph())
+    return time.perf_counter() - started_at, np.array(margins), defeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--candidates", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--ballots", type=int, nargs="+", default=[1000, 100000, 1000000])
+    parser.add_argument("--pref-voting-max", type=int, default=1000)
+    args = parser.parse_args()
+
+    print(f"{'cands':>6} {'ballots':>9} {'numpy':>9} {'pref_voting':>12}")
+    for num_cands in args.candidates:
+        for num_ballots in args.ballots:
+            ranks = random_ranks(num_cands, num_ballots)
+            seconds, M, D = time_numpy(ranks)
+            pv = ""
+            if num_ballots <= args.pref_voting_max and num_cands <= 50:
+                pv_seconds, pv_margins, pv_defeat = time_pref_voting(ranks)
+                assert (pv_margins == M).all()
+                assert all(D[i, j] == pv_defeat.has_edge(i, j) for i in range(num_cands) for j in range(num_cands))
+                pv = f"{pv_seconds:.3f}s"
+            print(f"{num_cands:>6} {num_ballots:>9} {seconds:>8.3f}s {pv:>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Time the table of rankings and the csv data of the outcome page on random rankings, against
+the pairwise comparison of rankings they were computed with before.
+
+    python -m benchmarks.rankings_table
+    python -m benchmarks.rankings_table --ballots 1000000 --baseline-ballots 10000
+
+The pairwise comparison is quadratic in the number of distinct rankings, so it is only run
+on the first --baseline-ballots ballots.
+"""
+import argparse
+import random
+import time
+
+from pref_voting.profiles_with_ties import ProfileWithTies
+
+from polls.voting import generate_columns_from_profiles, generate_csv_data
+
+
+def random_rankings(num_cands, num_ballots, seed=0):
+    """Rankings of some of the candidates, with ties."""
+    rng = random.Random(seed)
+    cands = list(range(num_cands))
+    return [{c: rng.randint(1, num_cands) for c in rng.sample(cands, rng.randint(1, num_cands))}
+            for _ in range(num_ballots)]
+
+
+def pairwise_columns(rankings):
+    """The columns of the table computed by comparing each ranking with every column found so far."""
+    columns = []
+    for rmap in rankings:
+        for column in columns:
+            if sorted(column["rmap"].keys()) == sorted(rmap.keys()) and all(column["rmap"][c] == rmap[c] for c in rmap):
+                column["count"] += 1
+                break
+        else:
+            columns.append({"rmap": rmap, "count": 1})
+    return columns
+
+
+def timed(fn, *args):
+    started_at = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - started_at
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--candidates", type=int, default=6)
+    parser.add_argument("--ballots", type=int, default=100000)
+    parser.add_argument("--baseline-ballots", type=int, default=5000)
+    args = parser.parse_args()
+
+    rankings = random_rankings(args.candidates, args.ballots)
+    prof = ProfileWithTies(rankings, candidates=list(range(args.candidates)))
+    cmap = {c: str(c) for c in prof.candidates}
+
+    (columns, _), columns_seconds = timed(generate_columns_from_profiles, prof)
+    rows, csv_seconds = timed(generate_csv_data, prof, cmap)
+    print(f"{args.ballots} ballots, {len(columns)} distinct rankings: "
+          f"columns {columns_seconds:.2f}s, csv data {csv_seconds:.2f}s")
+
+    baseline, baseline_seconds = timed(pairwise_columns, rankings[:args.baseline_ballots])
+    print(f"{args.baseline_ballots} ballots, {len(baseline)} distinct rankings: "
+          f"pairwise comparison {baseline_seconds:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Time Stable Voting with explanations on random margin graphs, and the number of page views
+needed to finish it when each view has a cpu time budget and resumes from the last checkpoint.
+
+    python -m benchmarks.stable_voting
+    python -m benchmarks.stable_voting --candidates 14 16 18 --budget 2
+"""
+import argparse
+import itertools
+import random
+import time
+
+from polls.voting import stable_voting_explained, stable_voting_winners
+
+
+def random_margin_graph(num_cands, seed=0):
+    """A complete margin graph with even margins, as for an even number of voters with linear ballots."""
+    rng = random.Random(seed)
+    cands = [str(c) for c in range(num_cands)]
+    edges = []
+    for c1, c2 in itertools.combinations(cands, 2):
+        margin = rng.randrange(2, 60, 2)
+        edges.append((c1, c2, margin) if rng.random() < 0.5 else (c2, c1, margin))
+    return cands, edges
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--candidates", type=int, nargs="+", default=[10, 12, 14, 16])
+    parser.add_argument("--seeds", type=int, default=3)
+    parser.add_argument("--budget", type=float, default=0.1, help="cpu seconds per page view")
+    args = parser.parse_args()
+
+    print(f"{'cands':>6} {'seed':>5} {'explained':>10} {'views':>6} {'pref_voting':>12}")
+    for num_cands in args.candidates:
+        for seed in range(args.seeds):
+            cands, edges = random_margin_graph(num_cands, seed)
+
+            started_at = time.perf_counter()
+            sv_winners, explanations, _ = stable_voting_explained(cands, edges)
+            explained = time.perf_counter() - started_at
+
+            views, checkpoint, resumed_winners = 0, None, None
+            while resumed_winners is None:
+                views += 1
+                resumed_winners, resumed_explanations, checkpoint = stable_voting_explained(cands, edges, args.budget, checkpoint)
+            assert resumed_winners == sv_winners and resumed_explanations == explanations
+
+            started_at = time.perf_counter()
+            assert sorted(stable_voting_winners(cands, edges)) == sv_winners
+            pref_voting = time.perf_counter() - started_at
+            print(f"{num_cands:>6} {seed:>5} {explained:>9.2f}s {views:>6} {pref_voting:>11.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,9 @@
 
-from fastapi import FastAPI 
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+import logging
+import time
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 import os
@@ -7,6 +11,10 @@ import os
 # Load environment variables from .env file
 load_dotenv()
 
+from polls.logs import configure_logging, start_request, REQUEST_ID_HEADER
+configure_logging()
+logger = logging.getLogger("stablevoting")
+
 from routers import polls, emails
 
 origins = [
@@ -16,7 +24,29 @@ origins = [
     "https://dev.stablevoting.org"
 ]
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    from polls.database import database
+    from polls.manage import ensure_indexes, run_migrations
+    from polls.compute import compute_service
+    from polls.health import readiness
+    from messages.outbox import outbox
+    database.connect()
+    await ensure_indexes()
+    await run_migrations()
+    await outbox.ensure_indexes()
+    compute_service.start()
+    readiness.start()
+    outbox.start()
+    yield
+    outbox.stop()
+    readiness.stop()
+    compute_service.shutdown()
+    database.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -27,6 +57,33 @@ app.add_middleware(
 )
 
 
+@app.middleware("http")
+async def observe_request(request: Request, call_next):
+    """
+    Give the request an id, count the requests and observe their latency, labelled by the path 
+    of the route rather than the url, and log them
+    """
+    from polls.metrics import requests_total, request_latency
+    request_id = start_request(request.url.path, request.headers.get(REQUEST_ID_HEADER))
+    started_at = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers[REQUEST_ID_HEADER] = request_id
+        return response
+    finally:
+        duration = time.perf_counter() - started_at
+        route = request.scope.get("route")
+        path = route.path if route is not None else "unmatched"
+        request_latency.labels(request.method, path).observe(duration)
+        requests_total.labels(request.method, path, str(status)).inc()
+        logger.log(
+            logging.WARNING if status >= 500 else logging.INFO, 
+            "request", 
+            extra={"method": request.method, "route": path, "status": status, "duration_ms": round(1000 * duration, 1)})
+
+
 app.include_router(polls.router)
 app.include_router(emails.router)
 
@@ -39,16 +96,59 @@ async def root():
 @app.get('/health')
 async def health_check():
     """Health check endpoint"""
+    from polls.outcome_cache import outcome_cache
+    from polls.compute import compute_service
+    from polls.database import database
+    mongo_ok, mongo_latency = await database.ping()
     return {
-        "status": "healthy",
+        "status": "healthy" if mongo_ok else "unhealthy",
         "environment": os.getenv("ENVIRONMENT", "unknown"),
-        "skip_emails": os.getenv("SKIP_EMAILS", "unknown")
+        "skip_emails": os.getenv("SKIP_EMAILS", "unknown"),
+        "mongo": {"ok": mongo_ok, "latency_seconds": mongo_latency},
+        "outcome_cache": outcome_cache.stats(),
+        "compute": compute_service.stats(),
+    }
+
+
+@app.get('/health/live')
+async def liveness():
+    """Liveness probe: the worker answers requests"""
+    return {"status": "alive"}
+
+
+@app.get('/health/ready')
+async def readiness_check():
+    """Readiness probe: MongoDB answers, the event loop is not lagging and the queues are not saturated"""
+    from polls.health import readiness
+    ready, checks = await readiness.check()
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"status": "ready" if ready else "unavailable", **checks})
+
+
+@app.get('/metrics')
+async def metrics(format: str = "prometheus"):
+    """
+    Metrics of this worker in the Prometheus text format, or, with format=json, the statistics of 
+    the MongoDB connection pool, the compute service and the outcome cache
+    """
+    from polls.outcome_cache import outcome_cache
+    from polls.compute import compute_service
+    from polls.database import database
+    from polls.metrics import metrics_text
+    if format != "json":
+        content, content_type = metrics_text()
+        return Response(content=content, media_type=content_type)
+    return {
+        "pid": os.getpid(),
+        "mongo_pool": database.stats(),
+        "compute": compute_service.stats(),
+        "outcome_cache": outcome_cache.stats(),
     }
 
 @app.get('/test-email')
 async def test_email():
     from messages.conf import send_email, SKIP_EMAILS
-    print(f"Test endpoint: SKIP_EMAILS = {SKIP_EMAILS}")
     result = await send_email(
         to_email="epacuit@gmail.com",
         subject="Test Email",
@@ -1,6 +1,9 @@
 
 # messages/conf.py
+import asyncio
 import os
+import re
+import string
 import logging
 from typing import List, Optional
 from postmarker.core import PostmarkClient
@@ -10,6 +13,7 @@ logger = logging.getLogger(__name__)
 # Read from environment variables
 SKIP_EMAILS = os.getenv('SKIP_EMAILS', 'True').lower() == 'true'
 POSTMARK_SERVER_TOKEN = os.getenv('POSTMARK_SERVER_TOKEN', 'POSTMARK_API_TEST')
+POSTMARK_API_URL = os.getenv('POSTMARK_API_URL', 'https://api.postmarkapp.com/') # a local fake server can be used for testing
 FROM_EMAIL = os.getenv('FROM_EMAIL', 'noreply@stablevoting.org')
 FROM_NAME = os.getenv('FROM_NAME', 'Stable Voting')
 
@@ -25,7 +29,16 @@ def get_email_client():
     """Get email client instance"""
     if SKIP_EMAILS:
         return None
-    return PostmarkClient(server_token=POSTMARK_SERVER_TOKEN)
+    return PostmarkClient(server_token=POSTMARK_SERVER_TOKEN, root_api_url=POSTMARK_API_URL)
+
+
+def text_body_from_html(html_body):
+    return re.sub('<[^<]+?>', '', html_body)
+
+
+def render(template, substitutions):
+    """Replace the $name placeholders of the template with the substitutions."""
+    return string.Template(template).safe_substitute(substitutions) if template is not None else None
 
 
 async def send_email(
@@ -37,8 +50,7 @@ async def send_email(
 ):
     """Send an email using Postmark"""
     if SKIP_EMAILS:
-        logger.info(f"[EMAIL SKIPPED] To: {to_email}, Subject: {subject}")
-        print(f"[EMAIL SKIPPED] To: {to_email}, Subject: {subject}")
+        logger.info("email skipped", extra={"subject": subject, "tag": tag})
         return {"MessageID": "skipped", "To": to_email}
     
     client = get_email_client()
@@ -47,11 +59,12 @@ async def send_email(
     
     # Create text body if not provided
     if not text_body:
-        import re
-        text_body = re.sub('<[^<]+?>', '', html_body)
+        text_body = text_body_from_html(html_body)
     
     try:
-        response = client.emails.send(
+        # the client is synchronous, so it is called in a thread to keep the event loop running
+        response = await asyncio.to_thread(
+            client.emails.send,
             From=f"{FROM_NAME} <{FROM_EMAIL}>",
             To=to_email,
             Subject=subject,
@@ -62,11 +75,11 @@ async def send_email(
             TrackLinks="HtmlOnly"
         )
         
-        logger.info(f"Email sent: {response['MessageID']} to {to_email}")
+        logger.info("email sent", extra={"message_id": response['MessageID'], "tag": tag})
         return response
         
     except Exception as e:
-        logger.error(f"Failed to send email to {to_email}: {str(e)}")
+        logger.exception("failed to send email", extra={"tag": tag})
         raise
 
 
@@ -75,12 +88,15 @@ async def send_batch_emails(
     subject: str,
     html_body: str,
     text_body: Optional[str] = None,
-    tag: Optional[str] = None
+    tag: Optional[str] = None,
+    substitutions: Optional[List[dict]] = None
 ):
-    """Send batch emails using Postmark"""
+    """
+    Send batch emails using Postmark.  With substitutions, the subject and bodies are templates 
+    whose $name placeholders are replaced with the substitutions of each recipient.
+    """
     if SKIP_EMAILS:
-        logger.info(f"[BATCH EMAIL SKIPPED] {len(recipients)} recipients, Subject: {subject}")
-        print(f"[BATCH EMAIL SKIPPED] {len(recipients)} recipients, Subject: {subject}")
+        logger.info("batch email skipped", extra={"num_recipients": len(recipients), "subject": subject, "tag": tag})
         return {"Messages": [{"MessageID": "skipped"} for _ in recipients]}
     
     client = get_email_client()
@@ -89,8 +105,7 @@ async def send_batch_emails(
     
     # Create text body if not provided
     if not text_body:
-        import re
-        text_body = re.sub('<[^<]+?>', '', html_body)
+        text_body = text_body_from_html(html_body)
     
     # Postmark allows up to 500 messages per batch
     batch_size = 500
@@ -100,27 +115,29 @@ async def send_batch_emails(
         for i in range(0, len(recipients), batch_size):
             batch = recipients[i:i + batch_size]
             
+            batch_substitutions = substitutions[i:i + batch_size] if substitutions is not None else [None] * len(batch)
+            
             messages = [
                 {
                     "From": f"{FROM_NAME} <{FROM_EMAIL}>",
                     "To": email,
-                    "Subject": subject,
-                    "HtmlBody": html_body,
-                    "TextBody": text_body,
+                    "Subject": render(subject, subs) if subs is not None else subject,
+                    "HtmlBody": render(html_body, subs) if subs is not None else html_body,
+                    "TextBody": render(text_body, subs) if subs is not None else text_body,
                     "Tag": tag,
                     "TrackOpens": True,
                     "TrackLinks": "HtmlOnly"
                 }
-                for email in batch
+                for email, subs in zip(batch, batch_substitutions)
             ]
             
-            response = client.emails.send_batch(*messages)
+            response = await asyncio.to_thread(client.emails.send_batch, *messages)
             all_responses.extend(response)
             
-            logger.info(f"Batch email sent: {len(batch)} recipients")
+            logger.info("batch email sent", extra={"num_recipients": len(batch), "tag": tag})
         
         return {"Messages": all_responses}
         
     except Exception as e:
-        logger.error(f"Failed to send batch email: {str(e)}")
+        logger.exception("failed to send batch email", extra={"tag": tag})
         raise
\ No newline at end of file
@@ -1,5 +1,5 @@
 
-from messages.conf import send_email, send_batch_emails, SKIP_EMAILS
+from messages.outbox import email_message, queue_emails
 from messages.helpers import participate_email
 
 
@@ -23,14 +23,9 @@ async def send_contact_form_email(message, background_tasks, vid=None, oid=None)
     
     # Send to all admin emails
     admin_emails = ['stablevoting.org@gmail.com', 'epacuit@umd.edu', 'wesholliday@berkeley.edu']
-    for admin_email in admin_emails:
-        background_tasks.add_task(
-            send_email,
-            to_email=admin_email,
-            subject=subject,
-            html_body=html_body,
-            tag="contact-form"
-        )
+    await queue_emails([
+        email_message(admin_email, subject, html_body, tag="contact-form")
+        for admin_email in admin_emails])
     
     return {"success": f"Message sent to administrators."}
 
@@ -48,13 +43,9 @@ async def send_emails_to_voters(emails_data, id, background_tasks, oid=None):
     subject = f"Participate in the poll: {emails_data.title}"
     
     # Send emails in batch
-    background_tasks.add_task(
-        send_batch_emails,
-        recipients=emails_data.emails,
-        subject=subject,
-        html_body=html_body,
-        tag=f"voter-invitation-{id}"
-    )
+    await queue_emails([
+        email_message(email, subject, html_body, tag=f"voter-invitation-{id}")
+        for email in emails_data.emails])
     
     return {"success": f"Emails queued for {len(emails_data.emails)} voters."}
 
@@ -93,13 +84,8 @@ async def send_email_to_owner(emails_data, id, background_tasks, oid=None):
     subject = f"Created poll: {emails_data.title}"
     
     # Send to all specified emails (usually just the owner)
-    for email in emails_data.emails:
-        background_tasks.add_task(
-            send_email,
-            to_email=email,
-            subject=subject,
-            html_body=html_body,
-            tag=f"poll-created-{id}"
-        )
+    await queue_emails([
+        email_message(email, subject, html_body, tag=f"poll-created-{id}")
+        for email in emails_data.emails])
     
     return {"success": "Owner notification sent."}
\ No newline at end of file
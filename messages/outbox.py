@@ -0,0 +1,301 @@
+## Email outbox
+#
+# Emails are not sent while a request is answered: they are saved in the EmailOutbox
+# collection, and a worker in each process sends the emails that are due with the batch API
+# of Postmark, in a thread so that the event loop is not blocked.  A worker claims a batch
+# by moving its emails to the sending state until OUTBOX_LOCK_SECONDS from now, so the
+# workers of different processes never send the same email, and the emails of a worker
+# that stopped while sending are claimed again once the lock expires.  An email that could
+# not be sent is retried with exponential backoff, and after OUTBOX_MAX_ATTEMPTS attempts,
+# or when Postmark rejects it for good, it is left in the dead state.
+#
+# Emails that only differ by a few values, such as the invitations to a private poll, which
+# each have the link of one voter, are queued as one template, saved once in the
+# EmailTemplates collection, and the substitutions of each recipient.  They are rendered
+# when they are sent.  Emails queued for a poll record its id, so that the owner can follow
+# the progress of the invitations.
+#
+
+import asyncio
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pymongo import UpdateOne
+
+from polls.database import Collection
+from polls import metrics
+from messages.conf import SKIP_EMAILS, FROM_EMAIL, FROM_NAME, get_email_client, text_body_from_html, render
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_BATCH_SIZE = min(500, int(os.getenv('OUTBOX_BATCH_SIZE', '500'))) # Postmark accepts at most 500 emails per batch
+OUTBOX_RATE_LIMIT = float(os.getenv('OUTBOX_RATE_LIMIT', '100')) # emails per second sent by each worker
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '8'))
+OUTBOX_BASE_BACKOFF = float(os.getenv('OUTBOX_BASE_BACKOFF', '30')) # seconds before the first retry, doubled after each attempt
+OUTBOX_MAX_BACKOFF = float(os.getenv('OUTBOX_MAX_BACKOFF', '3600')) # seconds
+OUTBOX_LOCK_SECONDS = int(os.getenv('OUTBOX_LOCK_SECONDS', '300'))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '5')) # seconds between checks for emails queued by other processes
+OUTBOX_RETENTION_SECONDS = int(os.getenv('OUTBOX_RETENTION_SECONDS', str(7 * 24 * 3600))) # sent emails are deleted after this time
+
+# Postmark error codes of emails that will never be accepted: invalid request and inactive recipient
+PERMANENT_ERROR_CODES = {300, 406}
+
+PENDING, SENDING, SENT, DEAD = "pending", "sending", "sent", "dead"
+
+outbox_db = Collection("EmailOutbox")
+templates_db = Collection("EmailTemplates")
+
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
+
+def email_message(to_email, subject, html_body, text_body=None, tag=None, poll_id=None):
+    """An email to add to the outbox."""
+    email = {"to": to_email, "subject": subject, "html_body": html_body, "text_body": text_body, "tag": tag}
+    if poll_id is not None:
+        email["poll_id"] = poll_id
+    return email
+
+
+def escape_template(text):
+    """Escape the text so that it is left as it is when it is part of a template."""
+    return text.replace("$", "$$") if text is not None else None
+
+
+def render_email(email, template):
+    """The subject, html body and text body of an email, rendered from its template if it has one."""
+    if template is None:
+        return email["subject"], email["html_body"], email["text_body"]
+    subs = email["substitutions"]
+    return render(template["subject"], subs), render(template["html_body"], subs), render(template["text_body"], subs)
+
+
+def postmark_message(email, template=None):
+    subject, html_body, text_body = render_email(email, template)
+    return {
+        "From": f"{FROM_NAME} <{FROM_EMAIL}>",
+        "To": email["to"],
+        "Subject": subject,
+        "HtmlBody": html_body,
+        "TextBody": text_body or text_body_from_html(html_body),
+        "Tag": email["tag"],
+        "TrackOpens": True,
+        "TrackLinks": "HtmlOnly"
+    }
+
+
+def backoff(attempts):
+    """Seconds to wait before the next attempt to send an email that failed attempts times."""
+    return min(OUTBOX_MAX_BACKOFF, OUTBOX_BASE_BACKOFF * 2 ** (attempts - 1))
+
+
+class EmailOutbox:
+
+    def __init__(self):
+        self.depth = 0 # emails pending or being sent, as of the last check
+        self.sent = 0
+        self.retried = 0
+        self.dead = 0
+        self._wake = None
+        self._worker = None
+
+    async def ensure_indexes(self):
+        await outbox_db.create_index([("status", 1), ("next_attempt_at", 1)])
+        await outbox_db.create_index("claim", sparse=True)
+        await outbox_db.create_index("sent_at", expireAfterSeconds=OUTBOX_RETENTION_SECONDS)
+        await outbox_db.create_index(
+            [("poll_id", 1), ("status", 1)], 
+            partialFilterExpression={"poll_id": {"$exists": True}})
+        # the emails of a template are sent, or dead lettered, long before it expires
+        await templates_db.create_index("created_at", expireAfterSeconds=OUTBOX_RETENTION_SECONDS)
+
+    def start(self):
+        if self._worker is None:
+            self._wake = asyncio.Event()
+            self._worker = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+    async def enqueue(self, emails):
+        """Add the emails to the outbox, to be sent by the worker."""
+        if len(emails) == 0:
+            return
+        now = utcnow()
+        await outbox_db.insert_many(
+            [{**email, "status": PENDING, "attempts": 0, "created_at": now, "next_attempt_at": now} for email in emails],
+            ordered=False)
+        self.depth += len(emails)
+        if self._wake is not None:
+            self._wake.set()
+
+    async def enqueue_template(self, subject, html_body, recipients, substitutions, text_body=None, tag=None, poll_id=None):
+        """
+        Add an email for each recipient to the outbox, rendered from the template with the 
+        substitutions of the recipient.
+        """
+        recipients = list(zip(recipients, substitutions))
+        if len(recipients) == 0:
+            return
+        template = await templates_db.insert_one(
+            {"subject": subject, "html_body": html_body, "text_body": text_body, "tag": tag, "created_at": utcnow()})
+        emails = list()
+        for to_email, subs in recipients:
+            email = {"to": to_email, "template_id": template.inserted_id, "substitutions": subs, "tag": tag}
+            if poll_id is not None:
+                email["poll_id"] = poll_id
+            emails.append(email)
+        await self.enqueue(emails)
+
+    async def _run(self):
+        while True:
+            try:
+                num_sent = await self.drain()
+                self.depth = await outbox_db.count_documents({"status": {"$in": [PENDING, SENDING]}})
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("email outbox worker failed")
+                num_sent = 0
+            if num_sent == 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), OUTBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self._wake.clear()
+
+    async def drain(self):
+        """Send the emails that are due, in batches.  Returns the number of emails that were attempted."""
+        num_attempted = 0
+        while True:
+            emails = await self._claim()
+            if len(emails) == 0:
+                return num_attempted
+            started_at = time.monotonic()
+            await self._send(emails)
+            num_attempted += len(emails)
+            # stay under the rate limit
+            await asyncio.sleep(max(0.0, len(emails) / OUTBOX_RATE_LIMIT - (time.monotonic() - started_at)))
+
+    async def _claim(self):
+        """Claim a batch of the emails that are due and return them."""
+        now = utcnow()
+        due = {"status": {"$in": [PENDING, SENDING]}, "next_attempt_at": {"$lte": now}}
+        ids = [e["_id"] async for e in outbox_db.find(due, {"_id": 1}).sort("next_attempt_at", 1).limit(OUTBOX_BATCH_SIZE)]
+        if len(ids) == 0:
+            return []
+        claim = uuid.uuid4().hex
+        # the emails claimed by another worker in the meantime are no longer due
+        await outbox_db.update_many(
+            {"_id": {"$in": ids}, **due},
+            {"$set": {"status": SENDING, "claim": claim, "next_attempt_at": now + timedelta(seconds=OUTBOX_LOCK_SECONDS)}})
+        return await outbox_db.find({"claim": claim}).to_list(None)
+
+    async def _templates(self, emails):
+        template_ids = list({e["template_id"] for e in emails if "template_id" in e})
+        if len(template_ids) == 0:
+            return dict()
+        return {t["_id"]: t async for t in templates_db.find({"_id": {"$in": template_ids}})}
+
+    async def _send(self, emails):
+        """Send a batch of claimed emails and record the result of each one."""
+        templates = await self._templates(emails)
+        missing = [e for e in emails if "template_id" in e and e["template_id"] not in templates]
+        if len(missing) > 0:
+            # the template expired, these emails can no longer be sent
+            await outbox_db.update_many(
+                {"_id": {"$in": [e["_id"] for e in missing]}},
+                {"$set": {"status": DEAD, "last_error": "The template of the email expired."}, "$unset": {"claim": ""}})
+            self.dead += len(missing)
+            metrics.outbox_emails.labels(DEAD).inc(len(missing))
+            emails = [e for e in emails if "template_id" not in e or e["template_id"] in templates]
+            if len(emails) == 0:
+                return
+
+        if SKIP_EMAILS:
+            logger.info("batch email skipped", extra={"num_recipients": len(emails)})
+            responses = [{"ErrorCode": 0, "MessageID": "skipped"} for _ in emails]
+        else:
+            try:
+                client = get_email_client()
+                messages = [postmark_message(e, templates.get(e.get("template_id"))) for e in emails]
+                responses = await asyncio.to_thread(client.emails.send_batch, *messages)
+            except Exception as e:
+                logger.warning("failed to send batch email", extra={"num_recipients": len(emails), "error": str(e)})
+                responses = [{"ErrorCode": None, "Message": str(e)} for _ in emails]
+
+        now = utcnow()
+        updates = list()
+        for email, response in zip(emails, responses):
+            claimed = {"_id": email["_id"], "claim": email["claim"]}
+            error_code = response.get("ErrorCode", 0)
+            if error_code == 0:
+                self.sent += 1
+                metrics.outbox_emails.labels(SENT).inc()
+                updates.append(UpdateOne(claimed, {
+                    "$set": {"status": SENT, "sent_at": now, "message_id": response.get("MessageID")},
+                    "$unset": {"claim": "", "html_body": "", "text_body": "", "substitutions": ""}}))
+                continue
+            attempts = email["attempts"] + 1
+            error = {"attempts": attempts, "last_error": response.get("Message"), "last_error_code": error_code}
+            if error_code in PERMANENT_ERROR_CODES or attempts >= OUTBOX_MAX_ATTEMPTS:
+                self.dead += 1
+                metrics.outbox_emails.labels(DEAD).inc()
+                logger.warning("email dead lettered", extra={"email_id": str(email["_id"]), "tag": email["tag"], **error})
+                updates.append(UpdateOne(claimed, {"$set": {"status": DEAD, **error}, "$unset": {"claim": ""}}))
+            else:
+                self.retried += 1
+                metrics.outbox_emails.labels("retry").inc()
+                updates.append(UpdateOne(claimed, {
+                    "$set": {"status": PENDING, "next_attempt_at": now + timedelta(seconds=backoff(attempts)), **error},
+                    "$unset": {"claim": ""}}))
+        await outbox_db.bulk_write(updates, ordered=False)
+        logger.info("batch email sent", extra={"num_recipients": len(emails), "num_sent": sum(r.get("ErrorCode", 0) == 0 for r in responses)})
+
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "sent": self.sent,
+            "retried": self.retried,
+            "dead": self.dead,
+        }
+
+
+outbox = EmailOutbox()
+
+
+async def queue_emails(emails):
+    """Add the emails, made with email_message, to the outbox."""
+    await outbox.enqueue(emails)
+
+
+async def queue_email(to_email, subject, html_body, text_body=None, tag=None, poll_id=None):
+    await outbox.enqueue([email_message(to_email, subject, html_body, text_body, tag, poll_id)])
+
+
+async def queue_templated_emails(subject, html_body, recipients, substitutions, text_body=None, tag=None, poll_id=None):
+    """
+    Add an email for each recipient to the outbox.  The subject and bodies are templates with 
+    $name placeholders, and substitutions has the values of the placeholders for each recipient.
+    """
+    await outbox.enqueue_template(subject, html_body, recipients, substitutions, text_body, tag, poll_id)
+
+
+async def poll_email_progress(poll_id):
+    """The number of emails queued for the poll in each state.  Sent emails are only counted until they expire."""
+    progress = {PENDING: 0, SENDING: 0, SENT: 0, DEAD: 0}
+    async for group in outbox_db.aggregate([
+            {"$match": {"poll_id": poll_id}},
+            {"$group": {"_id": "$status", "count": {"$sum": 1}}}]):
+        progress[group["_id"]] = group["count"]
+    progress["total"] = sum(progress.values())
+    return progress
+
+
+def email_queue_depth():
+    return outbox.depth
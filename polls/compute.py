@@ -0,0 +1,162 @@
+## Compute service
+#
+# Split Cycle and Stable Voting can take a long time for polls with many candidates, so
+# they are run in a pool of worker processes instead of on the event loop.  Each task
+# has a limit on the CPU time it may use, and the number of tasks waiting for or running
+# in the pool is bounded: when the pool is full new tasks are rejected so that the
+# caller can ask the client to retry later.
+#
+
+import asyncio
+import multiprocessing
+import os
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from polls import metrics
+
+COMPUTE_WORKERS = int(os.getenv('COMPUTE_WORKERS', '2'))
+COMPUTE_MAX_PENDING = int(os.getenv('COMPUTE_MAX_PENDING', '32')) # tasks queued or running
+COMPUTE_RETRY_AFTER = int(os.getenv('COMPUTE_RETRY_AFTER', '5')) # seconds
+COMPUTE_GRACE_PERIOD = 5 # seconds of wall clock time allowed past the cpu limit before the pool is restarted
+
+
+class ComputeUnavailable(Exception):
+    """The computation could not be carried out now."""
+    retry_after = COMPUTE_RETRY_AFTER
+
+
+class ComputeBusy(ComputeUnavailable):
+    """Too many computations are waiting for the pool."""
+
+
+class ComputeTimeout(ComputeUnavailable):
+    """The computation used more than its cpu time limit."""
+
+
+def _cpu_limit_exceeded(signum, frame):
+    raise ComputeTimeout()
+
+
+def _init_worker():
+    # import the voting code once per worker rather than with the first task
+    import polls.voting # noqa: F401
+
+
+def _run_with_cpu_limit(fn, args, cpu_limit, submitted_at):
+    '''
+    Run fn(*args) in a worker process, interrupting it once it has used cpu_limit seconds
+    of CPU time.  Returns the result together with the time the task spent in the queue
+    and the time it took to compute.
+    '''
+    started_at = time.time()
+    signal.signal(signal.SIGPROF, _cpu_limit_exceeded)
+    signal.setitimer(signal.ITIMER_PROF, cpu_limit)
+    try:
+        result = fn(*args)
+    finally:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+    return result, started_at - submitted_at, time.time() - started_at
+
+
+class ComputeService:
+
+    def __init__(self, max_workers=COMPUTE_WORKERS, max_pending=COMPUTE_MAX_PENDING):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = None
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.restarts = 0
+        self.queue_wait_seconds = 0.0
+        self.max_queue_wait_seconds = 0.0
+        self.compute_seconds = 0.0
+        self.max_compute_seconds = 0.0
+
+    def start(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _restart(self, executor):
+        '''Kill the workers of executor, including any that ignore the cpu limit, and start a new pool.'''
+        if executor is not self._executor:
+            return # the pool was already restarted
+        self._executor = None
+        for process in list(getattr(executor, "_processes", {}).values()):
+            process.kill()
+        executor.shutdown(wait=False, cancel_futures=True)
+        self.restarts += 1
+        self.start()
+
+    async def run(self, fn, *args, cpu_limit):
+        '''
+        Run fn(*args) in the pool and return its result.  fn and args must be picklable.
+
+        Raises ComputeBusy when too many tasks are pending and ComputeTimeout when the
+        task uses more than cpu_limit seconds of CPU time.
+        '''
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise ComputeBusy()
+        self.start()
+        executor = self._executor
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(executor, _run_with_cpu_limit, fn, args, cpu_limit, time.time())
+            # the cpu limit bounds the computation, the wall clock limit bounds the time in the queue as well
+            wall_limit = cpu_limit * (1 + self.max_pending / self.max_workers) + COMPUTE_GRACE_PERIOD
+            try:
+                result, queue_wait, compute_time = await asyncio.wait_for(future, wall_limit)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                metrics.compute_timeouts.labels(fn.__name__).inc()
+                self._restart(executor)
+                raise ComputeTimeout()
+            except ComputeTimeout:
+                self.timeouts += 1
+                metrics.compute_timeouts.labels(fn.__name__).inc()
+                raise
+            except BrokenProcessPool:
+                self._restart(executor)
+                raise ComputeUnavailable()
+        finally:
+            self.pending -= 1
+
+        self.completed += 1
+        self.queue_wait_seconds += queue_wait
+        self.max_queue_wait_seconds = max(self.max_queue_wait_seconds, queue_wait)
+        self.compute_seconds += compute_time
+        self.max_compute_seconds = max(self.max_compute_seconds, compute_time)
+        metrics.compute_queue_wait.observe(queue_wait)
+        metrics.compute_latency.labels(fn.__name__).observe(compute_time)
+        return result
+
+    def stats(self):
+        return {
+            "workers": self.max_workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "restarts": self.restarts,
+            "queue_wait_seconds": self.queue_wait_seconds,
+            "max_queue_wait_seconds": self.max_queue_wait_seconds,
+            "compute_seconds": self.compute_seconds,
+            "max_compute_seconds": self.max_compute_seconds,
+        }
+
+
+compute_service = ComputeService()
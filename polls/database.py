@@ -0,0 +1,157 @@
+## Database
+#
+# The MongoDB client is created when the application starts and closed when it stops.  Every
+# uvicorn worker has its own client, so the pool settings below apply to each worker.  The
+# collections used by the rest of the code can be created before the client, they look up
+# the client when they are used.
+#
+
+import asyncio
+import os
+import threading
+import time
+import certifi
+import motor.motor_asyncio
+from pymongo import monitoring
+from polls.metrics import CommandLatency
+
+DATABASE_NAME = os.getenv('MONGO_DB_NAME', 'StableVoting')
+
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', '100'))
+MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', '0'))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv('MONGO_MAX_IDLE_TIME_MS', '300000'))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000'))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv('MONGO_CONNECT_TIMEOUT_MS', '5000'))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv('MONGO_SOCKET_TIMEOUT_MS', '30000'))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv('MONGO_WAIT_QUEUE_TIMEOUT_MS', '10000'))
+MONGO_PING_TIMEOUT = float(os.getenv('MONGO_PING_TIMEOUT', '2')) # seconds
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """Count the connections of the pool.  The events are published from the threads of the driver."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.open = 0 # connections in the pool, checked out or idle
+        self.checked_out = 0 # connections in use
+        self.waiting = 0 # operations waiting to check out a connection
+        self.created = 0
+        self.closed = 0
+        self.checkout_failures = 0
+        self.pool_cleared = 0
+
+    def _update(self, **changes):
+        with self._lock:
+            for counter, change in changes.items():
+                setattr(self, counter, getattr(self, counter) + change)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._update(pool_cleared=1)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._update(open=1, created=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._update(open=-1, closed=1)
+
+    def connection_check_out_started(self, event):
+        self._update(waiting=1)
+
+    def connection_check_out_failed(self, event):
+        self._update(waiting=-1, checkout_failures=1)
+
+    def connection_checked_out(self, event):
+        self._update(waiting=-1, checked_out=1)
+
+    def connection_checked_in(self, event):
+        self._update(checked_out=-1)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "open": self.open,
+                "checked_out": self.checked_out,
+                "waiting": self.waiting,
+                "created": self.created,
+                "closed": self.closed,
+                "checkout_failures": self.checkout_failures,
+                "pool_cleared": self.pool_cleared,
+            }
+
+
+class Database:
+
+    def __init__(self):
+        self.client = None
+        self.pool_stats = PoolStats()
+
+    def connect(self):
+        """Create the client, unless it was already created."""
+        if self.client is None:
+            mongo_details = os.getenv('MONGODB_URI')
+            options = dict(
+                maxPoolSize=MONGO_MAX_POOL_SIZE,
+                minPoolSize=MONGO_MIN_POOL_SIZE,
+                maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+                serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+                socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+                waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+                event_listeners=[self.pool_stats, CommandLatency()])
+            # Check if we're in development (local MongoDB doesn't use SSL)
+            if not (mongo_details and ('localhost' in mongo_details or '127.0.0.1' in mongo_details)):
+                # Production connection with SSL
+                options.update(tlsCAFile=certifi.where(), tls=True)
+            self.client = motor.motor_asyncio.AsyncIOMotorClient(mongo_details, **options)
+        return self.client
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+    def collection(self, name):
+        return self.connect()[DATABASE_NAME][name]
+
+    async def ping(self, timeout=MONGO_PING_TIMEOUT):
+        """Ping the server.  Returns whether it answered within timeout seconds and how long it took."""
+        started_at = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.connect().admin.command("ping"), timeout)
+            ok = True
+        except Exception:
+            ok = False
+        return ok, time.perf_counter() - started_at
+
+    def stats(self):
+        return {
+            "connected": self.client is not None,
+            "max_pool_size": MONGO_MAX_POOL_SIZE,
+            "min_pool_size": MONGO_MIN_POOL_SIZE,
+            **self.pool_stats.stats(),
+        }
+
+
+database = Database()
+
+
+class Collection:
+    """A collection of the database that can be created before the client."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(database.collection(self.name), attr)
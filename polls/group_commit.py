@@ -0,0 +1,83 @@
+## Group commit
+#
+# When many votes for the same poll arrive at once, writing each one on its own makes every
+# request update the same poll document.  Instead the submissions for a poll that arrive
+# within VOTE_GROUP_WINDOW seconds of the first one are written together, and each request
+# gets its result once the whole group is written.
+#
+
+import asyncio
+import logging
+import os
+import time
+
+from polls import metrics
+
+VOTE_GROUP_WINDOW = float(os.getenv('VOTE_GROUP_WINDOW', '0.02')) # seconds
+VOTE_GROUP_MAX_SIZE = int(os.getenv('VOTE_GROUP_MAX_SIZE', '500'))
+
+logger = logging.getLogger(__name__)
+
+
+class GroupCommit:
+
+    def __init__(self, window=VOTE_GROUP_WINDOW, max_size=VOTE_GROUP_MAX_SIZE):
+        self.window = window
+        self.max_size = max_size
+        self.groups = 0 # groups committed
+        self.items = 0 # items in the committed groups
+        self.max_group_size = 0
+        self._pending = dict()
+
+    async def submit(self, key, item, commit_fn):
+        '''
+        Add item to the group of key and return its result once the group is committed with
+        commit_fn(key, items), which returns the result of each item.
+        '''
+        loop = asyncio.get_running_loop()
+        group = self._pending.get(key)
+        if group is None:
+            group = self._pending[key] = list()
+            loop.call_later(self.window, self._commit, key, group, commit_fn)
+        future = loop.create_future()
+        group.append((item, future))
+        if len(group) >= self.max_size:
+            self._commit(key, group, commit_fn)
+        # shield the result so that a cancelled request does not cancel it for the rest of the group
+        return await asyncio.shield(future)
+
+    def _commit(self, key, group, commit_fn):
+        if self._pending.get(key) is group: # the group was not committed yet
+            del self._pending[key]
+            asyncio.ensure_future(self._commit_group(key, group, commit_fn))
+
+    async def _commit_group(self, key, group, commit_fn):
+        started_at = time.perf_counter()
+        try:
+            results = await commit_fn(key, [item for item, _ in group])
+            for (_, future), result in zip(group, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _, future in group:
+                if not future.done():
+                    future.set_exception(e)
+        duration = time.perf_counter() - started_at
+
+        self.groups += 1
+        self.items += len(group)
+        self.max_group_size = max(self.max_group_size, len(group))
+        metrics.group_commit_size.observe(len(group))
+        metrics.group_commit_latency.observe(duration)
+        logger.info("group commit", extra={"poll_id": key, "group_size": len(group), "duration_ms": round(1000 * duration, 1)})
+
+    def stats(self):
+        return {
+            "groups": self.groups,
+            "items": self.items,
+            "max_group_size": self.max_group_size,
+            "pending_groups": len(self._pending),
+        }
+
+
+vote_group_commit = GroupCommit()
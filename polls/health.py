@@ -0,0 +1,90 @@
+## Health
+#
+# Liveness and readiness of a worker.  A worker is live as long as it answers requests, and
+# it is ready when MongoDB answers a ping quickly, the event loop is not lagging and the
+# compute service and email queue are not saturated.  The checks only read counters, except
+# for the ping, which is shared by the requests made within READY_PING_CACHE_SECONDS, so
+# readiness can be checked every second.
+#
+
+import asyncio
+import os
+import time
+
+READY_MAX_MONGO_LATENCY = float(os.getenv('READY_MAX_MONGO_LATENCY', '1')) # seconds
+READY_MAX_LOOP_LAG = float(os.getenv('READY_MAX_LOOP_LAG', '0.5')) # seconds
+READY_MAX_OUTCOMES_IN_FLIGHT = int(os.getenv('READY_MAX_OUTCOMES_IN_FLIGHT', '32'))
+READY_MAX_EMAIL_QUEUE = int(os.getenv('READY_MAX_EMAIL_QUEUE', '1000'))
+READY_PING_CACHE_SECONDS = float(os.getenv('READY_PING_CACHE_SECONDS', '1'))
+LOOP_LAG_INTERVAL = 0.25 # seconds between measurements of the event loop lag
+
+
+class Readiness:
+
+    def __init__(self):
+        self.loop_lag = 0.0 # seconds the last wake up of the monitor was late
+        self.max_loop_lag = 0.0
+        self._monitor = None
+        self._ping = None # task of the last ping
+        self._pinged_at = 0.0
+
+    def start(self):
+        if self._monitor is None:
+            self._monitor = asyncio.ensure_future(self._monitor_loop_lag())
+
+    def stop(self):
+        if self._monitor is not None:
+            self._monitor.cancel()
+            self._monitor = None
+
+    async def _monitor_loop_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started_at = loop.time()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            self.loop_lag = max(0.0, loop.time() - started_at - LOOP_LAG_INTERVAL)
+            self.max_loop_lag = max(self.max_loop_lag, self.loop_lag)
+
+    async def mongo_ping(self):
+        from polls.database import database
+        if self._ping is None or time.monotonic() - self._pinged_at > READY_PING_CACHE_SECONDS:
+            self._pinged_at = time.monotonic()
+            self._ping = asyncio.ensure_future(database.ping())
+        return await asyncio.shield(self._ping)
+
+    async def check(self):
+        """Return whether the worker is ready and the result of each check."""
+        from polls.compute import compute_service
+        from polls.outcome_cache import outcome_cache
+        from messages.outbox import email_queue_depth
+
+        mongo_ok, mongo_latency = await self.mongo_ping()
+        outcomes_in_flight = outcome_cache.stats()["in_flight"]
+        checks = {
+            "mongo": {
+                "ok": mongo_ok and mongo_latency <= READY_MAX_MONGO_LATENCY,
+                "latency_seconds": mongo_latency,
+            },
+            "event_loop": {
+                "ok": self.loop_lag <= READY_MAX_LOOP_LAG,
+                "lag_seconds": self.loop_lag,
+                "max_lag_seconds": self.max_loop_lag,
+            },
+            "compute": {
+                "ok": compute_service.pending < compute_service.max_pending,
+                "pending": compute_service.pending,
+                "max_pending": compute_service.max_pending,
+            },
+            "outcomes": {
+                "ok": outcomes_in_flight <= READY_MAX_OUTCOMES_IN_FLIGHT,
+                "in_flight": outcomes_in_flight,
+            },
+            "email_queue": {
+                "ok": email_queue_depth() <= READY_MAX_EMAIL_QUEUE,
+                "depth": email_queue_depth(),
+            },
+        }
+        return all(c["ok"] for c in checks.values()), checks
+
+
+readiness = Readiness()
@@ -1,16 +1,36 @@
 ## Helpers
 #
 
-import random
+import secrets
 
+ID_ALPHABET = b'0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+ID_LENGTH = 8
 
-def generate_voter_ids(num_voters): 
-    '''generate num_voters unique ids'''
-    
-    alphabet = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
-    ids =   [''.join(random.choices(alphabet, k=8)) for _ in range(num_voters)]
+# random bytes are mapped to the characters of the alphabet, the bytes from _ID_LIMIT on are
+# dropped so that every character is equally likely
+_ID_LIMIT = 256 - 256 % len(ID_ALPHABET)
+_ID_TABLE = bytes(ID_ALPHABET[b % len(ID_ALPHABET)] for b in range(256))
+_ID_REJECTED = bytes(range(_ID_LIMIT, 256))
 
-    while len(ids) != len(list(set(ids))): 
-        ids =  [''.join(random.choices(alphabet, k=8)) for _ in range(num_voters)]
-    return ids
 
+def random_ids(num_ids, length=ID_LENGTH):
+    '''generate num_ids random ids from a cryptographically strong source, they may not be unique'''
+    num_chars = num_ids * length
+    chars = b''
+    while len(chars) < num_chars:
+        # a few more bytes than needed, since some of them are dropped
+        chars += secrets.token_bytes((num_chars - len(chars)) * 256 // _ID_LIMIT + 16).translate(_ID_TABLE, _ID_REJECTED)
+    chars = chars[:num_chars].decode()
+    return [chars[i:i + length] for i in range(0, num_chars, length)]
+
+
+def generate_voter_ids(num_voters, exclude=()):
+    '''generate num_voters unique ids, none of them in exclude'''
+    ids = list()
+    seen = set(exclude)
+    while len(ids) < num_voters:
+        for vid in random_ids(num_voters - len(ids)):
+            if vid not in seen:
+                seen.add(vid)
+                ids.append(vid)
+    return ids
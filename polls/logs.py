@@ -0,0 +1,100 @@
+## Logs
+#
+# Structured logging: every record is written as one line of JSON with its level, logger,
+# message, the id of the request it belongs to and any fields passed with extra={...}.
+# Long values are truncated, so that logging a poll never writes the whole document.  The
+# routes that are called most often only log the records below WARNING for a sample of
+# their requests.  The profiles of the polls are only logged at the DEBUG level when
+# LOG_PROFILES is set.
+#
+
+import contextvars
+import contextlib
+import io
+import json
+import logging
+import os
+import random
+import sys
+import time
+import uuid
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_MAX_VALUE_LENGTH = int(os.getenv('LOG_MAX_VALUE_LENGTH', '1000')) # characters of each logged value
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '0.1')) # fraction of the requests to the sampled routes that are logged
+LOG_SAMPLED_ROUTES = tuple(p for p in os.getenv(
+    'LOG_SAMPLED_ROUTES',
+    '/polls/vote/,/polls/outcome/,/polls/ranking_information/,/polls/data/,/polls/bulk_vote/,/polls/invitations/,/health,/metrics').split(',') if p)
+LOG_PROFILES = os.getenv('LOG_PROFILES', 'false').lower() == 'true'
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+request_id = contextvars.ContextVar("request_id", default=None)
+sampled = contextvars.ContextVar("sampled", default=True)
+
+# the attributes of every LogRecord, the other attributes are fields passed with extra
+_RECORD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime"}
+
+
+def truncate(value, max_length=LOG_MAX_VALUE_LENGTH):
+    """The value, or its string representation cut to max_length characters if it is longer."""
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    s = value if isinstance(value, str) else str(value)
+    if len(s) > max_length:
+        return f"{s[:max_length]}... ({len(s)} characters)"
+    return s
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": truncate(record.getMessage()),
+        }
+        rid = request_id.get()
+        if rid is not None:
+            entry["request_id"] = rid
+        for attr, value in record.__dict__.items():
+            if attr not in _RECORD_ATTRIBUTES and not attr.startswith("_"):
+                entry[attr] = truncate(value)
+        if record.exc_info:
+            entry["exception"] = truncate(self.formatException(record.exc_info), 10 * LOG_MAX_VALUE_LENGTH)
+        return json.dumps(entry, default=str)
+
+
+class SampleFilter(logging.Filter):
+    """Drop the records below WARNING of the requests that were not sampled."""
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or sampled.get()
+
+
+def configure_logging():
+    """Write the records of the application as JSON to stderr."""
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter())
+    handler.addFilter(SampleFilter())
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(LOG_LEVEL)
+
+
+def start_request(path, rid=None):
+    """Set the id of the current request, and whether its records are logged.  Returns the id."""
+    rid = rid or uuid.uuid4().hex
+    request_id.set(rid)
+    sampled.set(not path.startswith(LOG_SAMPLED_ROUTES) or random.random() < LOG_SAMPLE_RATE)
+    return rid
+
+
+def log_profile(logger, prof, **fields):
+    """Log the table of the profile at the DEBUG level, only when LOG_PROFILES is set."""
+    if LOG_PROFILES and logger.isEnabledFor(logging.DEBUG):
+        table = io.StringIO()
+        with contextlib.redirect_stdout(table):
+            prof.display()
+        logger.debug("profile", extra={**fields, "profile": table.getvalue()})
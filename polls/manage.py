@@ -9,61 +9,408 @@
 from fastapi import BackgroundTasks, File, UploadFile
 import arrow
 import random
-import motor.motor_asyncio
 from pymongo import read_concern
-import uuid
+from pymongo import ReturnDocument, InsertOne, UpdateOne, UpdateMany
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+import asyncio
+import base64
 import csv
+import datetime
+import functools
+import hashlib
+import hmac
+import io
+import logging
 import os
+import time
+import bson
 from bson import ObjectId
 import humanize
-from func_timeout import func_timeout, FunctionTimedOut
 
 from pref_voting.profiles_with_ties import ProfileWithTies
-from pref_voting.voting_methods import split_cycle_defeat, stable_voting, split_cycle
 from polls.models import CreatePoll, UpdatePoll
 from polls.helpers import generate_voter_ids
 from messages.helpers import participate_email
-from polls.voting import is_linear, generate_columns_from_profiles, stable_voting_with_explanations_, get_splitting_numbers, generate_csv_data
+from polls.voting import rank_array, support_matrix, margin_matrix, generate_columns, generate_columns_from_profiles, iter_csv_rows, split_cycle_defeat_relation, split_cycle_winners, stable_voting_explained, stable_voting_winners, splitting_numbers_from_margins, margins_from_matrix, edges_from_margins, condorcet_winner_from_margins, linear_order_from_margins
+from polls.tallies import EMPTY_RANKING_KEY, empty_tally, ranking_key, tally_delta, nonzero, tally_from_ballots, ranked_candidates, margin_matrix_from_tally, ranking_counts_from_tally
+from polls.outcome_cache import outcome_cache
+from polls.group_commit import vote_group_commit
+from polls.compute import compute_service, ComputeTimeout
+from polls.metrics import fallbacks, profile_latency, outcome_candidates, outcome_ballots
+from polls.logs import log_profile
+from polls.database import Collection
 
 # UPDATED IMPORTS - removed fastapi_mail, added new email functions
-from messages.conf import SKIP_EMAILS, send_email
-import certifi
-
-# # MongoDB connection
-# mongo_details = os.getenv('MONGO_DETAILS')
-# print("mongo_details ", mongo_details)
-# client = motor.motor_asyncio.AsyncIOMotorClient(mongo_details, tlsCAFile=certifi.where(), tls=True)
-# db = client.StableVoting.Polls
-
-# MongoDB connection
-mongo_details = os.getenv('MONGODB_URI')
-print("mongo_details ", mongo_details)
-
-# Check if we're in development (local MongoDB doesn't use SSL)
-if mongo_details and ('localhost' in mongo_details or '127.0.0.1' in mongo_details):
-    # Local connection without SSL
-    client = motor.motor_asyncio.AsyncIOMotorClient(mongo_details)
-else:
-    # Production connection with SSL
-    client = motor.motor_asyncio.AsyncIOMotorClient(mongo_details, tlsCAFile=certifi.where(), tls=True)
-
-data_base = os.getenv('MONGO_DB_NAME', 'StableVoting')
-db = client[data_base].Polls
-
-print(db)
+from messages.conf import SKIP_EMAILS
+from messages.outbox import email_message, escape_template, queue_email, queue_emails, queue_templated_emails, poll_email_progress
+
+db = Collection("Polls")
+ballots_db = Collection("Ballots")
+voters_db = Collection("Voters")
+migrations_db = Collection("Migrations")
+
+logger = logging.getLogger(__name__)
+
+# cpu time, in seconds, allowed for computing each part of an outcome and for the fallback 
+# computations used when the first computation takes too long
+OUTCOME_CPU_LIMIT = 2
+FALLBACK_CPU_LIMIT = int(os.getenv('FALLBACK_CPU_LIMIT', '30'))
+
+# the number of times the tally of a poll is computed from its ballots before giving up on saving it
+TALLY_BACKFILL_ATTEMPTS = 5
+
+# the number of rows of a csv file of rankings that are added to the database at once
+BULK_BATCH_SIZE = int(os.getenv('BULK_BATCH_SIZE', '1000'))
+
+# the largest checkpoint of the Stable Voting computation, explanations and saved outcome, in bytes of BSON, 
+# so that the poll document stays under the 16MB limit of MongoDB.  Larger checkpoints and explanations are 
+# trimmed to the largest subprofiles, and larger outcomes are not saved.
+SV_CHECKPOINT_MAX_BYTES = int(os.getenv('SV_CHECKPOINT_MAX_BYTES', str(4 * 2 ** 20)))
+EXPLANATIONS_MAX_BYTES = int(os.getenv('EXPLANATIONS_MAX_BYTES', str(2 * 2 ** 20)))
+RESULT_MAX_BYTES = int(os.getenv('RESULT_MAX_BYTES', str(6 * 2 ** 20)))
+
+# when set, the ip addresses of the ballots are stored as keyed hashes rather than as they are
+IP_HASH_SALT = os.getenv('IP_HASH_SALT')
+
+
+async def ensure_indexes():
+    """Create the indexes used to look up the ballots and the voters of a poll."""
+    await ballots_db.create_index([("poll_id", 1), ("voter_id", 1)])
+    await ballots_db.create_index([("poll_id", 1), ("ip", 1)])
+    # at most one ballot per voter in a private poll and per ip in a public poll that 
+    # does not allow multiple votes.  Ballots without a dedup_key are not constrained.
+    await ballots_db.create_index(
+        [("poll_id", 1), ("dedup_key", 1)], 
+        unique=True, 
+        partialFilterExpression={"dedup_key": {"$type": "string"}})
+    await voters_db.create_index([("poll_id", 1), ("voter_id", 1)], unique=True)
+    await db.create_index("owner_id", unique=True, partialFilterExpression={"owner_id": {"$type": "string"}})
+    # finds the polls that closed in a time range, polls without a closing date are not indexed.  The 
+    # closing dates stored as strings, before they were stored as dates, are converted by run_migrations
+    await db.create_index("closing_datetime", partialFilterExpression={"closing_datetime": {"$type": "date"}})
+    await voters_db.create_index([("poll_id", 1), ("email", 1)])
+
+
+def voter_dedup_key(vid):
+    return f"voter:{vid}"
+
+
+def has_ip(ip):
+    return ip is not None and ip != "n/a"
+
+
+def hash_ip(ip):
+    """The ip address as it is stored: a keyed hash of 22 characters when IP_HASH_SALT is set."""
+    if not IP_HASH_SALT or not has_ip(ip):
+        return ip
+    digest = hmac.new(IP_HASH_SALT.encode(), ip.encode(), hashlib.sha256).digest()[:16]
+    return base64.urlsafe_b64encode(digest).decode().rstrip("=")
+
+
+def stored_ips(ip):
+    """The values of the ip field of the ballots from the ip, including those stored before its address was hashed."""
+    return list(dict.fromkeys([hash_ip(ip), ip]))
+
+
+def ip_dedup_key(stored_ip):
+    return f"ip:{stored_ip}"
+
+
+def migrated_ballot_id(poll_id, idx):
+    """The id of the idx-th ballot embedded in the poll, the same every time the poll is migrated."""
+    return ObjectId(hashlib.sha256(f"{poll_id}:{idx}".encode()).digest()[:12])
+
+
+async def migrate_embedded_ballots(document):
+    """
+    Move the ballots embedded in an older poll document into the Ballots collection.
+
+    The ballots are inserted before the embedded array is removed, with ids that only depend on 
+    the poll and the position of the ballot.  So when the migration is interrupted it is done 
+    again by the next request, and when several requests migrate the same poll at once the 
+    ballots are only inserted once.
+    """
+    if "ballots" not in document:
+        return
+    old_document = await db.find_one(
+        {"_id": document["_id"], "ballots": {"$exists": True}},
+        {"ballots": 1, "is_private": 1, "allow_multiple_votes": 1})
+    if old_document is not None and len(old_document["ballots"]) > 0:
+        ballots = [{**b, "_id": migrated_ballot_id(document["_id"], idx), "poll_id": document["_id"]} 
+                   for idx, b in enumerate(old_document["ballots"])]
+        if not old_document.get("is_private", False) and not old_document.get("allow_multiple_votes", False):
+            # the first ballot from each ip keeps the ip from voting again
+            ips = set()
+            for b in ballots:
+                ip = b.get("ip", None)
+                if has_ip(ip) and ip not in ips:
+                    ips.add(ip)
+                    b["dedup_key"] = ip_dedup_key(ip)
+        try:
+            await ballots_db.insert_many(ballots, ordered=False)
+        except BulkWriteError as e:
+            # the ballots inserted by an earlier or a concurrent migration
+            duplicate_key_indices(e)
+    await db.update_one({"_id": document["_id"], "ballots": {"$exists": True}}, {"$unset": {"ballots": ""}})
+    document.pop("ballots", None)
+
+
+async def migrate_all_embedded_ballots():
+    """Migrate the embedded ballots and voters of every poll.  Returns the number of polls migrated."""
+    num_polls = 0
+    async for document in db.find(
+            {"$or": [{"ballots": {"$exists": True}}, {"voter_ids": {"$exists": True}}]}, 
+            {"_id": 1, "ballots": {"$slice": 0}, "voter_ids": {"$slice": 0}}):
+        await migrate_embedded_ballots(document)
+        await migrate_embedded_voters(document)
+        num_polls += 1
+    return num_polls
+
+
+async def migrate_closing_datetimes():
+    """Store the closing datetimes that are strings as dates.  Returns the number of polls updated."""
+    num_polls = 0
+    async for document in db.find({"closing_datetime": {"$type": "string"}}, {"closing_datetime": 1}):
+        await db.update_one(
+            {"_id": document["_id"], "closing_datetime": document["closing_datetime"]}, 
+            {"$set": {"closing_datetime": utc_closing_datetime(document["closing_datetime"])}})
+        num_polls += 1
+    return num_polls
+
+
+async def backfill_ip_dedup_keys():
+    """
+    Give a dedup_key to the first ballot from each ip of the public polls that do not allow multiple
+    votes, for the ballots that were migrated without one.  Returns the number of ballots updated.
+    """
+    num_ballots = 0
+    async for document in db.find({"is_private": False, "allow_multiple_votes": False}, {"_id": 1}):
+        keys = set(await ballots_db.distinct("dedup_key", {"poll_id": document["_id"]}))
+        async for b in ballots_db.find(
+                {"poll_id": document["_id"], "dedup_key": {"$exists": False}, "ip": {"$nin": [None, "n/a"]}},
+                {"ip": 1}):
+            key = ip_dedup_key(b["ip"])
+            if key not in keys:
+                keys.add(key)
+                await ballots_db.update_one({"_id": b["_id"]}, {"$set": {"dedup_key": key}})
+                num_ballots += 1
+    return num_ballots
+
+
+# the migrations of the documents stored by earlier versions, in the order in which they are run
+MIGRATIONS = [
+    ("closing_datetimes", migrate_closing_datetimes),
+    ("embedded_ballots", migrate_all_embedded_ballots),
+    ("ip_dedup_keys", backfill_ip_dedup_keys),
+]
+
+
+async def run_migrations():
+    """
+    Run the migrations that have not been completed, at startup.  A migration is recorded once it 
+    completes, so an interrupted migration is run again at the next startup, and the migrations 
+    are written so that running them again, or from several workers at once, does no harm.
+    """
+    for name, migration in MIGRATIONS:
+        if await migrations_db.find_one({"_id": name}) is not None:
+            continue
+        started_at = time.perf_counter()
+        count = await migration()
+        await migrations_db.update_one(
+            {"_id": name}, 
+            {"$set": {"completed_at": datetime.datetime.now(datetime.timezone.utc), "count": count}}, 
+            upsert=True)
+        logger.info("migration", extra={"migration": name, "count": count, "duration_ms": round(1000 * (time.perf_counter() - started_at), 1)})
+
+
+async def migrate_embedded_voters(document):
+    """
+    Move the voter ids, emails and email send counts stored in an older poll document into the 
+    Voters collection.  As with the ballots, the voters are inserted before they are removed from 
+    the poll document, and the unique index on the voter ids of a poll inserts each voter once.
+    """
+    if "voter_ids" not in document:
+        return
+    old_document = await db.find_one(
+        {"_id": document["_id"], "voter_ids": {"$exists": True}},
+        {"voter_ids": 1, "voter_email_map": 1, "email_send_counts": 1})
+    if old_document is not None and len(old_document["voter_ids"]) > 0:
+        voter_email_map = old_document.get("voter_email_map", {})
+        email_send_counts = old_document.get("email_send_counts", {})
+        try:
+            await voters_db.insert_many([
+                voter_document(document["_id"], vid, voter_email_map.get(vid, None), 
+                               email_send_counts.get(voter_email_map[vid], 1) if vid in voter_email_map else 0)
+                for vid in old_document["voter_ids"]], ordered=False)
+        except BulkWriteError as e:
+            # the voters inserted by an earlier or a concurrent migration
+            duplicate_key_indices(e)
+    await db.update_one(
+        {"_id": document["_id"], "voter_ids": {"$exists": True}}, 
+        {"$unset": {"voter_ids": "", "voter_email_map": "", "email_send_counts": ""}})
+    for field in ["voter_ids", "voter_email_map", "email_send_counts"]:
+        document.pop(field, None)
+
+
+# Read profiles: the fields of a poll that are read by each kind of request, so that requests 
+# which only need the settings of a poll do not read its tally, saved outcome or checkpoint.  
+# Each profile includes an empty slice of the arrays of older polls to tell whether the 
+# poll still has embedded ballots or voters.
+
+AUTH_FIELDS = ["owner_id", "is_private"]
+METADATA_FIELDS = AUTH_FIELDS + [
+    "title", "description", "hide_description", "candidates", "show_rankings", "closing_datetime", "timezone", 
+    "can_view_outcome_before_closing", "show_outcome", "allow_multiple_votes", "is_completed", "creation_dt", "revision"]
+
+def read_profile(fields):
+    return {**{field: 1 for field in fields}, "ballots": {"$slice": 0}, "voter_ids": {"$slice": 0}}
+
+AUTH_PROFILE = read_profile(AUTH_FIELDS)
+METADATA_PROFILE = read_profile(METADATA_FIELDS)
+COUNT_PROFILE = read_profile(METADATA_FIELDS + ["tally.num_ballots"])
+TALLY_PROFILE = read_profile(METADATA_FIELDS + ["tally"])
+# the saved outcome, without the tally and the Stable Voting checkpoint, which are only read to compute it again
+OUTCOME_PROFILE = read_profile(METADATA_FIELDS + ["result", "result_revision", "result_closed"])
+
+
+async def find_poll(id, profile=None):
+    """
+    Find a poll, migrating its embedded ballots and voters if it still has any.  Only the fields 
+    in the read profile are read, or all the fields when there is no profile.
+    """
+    document = await db.find_one({"_id": ObjectId(id)}, profile)
+    if document is not None and "ballots" in document:
+        await migrate_embedded_ballots(document)
+    if document is not None and "voter_ids" in document:
+        await migrate_embedded_voters(document)
+    return document
+
+
+async def find_ballots(id):
+    """Return the ballots submitted to a poll."""
+    return await ballots_db.find({"poll_id": ObjectId(id)}, {"_id": 0, "poll_id": 0}).to_list(None)
+
+
+async def has_ballots(id):
+    return await ballots_db.count_documents({"poll_id": ObjectId(id)}, limit=1) > 0
+
+
+def voter_document(poll_id, vid, email, emails_sent=1):
+    return {"poll_id": poll_id, "voter_id": vid, "email": email, "emails_sent": emails_sent}
+
+
+def duplicate_key_indices(e: BulkWriteError):
+    """The indices of the writes of a bulk write that failed with a duplicate key, the error is raised again if other writes failed."""
+    indices = [error["index"] for error in e.details["writeErrors"] if error["code"] == 11000]
+    if len(indices) < len(e.details["writeErrors"]):
+        raise e
+    return indices
+
+
+async def add_voters(poll_id, voter_emails):
+    """Register a voter with a new voter id for each email.  Returns the voter ids."""
+    voter_ids = generate_voter_ids(len(voter_emails))
+    # the unique index on the voter ids of a poll rejects the ids already used in the poll, the voters with these ids get new ones
+    pending = list(range(len(voter_ids)))
+    while len(pending) > 0:
+        try:
+            await voters_db.insert_many([voter_document(poll_id, voter_ids[i], voter_emails[i]) for i in pending], ordered=False)
+            pending = []
+        except BulkWriteError as e:
+            pending = [pending[idx] for idx in duplicate_key_indices(e)]
+            for i, vid in zip(pending, generate_voter_ids(len(pending), exclude=voter_ids)):
+                voter_ids[i] = vid
+    return voter_ids
+
+
+async def is_registered_voter(document, vid):
+    """Is vid the id of a voter in the private poll?"""
+    if vid is None:
+        return False
+    return await voters_db.count_documents({"poll_id": document["_id"], "voter_id": vid}, limit=1) > 0
+
+
+async def registered_voters(document, vids):
+    """The ids in vids of the voters in the private poll."""
+    vids = [vid for vid in set(vids) if vid is not None]
+    if len(vids) == 0:
+        return set()
+    return {v["voter_id"] async for v in voters_db.find({"poll_id": document["_id"], "voter_id": {"$in": vids}}, {"voter_id": 1})}
+
+
+def candidate_indices(document):
+    return {c: str(i) for i, c in enumerate(document["candidates"])}
+
+
+async def update_tally(document, delta):
+    """Apply the changes in delta to the tally of the poll and increment its revision."""
+    delta = nonzero(delta)
+    if len(delta) > 0:
+        # polls without a tally are tallied from scratch the next time the outcome is computed
+        result = await db.update_one({"_id": document["_id"], "tally": {"$type": "object"}}, {"$inc": {**delta, "revision": 1}})
+        if result.matched_count == 0: 
+            await db.update_one({"_id": document["_id"]}, {"$inc": {"revision": 1}})
+
+
+async def reset_tally(document):
+    """Remove the tally of the poll, so that it is computed again from the ballots, and increment its revision."""
+    await db.update_one({"_id": document["_id"]}, {"$unset": {"tally": ""}, "$inc": {"revision": 1}})
+
+
+async def recompute_tally(document):
+    """
+    Compute the tally of the poll again from its ballots, after ballots were deleted.  The votes submitted 
+    while the ballots were deleted are counted, since the tally is computed from the ballots that remain.
+    """
+    await reset_tally(document)
+    await find_tally({"_id": document["_id"], "candidates": document["candidates"]})
+
+
+async def count_ballots(document):
+    """
+    The number of voters that submitted a ballot.  It is read from the tally, or counted by 
+    the database for polls created before tallies were stored.
+    """
+    if document.get("tally", None) is not None:
+        return document["tally"]["num_ballots"]
+    counts = await ballots_db.aggregate([
+        {"$match": {"poll_id": document["_id"]}},
+        {"$group": {"_id": None, "num_ballots": {"$sum": {"$ifNull": ["$count", 1]}}}}]).to_list(None)
+    return counts[0]["num_ballots"] if len(counts) > 0 else 0
+
+
+async def find_tally(document):
+    """
+    Return the tally of the poll, computing it from the ballots for polls created before tallies were stored, 
+    or whose tally was reset.  The tally is only saved if no ballot changed while it was computed, since the 
+    votes do not update a poll without a tally, and otherwise it is computed again.
+    """
+    for _ in range(TALLY_BACKFILL_ATTEMPTS):
+        if document.get("tally", None) is not None:
+            return document["tally"]
+        current = await db.find_one({"_id": document["_id"]}, {"tally": 1, "revision": 1})
+        if current is None: # the poll was deleted
+            break
+        if current.get("tally", None) is not None:
+            document["tally"] = current["tally"]
+            continue
+        ballots = await find_ballots(document["_id"])
+        tally = tally_from_ballots(ballots, candidate_indices(document))
+        result = await db.update_one(
+            {"_id": document["_id"], "tally": None, "revision": current.get("revision", None)}, 
+            {"$set": {"tally": tally}})
+        if result.modified_count > 0:
+            document["tally"] = tally
+    if document.get("tally", None) is None:
+        # the ballots keep changing, the last tally computed is shown without saving it
+        logger.warning("tally not saved", extra={"poll_id": str(document["_id"])})
+        document["tally"] = tally_from_ballots(await find_ballots(document["_id"]), candidate_indices(document))
+    return document["tally"]
 
 
 async def create_poll(background_tasks: BackgroundTasks, poll_data: CreatePoll):
     """Create a poll."""
-    print("HERE!!!!! creating a poll...")
     now = arrow.now()
-    print(now.format('YYYY-MM-DD HH:mm'))
-    voter_ids = []
-    voter_email_map = {}
-    if poll_data.is_private: 
-        voter_ids = generate_voter_ids(len(poll_data.voter_emails))
-        voter_email_map = {vid: email for vid, email in zip(voter_ids, poll_data.voter_emails)}
-
     owner_id = generate_voter_ids(1)[0]
     poll = {
         "title": poll_data.title,
@@ -71,58 +418,48 @@ async def create_poll(background_tasks: BackgroundTasks, poll_data: CreatePoll):
         "hide_description": poll_data.hide_description,
         "candidates": poll_data.candidates,
         "is_private": poll_data.is_private,
-        "voter_ids": voter_ids,
-        "voter_email_map": voter_email_map,
         "owner_id": owner_id,
         "show_rankings": poll_data.show_rankings,
-        "closing_datetime": poll_data.closing_datetime,
+        "closing_datetime": utc_closing_datetime(poll_data.closing_datetime),
         "timezone": poll_data.timezone,
         "can_view_outcome_before_closing": poll_data.can_view_outcome_before_closing,
         "show_outcome": poll_data.show_outcome,
         "allow_multiple_votes": poll_data.allow_multiple_votes,
-        "ballots": [],
+        "tally": empty_tally(),
+        "revision": 0,
         "is_completed": False,
         "result": None,
         "creation_dt": now.format('MMMM DD, YYYY @ HH:mm')
     }
-    result = await db.insert_one(poll)
+    # the unique index on the owner ids rejects an owner id that is already used
+    while True:
+        try:
+            result = await db.insert_one(poll)
+            break
+        except DuplicateKeyError:
+            owner_id = poll["owner_id"] = generate_voter_ids(1)[0]
+
+    voter_ids = []
+    if poll_data.is_private: 
+        voter_ids = await add_voters(result.inserted_id, poll_data.voter_emails)
 
     if not SKIP_EMAILS:
-        # UPDATED: Admin notification using new send_email
-        background_tasks.add_task(
-            send_email,
-            to_email="stablevoting.org@gmail.com",
-            subject="New Poll Created",
-            html_body=f"""<p>Poll Created: https://stablevoting.org/results/{result.inserted_id}?oid={owner_id}</p>
-            <p>vote: https://stablevoting.org/vote/{result.inserted_id}?oid={owner_id}</p>            
-            <p>admin: https://stablevoting.org/admin/{result.inserted_id}?oid={owner_id}</p><p></p><p>{poll}</p>""",
-            tag="admin-poll-created"
-        )
-        
-        # Also send to Eric
-        background_tasks.add_task(
-            send_email,
-            to_email="epacuit@umd.edu",
-            subject="New Poll Created",
-            html_body=f"""<p>Poll Created: https://stablevoting.org/results/{result.inserted_id}?oid={owner_id}</p>
+        # Admin notification, also sent to Eric
+        admin_body = f"""<p>Poll Created: https://stablevoting.org/results/{result.inserted_id}?oid={owner_id}</p>
             <p>vote: https://stablevoting.org/vote/{result.inserted_id}?oid={owner_id}</p>            
-            <p>admin: https://stablevoting.org/admin/{result.inserted_id}?oid={owner_id}</p><p></p><p>{poll}</p>""",
-            tag="admin-poll-created"
-        )
-
-        # UPDATED: Send voter invitations using new send_email
-        for em, voter_id in zip(poll_data.voter_emails, voter_ids):
-            print("sending email to ", em)
-            link = f"https://stablevoting.org/vote/{result.inserted_id}?vid={voter_id}"
-            print(participate_email(poll_data.title, poll_data.description, link))
-            
-            background_tasks.add_task(
-                send_email,
-                to_email=em,
-                subject=f"Participate in the poll: {poll_data.title}",
-                html_body=participate_email(poll_data.title, poll_data.description, link),
-                tag="voter-invitation"
-            )
+            <p>admin: https://stablevoting.org/admin/{result.inserted_id}?oid={owner_id}</p><p></p><p>{poll}</p>"""
+        await queue_emails([
+            email_message(admin_email, "New Poll Created", admin_body, tag="admin-poll-created")
+            for admin_email in ["stablevoting.org@gmail.com", "epacuit@umd.edu"]])
+
+        # Voter invitations, which only differ by the link of the voter
+        await queue_templated_emails(
+            f"Participate in the poll: {escape_template(poll_data.title)}",
+            participate_email(escape_template(poll_data.title), escape_template(poll_data.description), "$link"),
+            poll_data.voter_emails,
+            [{"link": f"https://stablevoting.org/vote/{result.inserted_id}?vid={voter_id}"} for voter_id in voter_ids],
+            tag="voter-invitation",
+            poll_id=result.inserted_id)
 
     return {"id": str(result.inserted_id), "owner_id": owner_id}
 
@@ -130,8 +467,7 @@ async def create_poll(background_tasks: BackgroundTasks, poll_data: CreatePoll):
 async def update_poll(id, owner_id, poll_data: UpdatePoll, background_tasks: BackgroundTasks):
     """Update a poll. """
 
-    print("updating poll ", id)
-    document = await db.find_one({"_id": ObjectId(id)}) 
+    document = await find_poll(id, METADATA_PROFILE)
     poll_data = poll_data.dict() 
     if document is None: # poll not found
         return {"error": "Poll not found."}
@@ -142,69 +478,52 @@ async def update_poll(id, owner_id, poll_data: UpdatePoll, background_tasks: Bac
         get_data = lambda field : poll_data[field] if poll_data[field] is not None else  document[field]
 
         new_voter_ids = []
-        print("new_voter_emails", poll_data["new_voter_emails"])
-        print("document is_private", document.get("is_private"))
-        print("poll_data is_private", poll_data.get("is_private"))
 
-        existing_voter_email_map = document.get("voter_email_map", {})
-        updated_voter_email_map = existing_voter_email_map.copy()
-        
         # Use the actual poll's privacy status, not the potentially None value from poll_data
         poll_is_private = get_data("is_private")
-        print("poll_is_private (resolved):", poll_is_private)
         
         if poll_is_private and poll_data["new_voter_emails"] is not None and len(poll_data["new_voter_emails"]) > 0:
-            print("HERE!!!") 
-            new_voter_ids = generate_voter_ids(len(poll_data["new_voter_emails"]))                
-            print("new voter ids ", new_voter_ids)
-            new_voter_email_map = {vid: email for vid, email in zip(new_voter_ids, poll_data["new_voter_emails"])}
-
-            # Get existing map and merge:
-            existing_voter_email_map = document.get("voter_email_map", {})
-            updated_voter_email_map = {**existing_voter_email_map, **new_voter_email_map}
+            new_voter_ids = await add_voters(document["_id"], poll_data["new_voter_emails"])
+            logger.info("added voters", extra={"poll_id": id, "num_voters": len(new_voter_ids)})
 
         new_poll = {
             "title": get_data("title"),
             "description": get_data("description"),
             "hide_description": get_data("hide_description"),
             "is_private": get_data("is_private"),
-            "voter_ids": document["voter_ids"] + new_voter_ids,
-            "voter_email_map": updated_voter_email_map,
             "show_rankings": get_data("show_rankings"),
-            "closing_datetime": get_data("closing_datetime") if poll_data["closing_datetime"] != "del" else None,
+            "closing_datetime": utc_closing_datetime(get_data("closing_datetime")) if poll_data["closing_datetime"] != "del" else None,
             "timezone": get_data("timezone"),
             "can_view_outcome_before_closing": get_data("can_view_outcome_before_closing"),
             "show_outcome": get_data("show_outcome"),
             "allow_multiple_votes": get_data("allow_multiple_votes"),
-            "ballots": document["ballots"],
             "is_completed": get_data("is_completed"),
-            "result": document["result"],
             "creation_dt": document["creation_dt"],
             }
         resp = {"success": "Poll updated."}
-        if len(document["ballots"]) > 0: 
+        if await has_ballots(id): 
             new_poll["candidates"] = document["candidates"]
             if poll_data["candidates"] is not None:
                 resp["message"] = "Since voters have submitted ballots, candidate names cannot be changed.   The other changes have been made to the poll." 
         else: 
             new_poll["candidates"] =  get_data("candidates") 
         
-        result = await db.update_one({"_id": ObjectId(id)}, {"$set": new_poll})
+        # the saved outcome depends on the settings of the poll
+        result = await db.update_one({"_id": ObjectId(id)}, {"$set": new_poll, "$inc": {"revision": 1}})
+        if new_poll["candidates"] != document["candidates"]: 
+            # the tally is indexed by the candidates, so it is computed again with the ballots submitted since they were checked
+            await recompute_tally({"_id": document["_id"], "candidates": new_poll["candidates"]})
 
         if not SKIP_EMAILS: 
             if len(new_voter_ids) > 0: 
-                # UPDATED: Send emails to new voters using new send_email
-                for em, voter_id in zip(poll_data["new_voter_emails"], new_voter_ids):
-                    print("sending email to ", em)
-                    link = f"https://stablevoting.org/vote/{id}?vid={voter_id}"
-
-                    background_tasks.add_task(
-                        send_email,
-                        to_email=em,
-                        subject=f'Participate in the poll: {new_poll["title"]}',
-                        html_body=participate_email(new_poll["title"], new_poll["description"], link),
-                        tag="voter-invitation-update"
-                    )
+                # Send emails to new voters, which only differ by the link of the voter
+                await queue_templated_emails(
+                    f'Participate in the poll: {escape_template(new_poll["title"])}',
+                    participate_email(escape_template(new_poll["title"]), escape_template(new_poll["description"]), "$link"),
+                    poll_data["new_voter_emails"],
+                    [{"link": f"https://stablevoting.org/vote/{id}?vid={voter_id}"} for voter_id in new_voter_ids],
+                    tag="voter-invitation-update",
+                    poll_id=document["_id"])
 
     return resp
 
@@ -214,7 +533,7 @@ async def delete_poll(id, oid):
     if len(id) != 24: 
         return {"error": "Poll not found. Invalid poll id."}
 
-    document = await db.find_one({"_id": ObjectId(id)})
+    document = await db.find_one({"_id": ObjectId(id)}, AUTH_PROFILE)
 
     if document is None: 
         return {"error": "Poll not found."}
@@ -226,27 +545,24 @@ async def delete_poll(id, oid):
     if result.deleted_count == 0: 
         return {"error": "There was a problem.  The poll was not deleted."}
     else: 
+        await ballots_db.delete_many({"poll_id": ObjectId(id)})
+        await voters_db.delete_many({"poll_id": ObjectId(id)})
         return {"success": "Poll deleted."}
 
 
 async def poll_information(id, oid): 
-    print("id ", id)
-    print("oid ", oid)
 
     if not ObjectId.is_valid(id): 
         return {"error": "Poll not found."}
 
-    document = await db.find_one({"_id": ObjectId(id)})  
-    print(document) 
+    document = await find_poll(id, COUNT_PROFILE)
 
     if document is None: # poll not found
         return {"error": "Poll not found."}
     
     is_owner = document["owner_id"] == oid
     
-    is_closed = poll_closed( 
-        document.get("closing_datetime", None), 
-        document.get("timezone", None))
+    is_closed = poll_closed(document.get("closing_datetime", None))
 
     resp = {
         "is_owner": is_owner,
@@ -254,13 +570,13 @@ async def poll_information(id, oid):
         "title": document.get("title", "n/a"),
         "description": document.get("description", "n/a"),
         "hide_description": document.get("hide_description", False),
-        "num_ballots": len(document["ballots"]),
+        "num_ballots": await count_ballots(document),
         "candidates": document.get("candidates", []),
         "is_private": document.get("is_private", False),
-        "num_invited_voters": len(document.get("voter_ids", list())) if document.get("is_private", False) else None,
+        "num_invited_voters": await voters_db.count_documents({"poll_id": document["_id"]}) if document.get("is_private", False) else None,
         "show_rankings": document.get("show_rankings", True),
         "allow_multiple_votes": document.get("allow_multiple_votes", False),
-        "closing_datetime": document.get("closing_datetime", ""),
+        "closing_datetime": closing_datetime_string(document.get("closing_datetime", None)),
         "timezone": document.get("timezone", ""),
         "can_view_outcome_before_closing": document.get("can_view_outcome_before_closing", True),
         "show_outcome": document.get("show_outcome", True),
@@ -270,24 +586,18 @@ async def poll_information(id, oid):
         }
     
     if is_owner and document.get("is_private", False):
-        voter_email_map = document.get("voter_email_map", {})
-        voter_ids = document.get("voter_ids", [])
-        email_send_counts = document.get("email_send_counts", {})
-        
         voter_details = []
-        if voter_email_map:
-            for vid in voter_ids:
-                email = voter_email_map.get(vid, "Email not available")
+        async for voter in voters_db.find({"poll_id": document["_id"]}).sort("_id", 1):
+            if voter.get("email", None) is not None:
                 voter_details.append({
-                    "voter_id": vid,
-                    "email": email,
-                    "emailsSent": email_send_counts.get(email, 1)  # Default to 1 if not tracked
+                    "voter_id": voter["voter_id"],
+                    "email": voter["email"],
+                    "emailsSent": voter.get("emails_sent", 1)
                 })
-        else:
-            # Old polls
-            for vid in voter_ids:
+            else:
+                # Old polls
                 voter_details.append({
-                    "voter_id": vid,
+                    "voter_id": voter["voter_id"],
                     "email": "Email not available (legacy poll)",
                     "emailsSent": 0
                 })
@@ -301,7 +611,7 @@ async def delete_voter(poll_id: str, voter_id: str, owner_id: str):
     if not ObjectId.is_valid(poll_id):
         return {"error": "Invalid poll ID."}
     
-    document = await db.find_one({"_id": ObjectId(poll_id)})
+    document = await find_poll(poll_id, METADATA_PROFILE)
     
     if document is None:
         return {"error": "Poll not found."}
@@ -312,37 +622,16 @@ async def delete_voter(poll_id: str, voter_id: str, owner_id: str):
     if not document.get("is_private", False):
         return {"error": "Can only manage voters in private polls."}
     
-    # Get current voter lists
-    voter_ids = document.get("voter_ids", [])
-    voter_email_map = document.get("voter_email_map", {})
+    result = await voters_db.delete_one({"poll_id": document["_id"], "voter_id": voter_id})
     
-    if voter_id not in voter_ids:
+    if result.deleted_count == 0:
         return {"error": "Voter not found."}
-    
-    # Remove voter_id from the list
-    voter_ids.remove(voter_id)
-    
-    # Remove from email map if present
-    if voter_id in voter_email_map:
-        del voter_email_map[voter_id]
-    
-    # Remove any ballots from this voter
-    ballots = [b for b in document["ballots"] if b.get("voter_id") != voter_id]
-    
-    # Update the database
-    result = await db.update_one(
-        {"_id": ObjectId(poll_id)}, 
-        {"$set": {
-            "voter_ids": voter_ids,
-            "voter_email_map": voter_email_map,
-            "ballots": ballots
-        }}
-    )
-    
-    if result.modified_count > 0:
-        return {"success": "Voter deleted."}
     else:
-        return {"error": "Failed to delete voter."}    
+        # Remove the ballot from this voter
+        old_ballot = await ballots_db.find_one_and_delete({"poll_id": ObjectId(poll_id), "voter_id": voter_id})
+        if old_ballot is not None: 
+            await update_tally(document, tally_delta(old_ballot["ranking"], candidate_indices(document), weight=-1))
+        return {"success": "Voter deleted."}
 
 
 async def regenerate_voter_link(poll_id: str, voter_id: str, owner_id: str, background_tasks: BackgroundTasks):
@@ -350,7 +639,7 @@ async def regenerate_voter_link(poll_id: str, voter_id: str, owner_id: str, back
     if not ObjectId.is_valid(poll_id):
         return {"error": "Invalid poll ID."}
     
-    document = await db.find_one({"_id": ObjectId(poll_id)})
+    document = await find_poll(poll_id, METADATA_PROFILE)
     
     if document is None:
         return {"error": "Poll not found."}
@@ -361,49 +650,32 @@ async def regenerate_voter_link(poll_id: str, voter_id: str, owner_id: str, back
     if not document.get("is_private", False):
         return {"error": "Can only manage voters in private polls."}
     
-    voter_ids = document.get("voter_ids", [])
-    voter_email_map = document.get("voter_email_map", {})
+    # Replace the old ID with a new ID, the unique index rejects an ID used by another voter
+    while True:
+        new_voter_id = generate_voter_ids(1, exclude=[voter_id])[0]
+        try:
+            voter = await voters_db.find_one_and_update(
+                {"poll_id": document["_id"], "voter_id": voter_id}, 
+                {"$set": {"voter_id": new_voter_id}})
+            break
+        except DuplicateKeyError:
+            continue
     
-    if voter_id not in voter_ids:
+    if voter is None:
         return {"error": "Voter not found."}
-    
-    # Generate new voter ID
-    new_voter_id = generate_voter_ids(1)[0]
-    
-    # Get the email for this voter
-    email = voter_email_map.get(voter_id)
-    
-    # Replace old ID with new ID in voter_ids list
-    voter_ids[voter_ids.index(voter_id)] = new_voter_id
-    
-    # Update email map if email exists
-    if email and voter_id in voter_email_map:
-        del voter_email_map[voter_id]
-        voter_email_map[new_voter_id] = email
-    
-    # Update any existing ballot to use the new voter_id
-    ballots = document["ballots"]
-    for ballot in ballots:
-        if ballot.get("voter_id") == voter_id:
-            ballot["voter_id"] = new_voter_id
-    
-    # Update the database
-    result = await db.update_one(
-        {"_id": ObjectId(poll_id)}, 
-        {"$set": {
-            "voter_ids": voter_ids,
-            "voter_email_map": voter_email_map,
-            "ballots": ballots
-        }}
-    )
-    
-    if result.modified_count > 0:
+    else:
+        email = voter.get("email", None)
+
+        # Update any existing ballot to use the new voter_id
+        await ballots_db.update_many(
+            {"poll_id": ObjectId(poll_id), "voter_id": voter_id},
+            {"$set": {"voter_id": new_voter_id, "dedup_key": voter_dedup_key(new_voter_id)}})
+
         # Send email with new link
         if email and not SKIP_EMAILS:
             link = f"https://stablevoting.org/vote/{poll_id}?vid={new_voter_id}"
             
-            background_tasks.add_task(
-                send_email,
+            await queue_email(
                 to_email=email,
                 subject=f"New voting link for: {document['title']}",
                 html_body=f"""<p>A new voting link has been generated for you.</p>
@@ -411,7 +683,8 @@ async def regenerate_voter_link(poll_id: str, voter_id: str, owner_id: str, back
                 <p>Your new voting link: <a href="{link}">{link}</a></p>
                 <p>Your previous link has been deactivated.</p>
                 <p>You can use this link to vote or update your existing vote.</p>""",
-                tag="voter-link-regenerated"
+                tag="voter-link-regenerated",
+                poll_id=document["_id"]
             )
         
         return {
@@ -419,36 +692,163 @@ async def regenerate_voter_link(poll_id: str, voter_id: str, owner_id: str, back
             "new_voter_id": new_voter_id,
             "voteUrl": f"https://stablevoting.org/vote/{poll_id}?vid={new_voter_id}"
         }
-    else:
-        return {"error": "Failed to generate new link."}
-    
-async def delete_ballot(id, vid):
-    """Given a voter id, delete a ballot from the poll"""
-    document = await db.find_one({"_id": ObjectId(id)})  
-    if document is None: # poll not found
-        return {"error": "Poll not found."}
-    else: 
-        ballots = document["ballots"]
-        if document["is_private"] and (vid is not None and vid in document["voter_ids"]): 
-            for bidx, b in enumerate(ballots): 
-                if b["voter_id"] == vid: 
-                    # update
-                    ballots.pop(bidx)
-                    await db.update_one( {"_id": ObjectId(id)}, {"$set": {"ballots": ballots}})
-                    return {"success": "Ballot deleted."}
-        elif document["is_private"] and (vid is  None or vid not in document["voter_ids"]): 
-            return {"error": "Voter id not found, cannot delete the ballot."}
-        elif not document["is_private"]: 
-            return {"error": "Can only delete ballots in private polls."}
-        return {"error": "Ballot not found."}
 
 
+async def find_private_poll(poll_id, owner_id):
+    """The private poll with the owner_id, and None, or None and the error."""
+    if not ObjectId.is_valid(poll_id):
+        return None, {"error": "Invalid poll ID."}
+    document = await find_poll(poll_id, METADATA_PROFILE)
+    if document is None:
+        return None, {"error": "Poll not found."}
+    if document["owner_id"] != owner_id:
+        return None, {"error": "Not authorized."}
+    if not document.get("is_private", False):
+        return None, {"error": "Can only manage voters in private polls."}
+    return document, None
+
+
+async def replace_voter_ids(document, voter_ids, emails_sent=0):
+    """
+    Give new ids to the voters, and to their ballots, with a bulk write for each.  Returns a map from 
+    the old to the new ids.  The new ids differ from the replaced ones, and the unique index on the 
+    voter ids rejects the ids used by the other voters, whose voters get other ids.
+    """
+    new_voter_ids = dict(zip(voter_ids, generate_voter_ids(len(voter_ids), exclude=voter_ids)))
+    inc = {"$inc": {"emails_sent": emails_sent}} if emails_sent > 0 else {}
+    pending = list(new_voter_ids.keys())
+    while len(pending) > 0:
+        try:
+            await voters_db.bulk_write([
+                UpdateOne({"poll_id": document["_id"], "voter_id": old_vid}, {"$set": {"voter_id": new_voter_ids[old_vid]}, **inc}) 
+                for old_vid in pending], ordered=False)
+            pending = []
+        except BulkWriteError as e:
+            pending = [pending[idx] for idx in duplicate_key_indices(e)]
+            used = [*new_voter_ids.keys(), *new_voter_ids.values()]
+            for old_vid, new_vid in zip(pending, generate_voter_ids(len(pending), exclude=used)):
+                new_voter_ids[old_vid] = new_vid
+
+    # only the ballots of the voters that voted are updated
+    voted = await ballots_db.distinct("voter_id", {"poll_id": document["_id"], "voter_id": {"$in": list(new_voter_ids.keys())}})
+    if len(voted) > 0:
+        await ballots_db.bulk_write([
+            UpdateMany({"poll_id": document["_id"], "voter_id": old_vid}, {"$set": {"voter_id": new_voter_ids[old_vid], "dedup_key": voter_dedup_key(new_voter_ids[old_vid])}}) 
+            for old_vid in voted], ordered=False)
+    return new_voter_ids
+
+
+def bulk_result(results, message):
+    num_succeeded = sum("success" in r for r in results)
+    return {"success": message.format(num_succeeded), "num_succeeded": num_succeeded, "results": results}
+
+
+async def delete_voters(poll_id: str, voter_ids: list, owner_id: str):
+    """Delete voters, and their ballots, from a private poll.  Returns the result for each voter id."""
+    document, error = await find_private_poll(poll_id, owner_id)
+    if error is not None:
+        return error
+
+    voter_ids = list(dict.fromkeys(voter_ids))
+    found = list(await registered_voters(document, voter_ids))
+    if len(found) > 0:
+        await voters_db.delete_many({"poll_id": document["_id"], "voter_id": {"$in": found}})
+        # Remove the ballots from these voters
+        old_ballots = await ballots_db.find({"poll_id": document["_id"], "voter_id": {"$in": found}}, {"ranking": 1}).to_list(None)
+        if len(old_ballots) > 0:
+            result = await ballots_db.delete_many({"_id": {"$in": [b["_id"] for b in old_ballots]}})
+            if result.deleted_count == len(old_ballots):
+                delta = dict()
+                for b in old_ballots:
+                    tally_delta(b["ranking"], candidate_indices(document), weight=-1, delta=delta)
+                await update_tally(document, delta)
+            else:
+                # some of the ballots were deleted by another request, so the tally is computed again from the ballots
+                await reset_tally(document)
+
+    found = set(found)
+    return bulk_result(
+        [{"voter_id": vid, "success": "Voter deleted."} if vid in found else {"voter_id": vid, "error": "Voter not found."} 
+         for vid in voter_ids],
+        "Deleted {} voter(s).")
+
+
+async def regenerate_voter_links(poll_id: str, voter_ids: list, owner_id: str):
+    """Generate new voter IDs for existing voters and email the new links in one batch.  Returns the result for each voter id."""
+    document, error = await find_private_poll(poll_id, owner_id)
+    if error is not None:
+        return error
+
+    voter_ids = list(dict.fromkeys(voter_ids))
+    voters = {v["voter_id"]: v async for v in voters_db.find(
+        {"poll_id": document["_id"], "voter_id": {"$in": voter_ids}}, {"voter_id": 1, "email": 1})}
+    new_voter_ids = await replace_voter_ids(document, list(voters.keys()))
+
+    # Send emails with the new links, which only differ by the link of the voter
+    recipients = [(voters[vid]["email"], new_vid) for vid, new_vid in new_voter_ids.items() if voters[vid].get("email", None)]
+    if len(recipients) > 0 and not SKIP_EMAILS:
+        await queue_templated_emails(
+            f"New voting link for: {escape_template(document['title'])}",
+            f"""<p>A new voting link has been generated for you.</p>
+                <p>Poll: {escape_template(document['title'])}</p>
+                <p>Your new voting link: <a href="$link">$link</a></p>
+                <p>Your previous link has been deactivated.</p>
+                <p>You can use this link to vote or update your existing vote.</p>""",
+            [email for email, _ in recipients],
+            [{"link": f"https://stablevoting.org/vote/{poll_id}?vid={new_vid}"} for _, new_vid in recipients],
+            tag="voter-link-regenerated",
+            poll_id=document["_id"])
+
+    return bulk_result(
+        [{
+            "voter_id": vid, 
+            "success": "New voter link generated.", 
+            "new_voter_id": new_voter_ids[vid], 
+            "voteUrl": f"https://stablevoting.org/vote/{poll_id}?vid={new_voter_ids[vid]}"
+        } if vid in new_voter_ids else {"voter_id": vid, "error": "Voter not found."} 
+         for vid in voter_ids],
+        "Generated {} new voter link(s).")
+
+
+async def resend_voter_emails(poll_id: str, voter_emails: list, owner_id: str):
+    """Resend invitation emails with new voting links to voters in one batch.  Returns the result for each email."""
+    document, error = await find_private_poll(poll_id, owner_id)
+    if error is not None:
+        return error
+
+    voter_emails = list(dict.fromkeys(voter_emails))
+    voters = dict()
+    async for v in voters_db.find({"poll_id": document["_id"], "email": {"$in": voter_emails}}, {"voter_id": 1, "email": 1, "emails_sent": 1}):
+        voters.setdefault(v["email"], v)
+    new_voter_ids = await replace_voter_ids(document, [v["voter_id"] for v in voters.values()], emails_sent=1)
+
+    # Send the reminders, which only differ by the link of the voter
+    if len(voters) > 0 and not SKIP_EMAILS:
+        await queue_templated_emails(
+            f"Reminder: Participate in the poll - {escape_template(document['title'])}",
+            f"""<p>This is a reminder to participate in the poll.</p>
+                <p>Poll: {escape_template(document['title'])}</p>
+                <p>Description: {escape_template(document.get('description', '') or '')}</p>
+                <p>Your voting link: <a href="$link">$link</a></p>
+                <p>Note: This new link replaces any previous links sent to you.</p>""",
+            list(voters.keys()),
+            [{"link": f"https://stablevoting.org/vote/{poll_id}?vid={new_voter_ids[v['voter_id']]}"} for v in voters.values()],
+            tag="voter-invitation-resend",
+            poll_id=document["_id"])
+
+    return bulk_result(
+        [{"email": email, "success": f"Email resent to {email}. Total emails sent: {voters[email].get('emails_sent', 1) + 1}"} 
+         if email in voters else {"email": email, "error": "Voter email not found."} 
+         for email in voter_emails],
+        "Resent {} email(s).")
+
+    
 async def delete_all_ballots(id, owner_id):
     """Delete all ballots from a poll."""
     if not ObjectId.is_valid(id):
         return {"error": "Invalid poll ID."}
     
-    document = await db.find_one({"_id": ObjectId(id)})
+    document = await find_poll(id, METADATA_PROFILE)
     
     if document is None:
         return {"error": "Poll not found."}
@@ -460,130 +860,319 @@ async def delete_all_ballots(id, owner_id):
     if document.get("is_completed", False):
         return {"error": "Cannot delete ballots from a completed poll."}
     
-    if poll_closed(document.get("closing_datetime", None), document.get("timezone", None)):
+    if poll_closed(document.get("closing_datetime", None)):
         return {"error": "Cannot delete ballots from a closed poll."}
     
     # Get the number of ballots to be deleted for the response
-    num_ballots = len(document.get("ballots", []))
+    num_ballots = await ballots_db.count_documents({"poll_id": ObjectId(id)})
     
     if num_ballots == 0:
         return {"error": "No ballots to delete."}
     
     # Delete all ballots
-    result = await db.update_one(
-        {"_id": ObjectId(id)},
-        {"$set": {"ballots": []}}
-    )
+    result = await ballots_db.delete_many({"poll_id": ObjectId(id)})
+    await recompute_tally(document)
     
-    if result.modified_count > 0:
-        return {"success": f"Successfully deleted {num_ballots} ballot(s)."}
+    if result.deleted_count > 0:
+        return {"success": f"Successfully deleted {result.deleted_count} ballot(s)."}
     else:
         return {"error": "Failed to delete ballots."}
 
 async def submit_ballot(ballot, id, vid, allow_multiple_vote_pwd):
-    """Submit a ballot to the poll."""
-
+    """Submit a ballot to the poll.  The ballot is written together with the ballots submitted to the poll at the same time."""
+    if not ObjectId.is_valid(id): 
+        return {"error": "Poll not found."}
     allow_multiple_vote_from_url = allow_multiple_vote_pwd == os.getenv('ALLOW_MULTIPLE_VOTE_PWD')
-    print("allow_multiple_vote_from_url: ", allow_multiple_vote_from_url)
+    return await vote_group_commit.submit(id, (ballot, vid, allow_multiple_vote_from_url), submit_ballots)
+
+
+async def submit_private_ballot(document, ballot, vid, delta):
+    """Submit the ballot of a registered voter, replacing the voter's previous ballot, and add the change to the tally to delta."""
+    b = ballot.dict()
+    b["voter_id"] = vid
+    b["ip"] = hash_ip(ballot.ip)
+    b["dedup_key"] = voter_dedup_key(vid)
+    # replace the voter's previous ballot, if there is one
+    try:
+        old_ballot = await ballots_db.find_one_and_update(
+            {"poll_id": document["_id"], "voter_id": vid}, 
+            {"$set": b}, 
+            projection={"ranking": 1},
+            upsert=True)
+    except DuplicateKeyError: 
+        # a concurrent submission from the same voter inserted the ballot first
+        old_ballot = await ballots_db.find_one_and_update(
+            {"poll_id": document["_id"], "voter_id": vid}, 
+            {"$set": b}, 
+            projection={"ranking": 1})
+    tally_delta(b["ranking"], candidate_indices(document), delta=delta)
+    if old_ballot is not None: 
+        tally_delta(old_ballot["ranking"], candidate_indices(document), weight=-1, delta=delta)
+    return {"success": "Ballot submitted."}
+
+
+def public_ballot_write(document, ballot, vid, allow_multiple_vote_from_url):
+    """
+    The write of a ballot to a public poll.  A ballot from an ip that already submitted one is 
+    not written when the poll does not allow multiple votes.
+    """
+    allow_mutliple_votes = document.get("allow_multiple_votes", False) or allow_multiple_vote_from_url
+    b = ballot.dict()
+    if vid is not None: 
+        b["voter_id"] = vid
+    b["poll_id"] = document["_id"]
+    b["ip"] = hash_ip(ballot.ip)
+    if not allow_mutliple_votes and has_ip(ballot.ip):
+        # only insert the ballot if there is no ballot from this ip, including the ballots submitted 
+        # when multiple votes were allowed, the unique index on the dedup_key makes this hold for 
+        # concurrent submissions too
+        b["dedup_key"] = ip_dedup_key(b["ip"])
+        return UpdateOne(
+            {"poll_id": document["_id"], "ip": {"$in": stored_ips(ballot.ip)}}, 
+            {"$setOnInsert": b}, 
+            upsert=True)
+    return InsertOne(b)
+
+
+async def submit_public_ballots(document, submissions, delta):
+    """Submit ballots to a public poll with one bulk write, and add the change to the tally to delta."""
+    results = [None] * len(submissions)
+    writes = list() # (index of the submission, write, ranking)
+    for idx, (ballot, vid, allow_multiple_vote_from_url) in enumerate(submissions):
+        try:
+            writes.append((idx, public_ballot_write(document, ballot, vid, allow_multiple_vote_from_url), ballot.ranking))
+        except Exception:
+            logger.exception("ballot not saved", extra={"poll_id": str(document["_id"])})
+            results[idx] = {"error": "The ballot could not be saved."}
+    if len(writes) == 0:
+        return results
+
+    try:
+        result = (await ballots_db.bulk_write([write for _, write, _ in writes], ordered=False)).bulk_api_result
+    except BulkWriteError as e: 
+        result = e.details
+    write_errors = {error["index"]: error for error in result.get("writeErrors", [])}
+    upserted = {u["index"] for u in result.get("upserted", [])}
+
+    for widx, (idx, write, ranking) in enumerate(writes):
+        if widx in write_errors and write_errors[widx]["code"] != 11000: 
+            results[idx] = {"error": "The ballot could not be saved."}
+        elif widx in write_errors or (isinstance(write, UpdateOne) and widx not in upserted): 
+            results[idx] = {"error": "Already submitted a ballot."}
+        else: 
+            tally_delta(ranking, candidate_indices(document), delta=delta)
+            results[idx] = {"success": "Ballot submitted."}
+    return results
+
+
+async def submit_ballots(id, submissions):
+    """
+    Submit a group of ballots to the poll, each given as (ballot, vid, allow_multiple_vote_from_url).  
+    The poll is read once and its tally is updated once for the whole group.  Returns the result of 
+    each submission, a submission that fails does not fail the others.
+    """
     read_concern.ReadConcern('linearizable')
-    document = await db.find_one({"_id": ObjectId(id)}) 
+    document = await find_poll(id, METADATA_PROFILE)
     if document is None: # poll not found
-        return {"error": "Poll not found."}
-    else: 
-        allow_mutliple_votes = document.get("allow_multiple_votes", False) or allow_multiple_vote_from_url
-        ballots = document["ballots"]
-        if document["is_private"] and (vid is not None and vid in document["voter_ids"]): 
-            for bidx, b in enumerate(ballots): 
-                if b["voter_id"] == vid: 
-                    b = ballot.dict()
-                    b["voter_id"] = vid
-                    # update
-                    ballots[bidx] = b
-                    await db.update_one( {"_id": ObjectId(id)}, {"$set": {"ballots": ballots}})
-                    return {"success": "Ballot submitted."}
-        elif document["is_private"] and (vid is  None or vid not in document["voter_ids"]): 
-            return {"error": "The poll is private."}
-        elif not document["is_private"]: 
-            if not allow_mutliple_votes and ballot.ip != "n/a":
-                for b in ballots: 
-                    if b["ip"] == ballot.ip:
-                        return {"error": "Already submitted a ballot."}
-        b = ballot.dict()
-        if vid is not None: 
-            b["voter_id"] = vid
-        ballots.append(b)
-        await db.update_one( {"_id": ObjectId(id)}, {"$set": {"ballots": ballots}})
-        return {"success": "Ballot submitted."}
+        return [{"error": "Poll not found."}] * len(submissions)
+
+    delta = dict()
+    try:
+        if document["is_private"]: 
+            registered = await registered_voters(document, [vid for _, vid, _ in submissions])
+
+            async def submit(ballot, vid): 
+                if vid not in registered: 
+                    return {"error": "The poll is private."}
+                try:
+                    return await submit_private_ballot(document, ballot, vid, delta)
+                except Exception:
+                    logger.exception("ballot not saved", extra={"poll_id": id})
+                    return {"error": "The ballot could not be saved."}
+
+            results = await asyncio.gather(*[submit(ballot, vid) for ballot, vid, _ in submissions])
+        else: 
+            try:
+                results = await submit_public_ballots(document, submissions, delta)
+            except Exception:
+                # it is not known which ballots were written, so the tally is computed again from the ballots
+                logger.exception("ballots not saved", extra={"poll_id": id, "group_size": len(submissions)})
+                await reset_tally(document)
+                results = [{"error": "The ballot could not be saved."}] * len(submissions)
+    finally:
+        # the changes of the ballots that were written are applied, even if others failed
+        await update_tally(document, delta)
+    return results
 
 
 async def delete_ballot(id, vid):
     """Given a voter id, delete a ballot from the poll"""
-    document = await db.find_one({"_id": ObjectId(id)})  
+    document = await find_poll(id, METADATA_PROFILE)
     if document is None: # poll not found
         return {"error": "Poll not found."}
     else: 
-        ballots = document["ballots"]
-        if document["is_private"] and (vid is not None and vid in document["voter_ids"]): 
-            for bidx, b in enumerate(ballots): 
-                if b["voter_id"] == vid: 
-                    # update
-                    ballots.pop(bidx)
-                    await db.update_one( {"_id": ObjectId(id)}, {"$set": {"ballots": ballots}})
-                    return {"success": "Ballot deleted."}
-        elif document["is_private"] and (vid is  None or vid not in document["voter_ids"]): 
+        is_registered = document["is_private"] and await is_registered_voter(document, vid)
+        if document["is_private"] and is_registered: 
+            old_ballot = await ballots_db.find_one_and_delete({"poll_id": document["_id"], "voter_id": vid})
+            if old_ballot is not None: 
+                await update_tally(document, tally_delta(old_ballot["ranking"], candidate_indices(document), weight=-1))
+                return {"success": "Ballot deleted."}
+        elif document["is_private"] and not is_registered: 
             return {"error": "Voter id not found, cannot delete the ballot."}
         elif not document["is_private"]: 
             return {"error": "Can only delete ballots in private polls."}
         return {"error": "Ballot not found."}
 
 
+class InvalidRow(Exception): 
+    pass
+
+
+def csv_rows(csv_file): 
+    """Read the rows of an uploaded csv file one at a time."""
+    csv_file.file.seek(0)
+    text = io.TextIOWrapper(csv_file.file, encoding="utf-8-sig", newline="")
+    try: 
+        yield from csv.reader(text, delimiter=',')
+    finally: 
+        text.detach() # the upload is closed by fastapi
+
+
+def parse_ranking_row(row, cands): 
+    """
+    Return the ranking and the number of voters that submitted it for a row of a csv file, 
+    or None for an empty row.  The number of voters is in the column after the candidates. 
+    """
+    if len([v for v in row if v.strip() != '']) == 0: 
+        return None
+    num_cands = len(cands)
+    try: 
+        ranking = {c: int(r) for c, r in zip(cands, row[0:num_cands]) if r.strip() != ''}
+    except ValueError: 
+        raise InvalidRow("The ranks must be whole numbers.")
+    count = row[num_cands].strip() if len(row) > num_cands else ''
+    return ranking, int(count) if count.isdigit() else 1
+
+
 async def add_rankings(id, owner_id, csv_file, overwrite): 
-    """add rankings to a poll from a csv file."""
-    document = await db.find_one({"_id": ObjectId(id)})  
+    """
+    Add rankings to a poll from a csv file.  
+
+    The file is read twice, first to check every row and then to add the ballots in batches of 
+    BULK_BATCH_SIZE rows.  The rows of a batch with the same ranking are stored as a single ballot 
+    with the number of voters that submitted the ranking, and the progress of the import is saved 
+    on the poll.
+    """
+    document = await find_poll(id, METADATA_PROFILE)
     if document is None: # poll not found
         return {"error": "Poll not found."}
+    if owner_id != document["owner_id"]:
+        return {"error": "Only the poll creater can add rankings to a poll."}
+
+    candidates = document["candidates"]
+    num_cands = len(candidates)
+    rows = csv_rows(csv_file)
+    cands = [c.strip() for c in next(rows, [])]
+    if not sorted(candidates) == sorted(cands[0:num_cands]):
+        return {"error": "The candidates in the file do not match the candidates in the poll."}
+    cands = cands[0:num_cands]
+
+    num_rows = 0
+    for rowidx, row in enumerate(rows):
+        try: 
+            parse_ranking_row(row, cands)
+        except InvalidRow as e: 
+            return {"error": f"Row {rowidx + 2}: {e}"}
+        num_rows += 1
+        if num_rows % BULK_BATCH_SIZE == 0: 
+            await asyncio.sleep(0) # let other requests run while a large file is checked
+
+    progress = {"status": "running", "filename": csv_file.filename, "overwrite": overwrite, 
+                "num_rows": num_rows, "imported_rows": 0, "imported_ballots": 0}
+    await db.update_one({"_id": document["_id"]}, {"$set": {"bulk_import": progress}})
+
+    try: 
+        if overwrite: 
+            await ballots_db.delete_many({"poll_id": document["_id"]})
+            await recompute_tally(document)
+
+        async def write_batch(batch, delta, num_rows): 
+            await ballots_db.insert_many(list(batch.values()))
+            await update_tally(document, delta)
+            progress["imported_rows"] += num_rows
+            progress["imported_ballots"] += sum(b["count"] for b in batch.values())
+            await db.update_one({"_id": document["_id"]}, {"$set": {"bulk_import": progress}})
+
+        rows = csv_rows(csv_file)
+        next(rows)
+        # the rows of a batch with the same ranking are stored as a single ballot 
+        batch, delta, num_batch_rows = dict(), dict(), 0
+        for rowidx, row in enumerate(rows):
+            parsed = parse_ranking_row(row, cands)
+            if parsed is None or parsed[1] == 0: 
+                continue
+            ranking, count = parsed
+            key = ranking_key(ranking, candidate_indices(document))
+            if key not in batch: 
+                batch[key] = {
+                    "ranking": ranking,
+                    "count": 0,
+                    "voter_id": f"bulk{rowidx}",
+                    "submission_date": None,
+                    "ip": csv_file.filename,
+                    "poll_id": document["_id"],
+                }
+            batch[key]["count"] += count
+            tally_delta(ranking, candidate_indices(document), weight=count, delta=delta)
+            num_batch_rows += 1
+            if num_batch_rows == BULK_BATCH_SIZE: 
+                await write_batch(batch, delta, num_batch_rows)
+                batch, delta, num_batch_rows = dict(), dict(), 0
+        if num_batch_rows > 0: 
+            await write_batch(batch, delta, num_batch_rows)
+    except Exception as e: 
+        # the import stops at the batch that could not be written, the progress keeps the rows 
+        # of the batches written before it
+        logger.exception("rankings not imported", extra={"poll_id": id, "imported_rows": progress["imported_rows"]})
+        progress["status"] = "failed"
+        progress["error"] = str(e)
+        await db.update_one({"_id": document["_id"]}, {"$set": {"bulk_import": progress}})
+        return {"error": f"The import failed after {progress['imported_rows']} of {num_rows} rows were added."}
+
+    progress["status"] = "completed"
+    await db.update_one({"_id": document["_id"]}, {"$set": {"bulk_import": progress}})
+
+    if overwrite: 
+        success_message = f"Replaced all the ballots with {progress['imported_ballots']} ballots in the poll: {document['title']}."
     else: 
-        if owner_id != document["owner_id"]:
-            return {"error": "Only the poll creater can add rankings to a poll."}
-        else: 
-            file_location = f"./tmpcsvfiles/{str(uuid.uuid4())}-{csv_file.filename}"
-            print(file_location)
-            new_ballots = list()
-            candidates = document["candidates"]
-            with open(file_location, "wb+") as file_object:
-                print("Writing file....")
-                file_object.write(csv_file.file.read())
-            with open(file_location) as csvfile:
-                ranking_reader = csv.reader(csvfile, delimiter=',')
-                _cands = next(ranking_reader)
-                cands = [c.strip() for c in _cands]
-                num_cands = len(candidates)
-                if not sorted(candidates) == sorted(cands[0:num_cands]):
-                    print({"error": "The candidates in the file do not match the candidates in the poll."})
-                        
-                new_ballots=list()
-                for rowidx, row in enumerate(ranking_reader):
-                    if len([v for v in row if v.strip() != '']) == 0: 
-                        continue
-                    num_ballot = int(row[num_cands]) if len(row) > num_cands and row[num_cands] != '' and row[num_cands].isdigit() else 1
-                    for nb in range(num_ballot): 
-                        new_ballots += [{
-                            "ranking": {c:int(r) for c,r in zip(cands, row[0:num_cands]) if r != ''},
-                            "voter_id": f"bulk{rowidx}_{nb+1}",
-                            "submission_date": None,
-                            "ip": csv_file.filename
-                        }] 
-
-                print(new_ballots)
-                curr_ballots = document["ballots"]
-                if overwrite: 
-                    await db.update_one( {"_id": ObjectId(id)}, {"$set": {"ballots": new_ballots}})
-                    success_message = f"Replaced all the ballots with {len(new_ballots)} ballots in the poll: {document['title']}."
-                else: 
-                    await db.update_one( {"_id": ObjectId(id)}, {"$set": {"ballots": curr_ballots + new_ballots}})
-                    success_message = f"Added {len(new_ballots)} ballots to the poll: {document['title']}."
-                os.remove(file_location)
-                return {"success": success_message}
+        success_message = f"Added {progress['imported_ballots']} ballots to the poll: {document['title']}."
+    return {"success": success_message}
+
+
+async def bulk_import_progress(id, owner_id): 
+    """The progress of the last import of rankings from a csv file."""
+    if not ObjectId.is_valid(id): 
+        return {"error": "Poll not found."}
+    document = await db.find_one({"_id": ObjectId(id)}, {"owner_id": 1, "bulk_import": 1})
+    if document is None: 
+        return {"error": "Poll not found."}
+    if owner_id != document["owner_id"]:
+        return {"error": "Only the poll creater can view the progress of an import."}
+    if "bulk_import" not in document: 
+        return {"error": "No rankings have been imported."}
+    return document["bulk_import"]
+
+
+async def invitation_progress(id, owner_id): 
+    """The number of emails queued for the poll that are pending, being sent, sent and dead lettered."""
+    if not ObjectId.is_valid(id): 
+        return {"error": "Poll not found."}
+    document = await find_poll(id, AUTH_PROFILE)
+    if document is None: 
+        return {"error": "Poll not found."}
+    if owner_id != document["owner_id"]:
+        return {"error": "Only the poll creater can view the progress of the invitations."}
+    return await poll_email_progress(document["_id"])
 
 
 ###
@@ -592,46 +1181,62 @@ async def add_rankings(id, owner_id, csv_file, overwrite):
 #
 ###
 
-def poll_closed(dt, tz): 
-    if dt is not None:
-        closing_dt = arrow.get(dt).to(tz)
-    else:
-        closing_dt = None
-    return closing_dt < arrow.utcnow().to(tz) if closing_dt is not None else False
+def utc_closing_datetime(dt):
+    """The closing datetime as it is stored: a UTC datetime, which is saved as a BSON date."""
+    return arrow.get(dt).to("UTC").naive if dt is not None else None
+
+
+@functools.lru_cache(maxsize=1024)
+def timestamp_from_string(dt):
+    return arrow.get(dt).timestamp()
+
+
+def closing_timestamp(dt):
+    """
+    The closing datetime as a POSIX timestamp.  The closing datetimes of the polls created before 
+    they were stored as dates are strings, which are only parsed once.
+    """
+    if isinstance(dt, str):
+        return timestamp_from_string(dt)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt.timestamp()
+
+
+def poll_closed(dt): 
+    return dt is not None and closing_timestamp(dt) < time.time()
 
 
 def dt_string(dt, tz):
-    if dt is not None:
-        closing_dt = arrow.get(dt).to(tz)
-    else:
-        closing_dt = None
-    return closing_dt.format('MMMM D YYYY @ HH:mm A (ZZZ)') if closing_dt is not None else "N/A"
+    return arrow.get(closing_timestamp(dt)).to(tz or "UTC").format('MMMM D YYYY @ HH:mm A (ZZZ)') if dt is not None else "N/A"
+
+
+def closing_datetime_string(dt):
+    """The closing datetime in ISO 8601, as it is returned to the client."""
+    return arrow.get(closing_timestamp(dt)).isoformat() if dt is not None else None
 
     
-def can_view_outcome(dt, tz, is_completed, can_view_outcome_before_closing, show_outcome, is_owner, is_voter):
+def can_view_outcome(dt, is_completed, can_view_outcome_before_closing, show_outcome, is_owner, is_voter):
     '''
     An outcome can be viewed when either
     1. the person is an owner, or
     2. the person is a voter and the owner enabled show outcome and either the poll is closed or completed or the viewing the outcome before the poll closes is enabled. 
     '''
-    if dt is not None:
-        closing_dt = arrow.get(dt).to(tz)
-    else:
-        closing_dt = None
-    is_closed =  closing_dt < arrow.utcnow().to(tz) if closing_dt is not None else False
+    is_closed = poll_closed(dt)
 
-    return is_owner or (is_voter and show_outcome and (closing_dt is None or is_closed or is_completed or (not is_closed and can_view_outcome_before_closing)))
+    return is_owner or (is_voter and show_outcome and (dt is None or is_closed or is_completed or (not is_closed and can_view_outcome_before_closing)))
 
         
-def can_vote(vid, is_completed, is_private, voter_ids, dt, tz):
-    return not is_completed and not poll_closed(dt, tz) and (not is_private or (vid in voter_ids))
+def can_vote(is_registered, is_completed, is_private, dt):
+    return not is_completed and not poll_closed(dt) and (not is_private or is_registered)
 
     
-def voter_type(poll_data, vid, oid = None): 
+def voter_type(poll_data, is_registered, oid = None): 
+    '''is_registered is True when the voter id is the id of a voter in the poll.'''
 
     is_owner = oid == poll_data.get("owner_id", False)
 
-    is_voter = not poll_data.get("is_private", False) or (poll_data.get("is_private", False) and vid in poll_data.get("voter_ids", []))
+    is_voter = not poll_data.get("is_private", False) or (poll_data.get("is_private", False) and is_registered)
 
     return is_voter, is_owner
 
@@ -646,7 +1251,6 @@ def open_poll(id, document, result):
 
 async def poll_ranking_information(id, vid, allowmultiplevote): 
     read_concern.ReadConcern('linearizable')
-    print("id ", id)
 
     allow_multiple_vote = allowmultiplevote == os.getenv('ALLOW_MULTIPLE_VOTE_PWD')
 
@@ -665,8 +1269,7 @@ async def poll_ranking_information(id, vid, allowmultiplevote):
             }
 
 
-    document = await db.find_one({"_id": ObjectId(id)})  
-    print(document) 
+    document = await find_poll(id, METADATA_PROFILE)
 
     allow_multiple_vote = document["allow_multiple_votes"] or allowmultiplevote == os.getenv('ALLOW_MULTIPLE_VOTE_PWD')
 
@@ -686,11 +1289,10 @@ async def poll_ranking_information(id, vid, allowmultiplevote):
             }
 
     # vid could either be a voter id or the owner id
-    is_voter, is_owner = voter_type(document, vid, vid)
+    is_registered = document.get("is_private", False) and await is_registered_voter(document, vid)
+    is_voter, is_owner = voter_type(document, is_registered, vid)
     
-    is_closed = poll_closed( 
-                document.get("closing_datetime", None), 
-                document.get("timezone", None))
+    is_closed = poll_closed(document.get("closing_datetime", None))
     
     is_completed = document.get("is_completed", False) or is_closed
     is_private = document.get("is_private", False)
@@ -698,23 +1300,18 @@ async def poll_ranking_information(id, vid, allowmultiplevote):
     closing_dt = document.get("closing_datetime", None)
     tz = document.get("timezone", None)
     if closing_dt is not None:
-        dt = arrow.get(closing_dt).to(tz)
-        now = arrow.utcnow().to(tz)
-        time_remaining_str = f'The poll closes in {humanize.precisedelta(dt - now, suppress=["seconds"], minimum_unit="minutes")}'
+        time_remaining = datetime.timedelta(seconds=closing_timestamp(closing_dt) - time.time())
+        time_remaining_str = f'The poll closes in {humanize.precisedelta(time_remaining, suppress=["seconds"], minimum_unit="minutes")}'
     else:
         time_remaining_str = None
-    print(time_remaining_str)
     v_can_vote = can_vote(
-                vid,
+                is_registered,
                 is_completed,
                 is_private,
-                document.get("voter_ids",[]),
-                closing_dt, 
-                tz)
+                closing_dt)
     
     v_can_view_outcome = can_view_outcome(
                 closing_dt, 
-                tz, 
                 is_completed,
                 document.get("can_view_outcome_before_closing", False), 
                 document.get("show_outcome", False),
@@ -729,7 +1326,7 @@ async def poll_ranking_information(id, vid, allowmultiplevote):
         "allow_multiple_vote": allow_multiple_vote,
         "is_private": document["is_private"],
         "ranking": {},
-        "closing_datetime_str": dt_string(document.get("closing_datetime", None), document.get("timezone", None)),
+        "closing_datetime_str": dt_string(closing_dt, tz),
         "timezone": document.get("timezone", "n/a"),
         "time_remaining_str": time_remaining_str,
         "is_closed": is_closed,
@@ -737,39 +1334,34 @@ async def poll_ranking_information(id, vid, allowmultiplevote):
         "can_vote": v_can_vote,
         "can_view_outcome": v_can_view_outcome
         }
-    print("poll_ranking_information: resp", resp)
-    if document["is_private"] and (vid is not None and vid in document["voter_ids"]): 
-        for b in document["ballots"]: 
-            if b["voter_id"] == vid: 
-                resp["ranking"] = b["ranking"]
+    if document["is_private"] and is_registered: 
+        b = await ballots_db.find_one({"poll_id": document["_id"], "voter_id": vid}, {"ranking": 1})
+        if b is not None: 
+            resp["ranking"] = b["ranking"]
     return resp
 
 
 async def submitted_ranking_information(id, owner_id):
 
-    print("Ranking information for ", id)
-    print("Owner id ", owner_id)
     if len(id) != 24: 
-        print("Invalid id.")
         return {"error": "Poll not found."}
     
-    document = await db.find_one({"_id": ObjectId(id)}) 
+    document = await find_poll(id, TALLY_PROFILE)
     
     if document is None: # poll not found
-        print("Poll not found.")
         return {"error": "Poll not found."}
     else: 
-        is_voter, is_owner = voter_type(document, owner_id, owner_id)
+        is_voter, is_owner = voter_type(document, False, owner_id)
 
         if not is_owner: 
-            print("Not a owner.")
             return {"error": "You must be the owner to view the ranking data."}
         
-        unranked_candidates = [c for c in document["candidates"] if all([c not in b["ranking"].keys() for b in document["ballots"]])]
-        
-        num_empty_ballots = len([b for b in document["ballots"] if all([c not in b["ranking"].keys() for c in document["candidates"]])])
-        cand_to_cidx = {c: str(i) for i, c in enumerate(document["candidates"])}
+        # the rankings are read from the tally, which has each distinct ranking with the number of voters that submitted it
+        tally = await find_tally(document)
+        cand_to_cidx = candidate_indices(document)
         cmap = {str(cidx):c for c,cidx in cand_to_cidx.items()}
+        unranked_candidates = [c for c in document["candidates"] if tally.get("ranked", {}).get(cand_to_cidx[c], 0) == 0]
+        num_empty_ballots = tally.get("rankings", {}).get(EMPTY_RANKING_KEY, 0)
 
         resp = {
             "unranked_candidates": unranked_candidates,
@@ -781,152 +1373,268 @@ async def submitted_ranking_information(id, owner_id):
             "cmap": cmap,
         }
 
-        if len(document["ballots"]) > 0:
+        if tally.get("num_ballots", 0) > 0:
 
-            prof = ProfileWithTies([{cand_to_cidx[c]: rank 
-                                     for c,rank in r["ranking"].items()} 
-                                     for r in document["ballots"]])
-            prof.display()
-            num_voters = prof.num_voters
-            print(num_voters)
-            columns, num_rows = generate_columns_from_profiles(prof)
+            num_voters = tally["num_ballots"]
+            columns, num_rows = generate_columns(zip(*ranking_counts_from_tally(tally)))
             resp["num_voters"] = num_voters
             resp["num_rows"] = num_rows
             resp["columns"] = columns
-            resp["csv_data"] = generate_csv_data(prof, cmap)
+            resp["csv_data"] = list(iter_csv_rows(ranked_candidates(tally), zip(*ranking_counts_from_tally(tally)), cmap))
     return resp
 
 
+async def compute_voting_results(cands, edges, condorcet_winner, sv_checkpoint=None):
+    """
+    Compute the Stable Voting and Split Cycle winners, the Split Cycle defeat relation, the explanations 
+    and the splitting numbers in the compute service.  
+
+    The last two values returned are a checkpoint from which the computation of the explanations can 
+    be resumed, which is None once the computation is finished, and whether the explanations are complete.  
+    When the computation is interrupted by the cpu time limit the checkpoint it was resumed from is returned.
+    """
+    try:
+        sc_winners, defeat_relation = await compute_service.run(split_cycle_defeat_relation, cands, edges, cpu_limit=OUTCOME_CPU_LIMIT)
+    except ComputeTimeout:
+        fallbacks.labels("split_cycle_defeat_relation").inc()
+        sc_winners = await compute_service.run(split_cycle_winners, cands, edges, cpu_limit=FALLBACK_CPU_LIMIT)
+        defeat_relation = {str(c): {} for c in cands }
+
+    try:
+        sv_winners, explanations, sv_checkpoint = await compute_service.run(
+            stable_voting_explained, cands, edges, OUTCOME_CPU_LIMIT, sv_checkpoint, 
+            cpu_limit=OUTCOME_CPU_LIMIT + 1)
+        explanations_complete = sv_checkpoint is None
+    except ComputeTimeout:
+        sv_winners, explanations, explanations_complete = None, dict(), False
+    if sv_winners is None: 
+        fallbacks.labels("stable_voting_explained").inc()
+        # keep the explanations that were found, and find the winners without explanations
+        sv_winners = await compute_service.run(stable_voting_winners, cands, edges, cpu_limit=FALLBACK_CPU_LIMIT)
+
+    splitting_numbers = {}
+    if condorcet_winner is None: 
+        try:
+            splitting_numbers = await compute_service.run(splitting_numbers_from_margins, cands, edges, cpu_limit=OUTCOME_CPU_LIMIT)
+        except ComputeTimeout:
+            fallbacks.labels("splitting_numbers").inc()
+            splitting_numbers = {}
+
+    return sv_winners, sc_winners, defeat_relation, explanations, splitting_numbers, sv_checkpoint, explanations_complete
+
+
+def bson_size(document):
+    return len(bson.encode(document))
+
+
+def trim_explanations(explanations, max_bytes):
+    """
+    Return the explanations, keeping only those that fit in max_bytes, taken from the subprofiles with the 
+    most candidates first, if they do not all fit.  The explanation of the whole profile is shown first.
+    """
+    if bson_size(explanations) <= max_bytes: 
+        return explanations
+    trimmed = dict()
+    num_bytes = 0
+    for cs in sorted(explanations, key=lambda cs: -cs.count(",")):
+        entry_bytes = bson_size({cs: explanations[cs]})
+        if num_bytes + entry_bytes <= max_bytes: 
+            trimmed[cs] = explanations[cs]
+            num_bytes += entry_bytes
+    return trimmed
+
+
+def trim_sv_checkpoint(sv_checkpoint, max_bytes):
+    """
+    Return the checkpoint, keeping only the resolved subprofiles with the fewest candidates that fit in max_bytes 
+    if it does not fit.  A subprofile is resolved after the smaller subprofiles it depends on, so the computation 
+    resumed from the trimmed checkpoint finds the same explanations.
+    """
+    if bson_size(sv_checkpoint) <= max_bytes: 
+        return sv_checkpoint
+    mem_sv_winners, explanations = sv_checkpoint["mem_sv_winners"], sv_checkpoint["explanations"]
+    trimmed = {"mem_sv_winners": dict(), "explanations": dict()}
+    num_bytes = 0
+    for cs in sorted(mem_sv_winners, key=lambda cs: cs.count(",")):
+        num_bytes += bson_size({cs: mem_sv_winners[cs]}) + (bson_size({cs: explanations[cs]}) if cs in explanations else 0)
+        if num_bytes > max_bytes: 
+            break
+        trimmed["mem_sv_winners"][cs] = mem_sv_winners[cs]
+        if cs in explanations: 
+            trimmed["explanations"][cs] = explanations[cs]
+    return trimmed
+
+
+async def find_sv_checkpoint(document):
+    """The checkpoint of the Stable Voting computation saved for the current revision of the ballots, if there is one."""
+    saved = await db.find_one(
+        {"_id": document["_id"], "sv_checkpoint.revision": document.get("revision", 0)}, 
+        {"sv_checkpoint": 1})
+    return saved["sv_checkpoint"] if saved is not None else None
+
+
+async def save_sv_checkpoint(document, sv_checkpoint):
+    """Save the checkpoint of the Stable Voting computation for the current revision of the ballots."""
+    if sv_checkpoint is None: 
+        await db.update_one({"_id": document["_id"], "sv_checkpoint": {"$exists": True}}, {"$unset": {"sv_checkpoint": ""}})
+    else: 
+        sv_checkpoint = trim_sv_checkpoint(sv_checkpoint, SV_CHECKPOINT_MAX_BYTES)
+        await db.update_one(
+            {"_id": document["_id"], "revision": document.get("revision", None)}, 
+            {"$set": {"sv_checkpoint": {**sv_checkpoint, "revision": document.get("revision", 0)}}})
+
+
+async def compute_poll_result(document, can_view):
+    """Compute the outcome of the poll from its tally."""
+    cand_to_cidx = candidate_indices(document)
+    cmap = {str(cidx):c for c,cidx in cand_to_cidx.items()}
+    error_message = ''
+    show_rankings = document["show_rankings"] 
+    margins= {}
+    num_voters = 0
+    sv_winners = []
+    sc_winners = []
+    condorcet_winner = "N/A"
+    defeat_relation = {}
+    explanations = {}
+    explanations_complete = True
+    explanations_trimmed = False
+    prof_is_linear = False
+    linear_order = []
+    splitting_numbers = {}
+    num_rows = 0
+    columns = [[]]
+    tally = await find_tally(document) if can_view else empty_tally()
+    if tally.get("num_ballots", 0) > 0:
+
+        # the margins are computed from the tally, so this does not depend on the number of voters
+        with profile_latency.time():
+            cands, M = margin_matrix_from_tally(tally)
+            if len(cands) > 0:
+                margins = margins_from_matrix(cands, M)
+                columns, num_rows = generate_columns(zip(*ranking_counts_from_tally(tally)))
+
+        if len(cands) == 0:
+            error_message = "No candidates are ranked."
+        else: 
+            outcome_candidates.observe(len(cands))
+            outcome_ballots.observe(tally["num_ballots"])
+            condorcet_winner = condorcet_winner_from_margins(cands, M)
+            # resume the Stable Voting computation from the previous request if the ballots have not changed
+            sv_checkpoint = await find_sv_checkpoint(document)
+            sv_winners, sc_winners, defeat_relation, explanations, splitting_numbers, sv_checkpoint, explanations_complete = await compute_voting_results(
+                cands, 
+                edges_from_margins(cands, M), 
+                condorcet_winner, 
+                sv_checkpoint)
+            await save_sv_checkpoint(document, sv_checkpoint)
+            trimmed_explanations = trim_explanations(explanations, EXPLANATIONS_MAX_BYTES)
+            explanations_trimmed = len(trimmed_explanations) < len(explanations)
+            explanations = trimmed_explanations
+
+            num_voters = tally["num_ballots"]
+            prof_is_linear, linear_order = linear_order_from_margins(cands, M)
+
+    result = {
+        "margins": margins, 
+        "num_voters": str(num_voters),
+        "cmap": cmap,
+        "show_rankings": show_rankings, 
+        "sv_winners": sv_winners, 
+        "sc_winners": sc_winners, 
+        "selected_sv_winner": None, # only set if the poll is completed
+        "condorcet_winner": condorcet_winner, 
+        "explanations": explanations,
+        "defeats": defeat_relation,
+        "splitting_numbers": splitting_numbers,
+        "prof_is_linear": prof_is_linear,
+        "linear_order": linear_order if prof_is_linear else [],
+        "num_rows": num_rows,
+        "columns":columns,
+        "explanations_complete": explanations_complete,
+        "explanations_trimmed": explanations_trimmed,
+        }
+    if error_message != '':
+        result["error"] = error_message
+    return result
+
+
 async def poll_outcome(id, owner_id, voter_id):
-    print("Generating poll outcome for ", id)
-    print("Owner id ", owner_id)
-    print("Voter id ", voter_id)
     if not ObjectId.is_valid(id): 
         return {"error": "Poll not found."}
-    print("Getting document...")
-    document = await db.find_one({"_id": ObjectId(id)}) 
-    print("got document")
-    print(document)
-    error_message = ''
+    document = await find_poll(id, OUTCOME_PROFILE)
     if document is None: # poll not found
-        print("Poll not found.")
         return {"error": "Poll not found."}
     else: 
-        cand_to_cidx = {c: str(i) for i, c in enumerate(document["candidates"])}
-        cmap = {str(cidx):c for c,cidx in cand_to_cidx.items()}
-
-        is_voter, is_owner = voter_type(document, voter_id, owner_id)
+        is_registered = document.get("is_private", False) and await is_registered_voter(document, voter_id)
+        is_voter, is_owner = voter_type(document, is_registered, owner_id)
 
         can_view = can_view_outcome(
                 document.get("closing_datetime", None), 
-                document.get("timezone", None), 
                 document.get("is_completed", None), 
                 document.get("can_view_outcome_before_closing", False), 
                 document.get("show_outcome", True), 
                 is_owner,
                 is_voter)
         
-        print("is_completed", document.get("is_completed", None))
-        print("can_view ", can_view)
         title = str(document["title"])
-        print("title", title)
-        print(document)
         closing_datetime =  dt_string(document.get("closing_datetime", None), document.get("timezone", None))
         timezone = document["timezone"] if document["timezone"] is not None else "N/A"
-        is_closed = poll_closed(document.get("closing_datetime", None), document.get("timezone", None))
-        print("is closed", is_closed)
-        print(document.get("is_completed", False))
-        print(document.get("result", None))
-        print(document.get("is_completed", False) and document.get("result", None) is not None)
-
-        if document.get("is_completed", False) and document.get("result", None) is not None: 
+        is_closed = poll_closed(document.get("closing_datetime", None))
+        logger.debug("poll outcome", extra={
+            "poll_id": id, 
+            "can_view": can_view, 
+            "is_closed": is_closed, 
+            "is_completed": document.get("is_completed", False), 
+            "revision": document.get("revision", 0)})
+
+        revision = document.get("revision", 0)
+        closing = is_closed or document.get("is_completed", False)
+
+        saved_result = document.get("result", None)
+        saved_result_complete = saved_result is not None and saved_result.get("explanations_complete", True)
+        # the result saved when the poll closed, which has the selected winner.  The polls saved before 
+        # results were saved while they are open only have a result once they closed.
+        saved_result_closed = saved_result_complete and document.get("result_closed", "result_revision" not in document)
+
+        if document.get("is_completed", False) and saved_result_closed: 
             """The poll is completed and there is a saved result."""
-            result = document["result"]
+            result = saved_result
+        elif not can_view: 
+            result = await compute_poll_result(document, can_view)
+        elif not closing and saved_result_complete and document.get("result_revision", None) == revision: 
+            """The ballots have not changed since the result was saved."""
+            outcome_cache.hit()
+            result = saved_result
         else: # otherwise generate the result.    
-            show_rankings = document["show_rankings"] 
-            margins= {}
-            num_voters = 0
-            sv_winners = []
-            sc_winners = []
-            condorcet_winner = "N/A"
-            defeat_relation = {}
-            explanations = {}
-            prof_is_linear = False
-            linear_order = []
-            splitting_numbers = {}
-            num_rows = 0
-            columns = [[]]
-            if can_view and len(document["ballots"]) > 0:
-
-                prof = ProfileWithTies([{cand_to_cidx[c]: rank 
-                                         for c,rank in r["ranking"].items()} 
-                                         for r in document["ballots"]])
-                prof.display()
-
-                if not any([len(list(r.rmap.keys())) > 0 for r in prof.rankings]):
-                    error_message = "No candidates are ranked."
-                else: 
-                    margins = {c1: {c2: prof.margin(c1, c2) for c2 in prof.candidates} for c1 in prof.candidates}
-                    condorcet_winner = prof.condorcet_winner()
-
-                    try:
-                        sc_defeat = func_timeout(2, split_cycle_defeat, args=(prof,), kwargs=None)
-                        sc_winners = [str(c) for c in prof.candidates if not any([c2 for c2 in prof.candidates if sc_defeat.has_edge(c2,c)])]
-                        defeat_relation = {str(c): {str(c2): sc_defeat.has_edge(c,c2) for c2 in prof.candidates} for c in prof.candidates }
-                    except FunctionTimedOut:
-                        sc_defeat = dict()
-                        sc_winners = split_cycle(prof)
-                        defeat_relation = {str(c): {} for c in prof.candidates }
-
-                    try:
-                        sv_winners, _, explanations = func_timeout(2, stable_voting_with_explanations_, args=(prof,), kwargs = {"curr_cands": None, "mem_sv_winners": {}, "explanations": {}})
-                    except FunctionTimedOut:
-                        sv_winners = stable_voting(prof)
-                        explanations = dict()
-
-                    num_voters = prof.num_voters
-                    prof_is_linear, linear_order = is_linear(prof)
-                    columns, num_rows = generate_columns_from_profiles(prof)
-                    if condorcet_winner is None: 
-                        try:
-                            splitting_numbers = func_timeout(2, get_splitting_numbers, args=(prof,), kwargs=None)
-                        except FunctionTimedOut:
-                            splitting_numbers = {}
-                    else: 
-                        splitting_numbers = {}
-
-            result = {
-                "margins": margins, 
-                "num_voters": str(num_voters),
-                "cmap": cmap,
-                "show_rankings": show_rankings, 
-                "sv_winners": sv_winners, 
-                "sc_winners": sc_winners, 
-                "selected_sv_winner": None, # only set if the poll is completed
-                "condorcet_winner": condorcet_winner, 
-                "explanations": explanations,
-                "defeats": defeat_relation,
-                "splitting_numbers": splitting_numbers,
-                "prof_is_linear": prof_is_linear,
-                "linear_order": linear_order if prof_is_linear else [],
-                "num_rows": num_rows,
-                "columns":columns,
-                }
-
-            print("HELLO")
-            if is_closed or document.get("is_completed", False): 
-                # close the poll
-                if len(sv_winners) > 1: 
-                    selected_sv_winner = random.choice(sv_winners)
-                    result["selected_sv_winner"] = selected_sv_winner
 
-                print("RESULT")
-                print(result)
-                await db.update_one( {"_id": ObjectId(id)}, {"$set": {"result": result, "is_completed": True}})
-
-            if not document.get("is_completed", False): 
-                # remove the saved result
-                await db.update_one( {"_id": ObjectId(id)}, {"$set": {"result": None}})
+            async def generate_result():
+                result = await compute_poll_result(document, can_view)
+                if closing: 
+                    # close the poll
+                    if saved_result is not None and saved_result.get("selected_sv_winner", None) is not None: 
+                        # the explanations were not complete when the poll was closed
+                        result["selected_sv_winner"] = saved_result["selected_sv_winner"]
+                    elif len(result["sv_winners"]) > 1: 
+                        selected_sv_winner = random.choice(result["sv_winners"])
+                        result["selected_sv_winner"] = selected_sv_winner
+
+                too_large = bson_size(result) > RESULT_MAX_BYTES
+                if too_large: 
+                    logger.warning("outcome too large to save", extra={"poll_id": id, "num_bytes": bson_size(result)})
+                if closing: 
+                    logger.info("poll closed", extra={"poll_id": id, "sv_winners": result["sv_winners"]})
+                    # a result that is too large is computed again for each view, with the selected winner saved here
+                    saved = result if not too_large else {"selected_sv_winner": result["selected_sv_winner"], "explanations_complete": False}
+                    await db.update_one( {"_id": ObjectId(id)}, {"$set": {"result": saved, "result_closed": True, "is_completed": True}})
+                elif not too_large: 
+                    # save the result unless the ballots changed while it was computed
+                    await db.update_one( 
+                        {"_id": ObjectId(id), "revision": document.get("revision", None)}, 
+                        {"$set": {"result": result, "result_revision": revision, "result_closed": False}})
+                return result
+
+            result = await outcome_cache.compute((id, revision, closing), generate_result)
 
     result["title"] = title
     result["is_closed"] = is_closed 
@@ -936,14 +1644,12 @@ async def poll_outcome(id, owner_id, voter_id):
     result["timezone"] = timezone
     result["election_id"] = str(id)
     
-    if error_message != '':
-        result["error"] = error_message
     return result
 
 
 async def demo_poll_outcome(rankings):
 
-    print("Generating poll outcome for ", rankings)
+    logger.debug("demo poll outcome", extra={"num_rankings": len(rankings)})
 
     closing_datetime = None
     timezone = "N/A"
@@ -952,13 +1658,13 @@ async def demo_poll_outcome(rankings):
     margins= {}
     num_voters = 0
 
-    ballots = list()
+    # collapse identical rankings, so that the profile has each distinct ranking once with its number of voters
+    rcounts = dict()
     for r in rankings: 
-        print(r)
-        for n in range(int(r["num"])): 
-            ballots.append(r["ranking"])
-    _prof = ProfileWithTies([r for r in ballots])
-    _prof.display()
+        key = tuple(sorted(r["ranking"].items()))
+        rcounts[key] = rcounts.get(key, 0) + int(r["num"])
+    rcounts = {key: n for key, n in rcounts.items() if n > 0}
+    _prof = ProfileWithTies([dict(key) for key in rcounts.keys()], rcounts=list(rcounts.values()))
     curr_rankings, counts = _prof.rankings_as_dicts_counts
     cand_to_cindex = {str(c): i for i,c in enumerate(_prof.candidates)}
     cmap = {cindx: str(c) for c, cindx in cand_to_cindex.items()}
@@ -967,9 +1673,8 @@ async def demo_poll_outcome(rankings):
                              for c, r in rank.items()} 
                              for rank in curr_rankings], rcounts=counts)
     
-    prof.display()
-    print(cmap)
-    num_ranked_cands = len(list(set([_c  for _r in prof.rankings for _c in _r.rmap.keys()])))
+    log_profile(logger, prof, cmap=cmap)
+    num_ranked_cands = len(list(set([_c  for _r in prof.rankings_counts[0] for _c in _r.rmap.keys()])))
     if num_ranked_cands == 0: #not any([len(list(r.rmap.keys())) > 0 for r in prof.rankings]):
         columns, num_rows = generate_columns_from_profiles(prof)
         result = {
@@ -1012,35 +1717,19 @@ async def demo_poll_outcome(rankings):
 
         }
     else: 
-        margins = {c1: {c2: prof.margin(c1, c2) for c2 in prof.candidates} for c1 in prof.candidates}
-        condorcet_winner = prof.condorcet_winner()
+        # the margins are computed from the distinct rankings at once, as for the polls
+        cands = list(prof.candidates)
+        prof_rankings, prof_counts = prof.rankings_as_dicts_counts
+        M = margin_matrix(support_matrix(rank_array(prof_rankings, cands), prof_counts))
+        margins = margins_from_matrix(cands, M)
+        condorcet_winner = condorcet_winner_from_margins(cands, M)
 
-        try:
-            sc_defeat = func_timeout(2, split_cycle_defeat, args=(prof,), kwargs=None)
-            sc_winners = [str(c) for c in prof.candidates if not any([c2 for c2 in prof.candidates if sc_defeat.has_edge(c2,c)])]
-            defeat_relation = {str(c): {str(c2): sc_defeat.has_edge(c,c2) for c2 in prof.candidates} for c in prof.candidates }
-        except FunctionTimedOut:
-            sc_defeat = dict()
-            sc_winners = split_cycle(prof)
-            defeat_relation = {str(c): {} for c in prof.candidates }
-
-        try:
-            sv_winners, _, explanations = func_timeout(2, stable_voting_with_explanations_, args=(prof,), kwargs = {"curr_cands": None, "mem_sv_winners": {}, "explanations": {}})
-        except FunctionTimedOut:
-            sv_winners = stable_voting(prof)
-            explanations = dict()
+        sv_winners, sc_winners, defeat_relation, explanations, splitting_numbers, _, _ = await compute_voting_results(
+            cands, edges_from_margins(cands, M), condorcet_winner)
 
         num_voters = prof.num_voters
-        prof_is_linear, linear_order = is_linear(prof)
+        prof_is_linear, linear_order = linear_order_from_margins(cands, M)
         columns, num_rows = generate_columns_from_profiles(prof)
-        if condorcet_winner is None: 
-            try:
-                splitting_numbers = func_timeout(2, get_splitting_numbers, args=(prof,), kwargs=None)
-            except FunctionTimedOut:
-                splitting_numbers = {}
-                        #splitting_numbers = get_splitting_numbers(prof)
-        else: 
-            splitting_numbers = {}
 
         result = {
             "margins": margins, 
@@ -1082,8 +1771,6 @@ async def demo_poll_outcome(rankings):
     if 'linear_order' in result:
         result['linear_order'] = [str(w) for w in result['linear_order']]
 
-
-    print("result ", result)
     return result
 
 
@@ -1092,7 +1779,7 @@ async def resend_voter_email(poll_id: str, voter_email: str, owner_id: str, back
     if not ObjectId.is_valid(poll_id):
         return {"error": "Invalid poll ID."}
     
-    document = await db.find_one({"_id": ObjectId(poll_id)})
+    document = await find_poll(poll_id, METADATA_PROFILE)
     
     if document is None:
         return {"error": "Poll not found."}
@@ -1103,60 +1790,34 @@ async def resend_voter_email(poll_id: str, voter_email: str, owner_id: str, back
     if not document.get("is_private", False):
         return {"error": "Can only manage voters in private polls."}
     
-    voter_email_map = document.get("voter_email_map", {})
-    email_send_counts = document.get("email_send_counts", {})
-    
-    # Find the voter_id for this email
-    voter_id = None
-    for vid, email in voter_email_map.items():
-        if email == voter_email:
-            voter_id = vid
+    # Find the voter with this email, replace the old ID with a new ID and increment the email send count,
+    # the unique index rejects an ID used by another voter
+    while True:
+        new_voter_id = generate_voter_ids(1)[0]
+        try:
+            voter = await voters_db.find_one_and_update(
+                {"poll_id": document["_id"], "email": voter_email}, 
+                {"$set": {"voter_id": new_voter_id}, "$inc": {"emails_sent": 1}},
+                return_document=ReturnDocument.BEFORE)
             break
+        except DuplicateKeyError:
+            continue
     
-    if not voter_id:
+    if voter is None:
         return {"error": "Voter email not found."}
-    
-    # Generate new voter ID
-    new_voter_id = generate_voter_ids(1)[0]
-    
-    # Get voter_ids list
-    voter_ids = document.get("voter_ids", [])
-    
-    # Replace old ID with new ID in voter_ids list
-    if voter_id in voter_ids:
-        voter_ids[voter_ids.index(voter_id)] = new_voter_id
-    
-    # Update email map
-    del voter_email_map[voter_id]
-    voter_email_map[new_voter_id] = voter_email
-    
-    # Update any existing ballot to use the new voter_id
-    ballots = document["ballots"]
-    for ballot in ballots:
-        if ballot.get("voter_id") == voter_id:
-            ballot["voter_id"] = new_voter_id
-    
-    # Increment email send count
-    email_send_counts[voter_email] = email_send_counts.get(voter_email, 1) + 1
-    
-    # Update the database
-    result = await db.update_one(
-        {"_id": ObjectId(poll_id)}, 
-        {"$set": {
-            "voter_ids": voter_ids,
-            "voter_email_map": voter_email_map,
-            "email_send_counts": email_send_counts,
-            "ballots": ballots
-        }}
-    )
-    
-    if result.modified_count > 0:
+    else:
+        voter_id = voter["voter_id"]
+
+        # Update any existing ballot to use the new voter_id
+        await ballots_db.update_many(
+            {"poll_id": ObjectId(poll_id), "voter_id": voter_id},
+            {"$set": {"voter_id": new_voter_id, "dedup_key": voter_dedup_key(new_voter_id)}})
+
         # Send email with new link
         if not SKIP_EMAILS:
             link = f"https://stablevoting.org/vote/{poll_id}?vid={new_voter_id}"
             
-            background_tasks.add_task(
-                send_email,
+            await queue_email(
                 to_email=voter_email,
                 subject=f"Reminder: Participate in the poll - {document['title']}",
                 html_body=f"""<p>This is a reminder to participate in the poll.</p>
@@ -1164,11 +1825,10 @@ async def resend_voter_email(poll_id: str, voter_email: str, owner_id: str, back
                 <p>Description: {document.get('description', '')}</p>
                 <p>Your voting link: <a href="{link}">{link}</a></p>
                 <p>Note: This new link replaces any previous links sent to you.</p>""",
-                tag="voter-invitation-resend"
+                tag="voter-invitation-resend",
+                poll_id=document["_id"]
             )
         
         return {
-            "success": f"Email resent to {voter_email}. Total emails sent: {email_send_counts[voter_email]}"
-        }
-    else:
-        return {"error": "Failed to resend email."}
\ No newline at end of file
+            "success": f"Email resent to {voter_email}. Total emails sent: {voter.get('emails_sent', 1) + 1}"
+        }
\ No newline at end of file
@@ -0,0 +1,124 @@
+## Metrics
+#
+# Prometheus metrics of a worker, served by /metrics: the latency of each route, of the
+# MongoDB commands and of the computations in the compute service, the time it takes to
+# build the profile of a poll from its tally, the sizes of the polls whose outcomes are
+# computed and the number of times each computation falls back to a cheaper one because it
+# ran out of time.  The statistics of the connection pool, the compute service, the outcome
+# cache, the group commit of votes and the email outbox are exported as gauges when the
+# metrics are collected.
+#
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import GaugeMetricFamily
+from pymongo import monitoring
+
+registry = CollectorRegistry()
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+MONGO_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+CANDIDATE_BUCKETS = (2, 3, 4, 5, 6, 8, 10, 12, 15, 20, 30, 50, 100)
+BALLOT_BUCKETS = (1, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000, 1000000)
+
+requests_total = Counter(
+    "stablevoting_requests_total",
+    "Requests by route and status code",
+    ["method", "route", "status"], registry=registry)
+request_latency = Histogram(
+    "stablevoting_request_duration_seconds",
+    "Time to answer a request, by route",
+    ["method", "route"], buckets=LATENCY_BUCKETS, registry=registry)
+
+mongo_latency = Histogram(
+    "stablevoting_mongo_command_duration_seconds",
+    "Time of the MongoDB commands, by command",
+    ["command"], buckets=MONGO_LATENCY_BUCKETS, registry=registry)
+mongo_failures = Counter(
+    "stablevoting_mongo_command_failures_total",
+    "MongoDB commands that failed, by command",
+    ["command"], registry=registry)
+
+compute_latency = Histogram(
+    "stablevoting_compute_duration_seconds",
+    "CPU bound time of the computations run in the compute service, by function",
+    ["function"], buckets=LATENCY_BUCKETS, registry=registry)
+compute_queue_wait = Histogram(
+    "stablevoting_compute_queue_wait_seconds",
+    "Time the computations waited for a worker of the compute service",
+    buckets=LATENCY_BUCKETS, registry=registry)
+compute_timeouts = Counter(
+    "stablevoting_compute_timeouts_total",
+    "Computations that ran out of time, by function",
+    ["function"], registry=registry)
+fallbacks = Counter(
+    "stablevoting_outcome_fallbacks_total",
+    "Parts of an outcome that fell back to a cheaper computation, or were left out, because they ran out of time",
+    ["computation"], registry=registry)
+
+group_commit_size = Histogram(
+    "stablevoting_vote_group_size",
+    "Number of votes written together by a group commit",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500), registry=registry)
+group_commit_latency = Histogram(
+    "stablevoting_vote_group_commit_seconds",
+    "Time to write a group of votes",
+    buckets=MONGO_LATENCY_BUCKETS, registry=registry)
+
+outbox_emails = Counter(
+    "stablevoting_outbox_emails_total",
+    "Emails of the outbox that were sent, will be retried or were dead lettered",
+    ["result"], registry=registry)
+
+profile_latency = Histogram(
+    "stablevoting_profile_duration_seconds",
+    "Time to build the margins and the table of rankings of a poll from its tally",
+    buckets=LATENCY_BUCKETS, registry=registry)
+outcome_candidates = Histogram(
+    "stablevoting_outcome_candidates",
+    "Number of ranked candidates of the polls whose outcome is computed",
+    buckets=CANDIDATE_BUCKETS, registry=registry)
+outcome_ballots = Histogram(
+    "stablevoting_outcome_ballots",
+    "Number of ballots of the polls whose outcome is computed",
+    buckets=BALLOT_BUCKETS, registry=registry)
+
+
+class CommandLatency(monitoring.CommandListener):
+    """Observe the latency of each MongoDB command.  The events are published from the threads of the driver."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        mongo_latency.labels(event.command_name).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        mongo_latency.labels(event.command_name).observe(event.duration_micros / 1e6)
+        mongo_failures.labels(event.command_name).inc()
+
+
+class StatsCollector:
+    """Export the statistics of the connection pool, the compute service, the outcome cache, the group commit of votes and the email outbox as gauges."""
+
+    def collect(self):
+        from polls.database import database
+        from polls.compute import compute_service
+        from polls.outcome_cache import outcome_cache
+        from polls.group_commit import vote_group_commit
+        from messages.outbox import outbox
+        for prefix, stats in (
+                ("mongo_pool", database.stats()),
+                ("compute_service", compute_service.stats()),
+                ("outcome_cache", outcome_cache.stats()),
+                ("vote_group_commit", vote_group_commit.stats()),
+                ("email_outbox", outbox.stats())):
+            for name, value in stats.items():
+                yield GaugeMetricFamily(f"stablevoting_{prefix}_{name}", f"{name} of the {prefix.replace('_', ' ')}", value=float(value))
+
+
+registry.register(StatsCollector())
+
+
+def metrics_text():
+    """The metrics in the Prometheus text format, with its content type."""
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -114,6 +114,12 @@ class VoterDetail(BaseModel):
     emailsSent: int
     # Removed hasVoted and voteUrl fields for privacy
 
+class VoterIds(BaseModel): 
+    voter_ids: List[str] # ids of the voters of a private poll
+
+class VoterEmails(BaseModel): 
+    emails: List[str] # emails of the voters of a private poll
+
 class PollInfo(BaseModel):
     is_owner: bool
     title: str
@@ -192,6 +198,8 @@ class OutcomeInfo(BaseModel):
     linear_order: List[str]
     num_rows: int
     columns: List[List[str]]
+    explanations_complete: bool = True
+    explanations_trimmed: bool = False
 
 
 class DemoRankingsInput(BaseModel):
@@ -0,0 +1,48 @@
+## Outcome cache
+#
+# The outcome of a poll is saved on the poll document together with the revision of the
+# ballots it was computed from.  Every change to the ballots increments the revision, so
+# a saved outcome can be reused as long as the revisions match.  When the outcome must be
+# recomputed, concurrent requests for the same revision share a single computation.
+#
+
+import asyncio
+
+
+class OutcomeCache:
+
+    def __init__(self):
+        self.hits = 0 # outcomes served from the saved result
+        self.misses = 0 # outcomes that were computed
+        self.shared = 0 # outcomes that waited for a computation started by another request
+        self._in_flight = dict()
+
+    def hit(self):
+        self.hits += 1
+
+    async def compute(self, key, compute_fn):
+        '''
+        Return the result of compute_fn(), unless a computation for key is already running,
+        in which case wait for that computation and return its result.
+        '''
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.shared += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(compute_fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # shield the computation so that a cancelled request does not cancel it for everyone else
+        return dict(await asyncio.shield(task))
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "shared": self.shared,
+            "in_flight": len(self._in_flight),
+        }
+
+
+outcome_cache = OutcomeCache()
@@ -0,0 +1,112 @@
+## Tallies
+#
+# The tally of a poll is stored on the poll document and is updated by applying the
+# change caused by each ballot that is added or removed, so that the outcome can be
+# computed without reading the ballots:
+#
+#   tally.support.{i}.{j}  number of voters that rank candidate i strictly above candidate j
+#   tally.ranked.{i}       number of voters that rank candidate i
+#   tally.rankings.{key}   number of voters that submitted the ranking with this key
+#   tally.num_ballots      number of ballots
+#
+# Candidates are identified by their index in the list of candidates of the poll.
+#
+
+from collections import Counter
+import numpy as np
+from polls.voting import rank_array, support_matrix, margin_matrix
+
+EMPTY_RANKING_KEY = "empty"
+
+
+def empty_tally():
+    return {"support": {}, "ranked": {}, "rankings": {}, "num_ballots": 0}
+
+
+def ranking_key(ranking, cand_to_cidx):
+    '''
+    A key identifying the ranking that can be used as a field name in a document, e.g.,
+    the ranking {"A": 1, "C": 2} of the candidates ["A", "B", "C"] has the key "0:1|2:2".
+    '''
+    ranks = sorted((int(cand_to_cidx[c]), r) for c, r in ranking.items() if c in cand_to_cidx)
+    if len(ranks) == 0:
+        return EMPTY_RANKING_KEY
+    return "|".join(f"{cidx}:{r}" for cidx, r in ranks)
+
+
+def ranking_from_key(key):
+    '''Return the ranking, as a map from candidate indices to ranks, with this key.'''
+    if key == EMPTY_RANKING_KEY:
+        return {}
+    return {cidx: int(r) for cidx, r in (cr.split(":") for cr in key.split("|"))}
+
+
+def tally_delta(ranking, cand_to_cidx, weight=1, delta=None):
+    '''
+    Add to delta the changes to the tally caused by adding weight ballots with the ranking
+    (weight is negative when ballots are removed).  The result is suitable for an $inc update.
+    '''
+    delta = delta if delta is not None else dict()
+
+    def inc(field, amount):
+        delta[field] = delta.get(field, 0) + amount
+
+    ranks = {cand_to_cidx[c]: r for c, r in ranking.items() if c in cand_to_cidx}
+    for c1, r1 in ranks.items():
+        inc(f"tally.ranked.{c1}", weight)
+        for c2, r2 in ranks.items():
+            if r1 < r2:
+                inc(f"tally.support.{c1}.{c2}", weight)
+    inc(f"tally.rankings.{ranking_key(ranking, cand_to_cidx)}", weight)
+    inc("tally.num_ballots", weight)
+    return delta
+
+
+def nonzero(delta):
+    return {field: amount for field, amount in delta.items() if amount != 0}
+
+
+def tally_from_ballots(ballots, cand_to_cidx):
+    '''Compute the tally of a list of ballots from scratch.'''
+    rankings = Counter()
+    for b in ballots:
+        rankings[ranking_key(b["ranking"], cand_to_cidx)] += b.get("count", 1)
+
+    # tally the distinct rankings
+    keys = list(rankings.keys())
+    cidxs = sorted(cand_to_cidx.values(), key=int)
+    ranks = rank_array([ranking_from_key(key) for key in keys], cidxs)
+    counts = np.array([rankings[key] for key in keys], dtype=np.int64)
+    S = support_matrix(ranks, counts)
+    ranked = (np.isfinite(ranks) * counts[:, None]).sum(axis=0) if len(keys) > 0 else np.zeros(len(cidxs))
+
+    return {
+        "support": {c1: {c2: int(S[i, j]) for j, c2 in enumerate(cidxs) if S[i, j] != 0}
+                    for i, c1 in enumerate(cidxs) if S[i].any()},
+        "ranked": {c: int(ranked[i]) for i, c in enumerate(cidxs) if ranked[i] != 0},
+        "rankings": {key: n for key, n in rankings.items() if n != 0},
+        "num_ballots": int(counts.sum()),
+    }
+
+
+def ranked_candidates(tally):
+    '''The indices, as strings, of the candidates ranked by at least one voter, sorted as in ProfileWithTies.'''
+    return sorted([c for c, n in tally.get("ranked", {}).items() if n > 0])
+
+
+def margin_matrix_from_tally(tally):
+    '''The candidates that are ranked by at least one voter and their margin matrix.'''
+    support = tally.get("support", {})
+    cands = ranked_candidates(tally)
+    S = np.array([[support.get(c1, {}).get(c2, 0) for c2 in cands] for c1 in cands], dtype=np.int64)
+    return cands, margin_matrix(S.reshape(len(cands), len(cands)))
+
+
+def ranking_counts_from_tally(tally):
+    '''The anonymized profile: the distinct rankings with the number of voters that submitted each one.'''
+    rankings, counts = list(), list()
+    for key, n in tally.get("rankings", {}).items():
+        if n > 0:
+            rankings.append(ranking_from_key(key))
+            counts.append(n)
+    return rankings, counts
@@ -1,11 +1,9 @@
 
-from pref_voting.voting_methods import split_cycle
+import time
+import numpy as np
+from pref_voting.voting_methods import split_cycle, stable_voting
+from pref_voting.weighted_majority_graphs import MarginGraph
  
-def is_same_ranking(r1, r2): 
-    if sorted(list(r1.keys())) == sorted(list(r2.keys())):
-        return all([r1[c] == r2[c] for c in r1.keys()])
-    return False
-
 def ws_to_str(ws): 
     if len(ws) == 1: 
         return f"Stable Voting winner is {ws[0]}"
@@ -37,125 +35,363 @@ def is_linear(profile):
     
     return lin_profile, [c for c,_ in sorted(num_incoming_edges.items(), key=lambda ces: ces[1] )]
 
+#
+# Array based computations.  Candidates are identified by their position in a list of 
+# candidates, and M is the margin matrix: M[i, j] is the margin of candidate i over candidate j. 
+#
+
+# the number of entries of the (voters x candidates x candidates) arrays built at once
+SUPPORT_CHUNK_ENTRIES = 2 ** 24
+
+def rank_array(rankings, candidates): 
+    '''
+    encode the rankings, given as maps from candidates to ranks, as an array with a row for each ranking 
+    and a column for each candidate, where unranked candidates have rank np.inf
+    '''
+    cidx = {c: i for i, c in enumerate(candidates)}
+    ranks = np.full((len(rankings), len(candidates)), np.inf)
+    for ridx, r in enumerate(rankings): 
+        for c, rank in r.items(): 
+            if c in cidx: 
+                ranks[ridx, cidx[c]] = rank
+    return ranks
+
+def support_matrix(ranks, counts = None): 
+    '''
+    S[i, j] is the number of voters that rank both i and j with i strictly above j, where row v of ranks 
+    is the ranking submitted by counts[v] voters
+    '''
+    num_rankings, num_cands = ranks.shape
+    counts = np.ones(num_rankings, dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64)
+    S = np.zeros((num_cands, num_cands), dtype=np.int64)
+    chunk = max(1, SUPPORT_CHUNK_ENTRIES // max(1, num_cands * num_cands))
+    for start in range(0, num_rankings, chunk): 
+        r = ranks[start:start + chunk]
+        # r[v, i] < r[v, j] is False whenever r[v, i] is np.inf, so only j can be unranked
+        prefers = (r[:, :, None] < r[:, None, :]) & np.isfinite(r)[:, None, :]
+        S += np.einsum('v,vij->ij', counts[start:start + chunk], prefers.astype(np.int64))
+    return S
+
+def margin_matrix(S): 
+    return S - S.T
+
+def margin_matrix_from_edges(cands, edges): 
+    cidx = {c: i for i, c in enumerate(cands)}
+    M = np.zeros((len(cands), len(cands)), dtype=np.int64)
+    for c1, c2, m in edges: 
+        M[cidx[c1], cidx[c2]] = m
+        M[cidx[c2], cidx[c1]] = -m
+    return M
+
+def condorcet_winner_from_margins(cands, M): 
+    beats = (M > 0).sum(axis=1)
+    winners = np.flatnonzero(beats == len(cands) - 1)
+    return cands[winners[0]] if len(winners) == 1 else None
+
+def linear_order_from_margins(cands, M): 
+    '''
+    return whether the majority relation is a linear order and the candidates sorted by the 
+    number of candidates with a positive margin over them
+    '''
+    num_incoming_edges = (M > 0).sum(axis=0)
+    lin_profile = sorted(num_incoming_edges.tolist()) == list(range(len(cands)))
+    return lin_profile, [cands[i] for i in np.argsort(num_incoming_edges, kind="stable")]
+
+def margins_from_matrix(cands, M): 
+    return {c1: {c2: int(M[i, j]) for j, c2 in enumerate(cands)} for i, c1 in enumerate(cands)}
+
+def edges_from_margins(cands, M): 
+    '''
+    the edges (c1, c2, margin) of the margin graph, which, unlike a MarginGraph, can be sent to another process
+    '''
+    return [(cands[i], cands[j], int(M[i, j])) for i, j in zip(*np.nonzero(M > 0))]
+
+def strongest_paths(M): 
+    '''
+    P[i, j] is the strength of the strongest path from i to j in the margin graph, where the strength 
+    of a path is its smallest margin (0 when there is no path)
+    '''
+    P = np.where(M > 0, M, 0)
+    for k in range(len(M)): 
+        P = np.maximum(P, np.minimum(P[:, k, None], P[None, k, :]))
+    return P
+
+def split_cycle_defeat_matrix(M): 
+    '''
+    D[i, j] is True when i defeats j according to Split Cycle: the margin of i over j is positive and 
+    larger than the splitting number of every cycle containing the edge from i to j, i.e., larger than
+    the strength of the strongest path from j back to i
+    '''
+    P = strongest_paths(M)
+    return (M > 0) & (M > P.T)
+
+def rmap_key(rmap): 
+    '''
+    a hashable key identifying a ranking, given as a map from candidates to ranks, that does not depend on 
+    the order of the candidates in the map
+    '''
+    return frozenset(rmap.items())
+
+def normalized_rmap(rmap): 
+    '''the ranking with its ranks renumbered 1, 2, 3, ... without changing the order of the candidates'''
+    ranks = {rank: ridx + 1 for ridx, rank in enumerate(sorted(set(rmap.values())))}
+    return {c: ranks[rank] for c, rank in rmap.items()}
+
+def aggregate_rankings(rankings_counts, normalize = False): 
+    '''
+    return the distinct rankings, in the order in which they first appear, with their total counts 
+    given (ranking, count) pairs, which are read once so they can be streamed 
+    '''
+    aggregated = dict()
+    for rmap, count in rankings_counts: 
+        if normalize: 
+            rmap = normalized_rmap(rmap)
+        key = rmap_key(rmap)
+        if key in aggregated: 
+            aggregated[key][1] += count
+        else: 
+            aggregated[key] = [rmap, count]
+    return list(aggregated.values())
+
+def iter_columns(rankings_counts, max_rank): 
+    '''
+    yield the columns of the table of rankings one at a time: the count followed by the candidates at each rank
+    '''
+    for rmap, count in rankings_counts: 
+        cands_at_rank = dict()
+        for c, rank in rmap.items(): 
+            cands_at_rank.setdefault(rank, list()).append(c)
+        yield [str(count)] + [", ".join([str(_c) for _c in cands_at_rank.get(rank, [])]) for rank in range(1, max_rank + 1)]
+
+def generate_columns(rankings_counts): 
+    rankings_counts = aggregate_rankings(rankings_counts)
+    max_rank = max([max(rmap.values()) for rmap, _ in rankings_counts if len(rmap) > 0], default = 0)
+    return list(iter_columns(rankings_counts, max_rank)), max_rank
+
 def generate_columns_from_profiles(prof): 
-    cols = list()
-    max_rank = 0
-    for r in prof.rankings: 
-        if len(r.rmap.values()) > 0 and max_rank < max(r.rmap.values()):
-            max_rank = max(r.rmap.values())
-            
-    for r,c in zip(prof.rankings, prof.rcounts):
-        found_col=False
-        for col in cols: 
-            col_rmap = col["rmap"]
-            if is_same_ranking(r.rmap, col_rmap): 
-                col["count"] += c
-                found_col = True
-        if not found_col: 
-            cols.append({
-                "rmap": r.rmap,
-                "count": c,
-                "col_list": [", ".join([str(_c) for _c in r.cands_at_rank(rank)]) if rank in r.rmap.values() else "" 
-                            for rank in range(1, max_rank + 1)]
-            })
-    return [[str(c["count"])] + c["col_list"] for c in cols], max_rank
+    return generate_columns(zip(*prof.rankings_as_dicts_counts))
+
+def iter_csv_rows(candidates, rankings_counts, cmap): 
+    '''
+    yield the rows of the csv file of the anonymous profile one at a time: the header with the names of the 
+    candidates, then the ranks of the candidates followed by the count for each distinct ranking
+    '''
+    yield [cmap[c] for c in candidates] + [""]
+    for rmap, count in aggregate_rankings(rankings_counts, normalize = True): 
+        yield [rmap.get(cand, "") for cand in candidates] + [count]
 
 def generate_csv_data(profile, cmap): 
-    candidates = profile.candidates
-    
-    # generate the anonymous profile
-    rs, cs = profile.rankings_counts
-    anon_rankings = [[rs[0], cs[0]]]
-    for r, c in zip(rs[1::], cs[1::]): 
-        r.normalize_ranks()
-        found_it = False
-        for r_c in anon_rankings[1::]: 
-            if r_c[0] == r: 
-                found_it = True
-                r_c[1] += c
-        if not found_it: 
-            anon_rankings.append([r, c])
+    return list(iter_csv_rows(profile.candidates, zip(*profile.rankings_as_dicts_counts), cmap))
+
+# the maximum number of cycles for which splitting numbers are displayed
+MAX_DISPLAYED_CYCLES = 25
+
+def strongest_path(M, start, end, strength): 
+    '''
+    return a path with as few edges as possible from start to end using only edges with margin at least strength, 
+    or None if there is no such path
+    '''
+    previous = {start: None}
+    frontier = [start]
+    while len(frontier) > 0 and end not in previous: 
+        next_frontier = list()
+        for i in frontier: 
+            for j in np.nonzero(M[i] >= strength)[0].tolist(): 
+                if j not in previous: 
+                    previous[j] = i
+                    next_frontier.append(j)
+        frontier = next_frontier
+    if end not in previous: 
+        return None
+    path = [end]
+    while path[-1] != start: 
+        path.append(previous[path[-1]])
+    return path[::-1]
+
+def get_splitting_numbers(M, max_cycles = MAX_DISPLAYED_CYCLES): 
+    '''
+    return the splitting numbers of the edges of the margin graph that are in a cycle, as a list of 
+    (i, j, splitting number, cycle) sorted by splitting number. 
     
-    # generate the rows for the csv file
-    rows = [[cmap[c] for c in candidates] + [""]] 
-    for r,c in anon_rankings: 
-        row = list()
-        for cand in candidates: 
-            if cand in r.rmap.keys(): 
-                row.append(r.rmap[cand])
+    The splitting number of the edge from i to j is the largest splitting number (smallest margin) of a cycle 
+    containing the edge, which is the smaller of the margin of i over j and the strength of the strongest path 
+    from j back to i, so it is found without enumerating the cycles.  A cycle with this splitting number, 
+    the edge followed by a strongest path, is only found for the first max_cycles distinct cycles. 
+    '''
+    P = strongest_paths(M)
+    numbers = np.minimum(M, P.T)
+    edges = [(i, j) for i, j in zip(*np.nonzero((M > 0) & (P.T > 0)))]
+    edges.sort(key=lambda e: (-numbers[e], e))
+
+    splitting_numbers = list()
+    cycles = set()
+    for i, j in edges: 
+        number = int(numbers[i, j])
+        cycle = None
+        if len(cycles) < max_cycles: 
+            path = strongest_path(M, j, i, number)
+            cycle = [i] + path[:-1]
+            # start the cycle at its first candidate so that each cycle is only displayed once
+            first = cycle.index(min(cycle))
+            cycle = tuple(cycle[first:] + cycle[:first])
+            if cycle in cycles: 
+                cycle = None
             else: 
-                row.append("")
-        row.append(c)
-        rows.append(row)
-
-    return rows
-
-def get_splitting_numbers(profile): 
-    '''
-    return a dictionary associating each cycle with its splitting number
-    '''
-    cycles = profile.cycles()
-    splitting_numbers = dict()
-    for cycle in cycles: # for each cycle in the margin graph
-        # get all the margins (i.e., the weights) of the edges in the cycle
-        margins = list() 
-        for idx,c1 in enumerate(cycle): 
-            next_idx = idx + 1 if (idx + 1) < len(cycle) else 0
-            c2 = cycle[next_idx]
-            margins.append(profile.margin(c1, c2)) 
-        splitting_numbers[tuple_to_str(cycle)] = min(margins) # the split number of the cycle is the minimal margin
+                cycles.add(cycle)
+        splitting_numbers.append((int(i), int(j), number, cycle))
     return splitting_numbers
 
 
-def stable_voting_with_explanations_(profile, curr_cands = None, mem_sv_winners = {}, explanations = {}): 
+class BudgetExceeded(Exception): 
+    pass
+
+
+def members(mask, cands): 
+    '''the candidates in the subset of cands represented by the bitmask, in the order of cands'''
+    return [c for cidx, c in enumerate(cands) if mask >> cidx & 1]
+
+def to_mask(cs, cand_to_cidx): 
+    return sum(1 << cand_to_cidx[c] for c in cs)
+
+def stable_voting_with_explanations_(cands, M, mem_sv_winners = None, explanations = None, deadline = None): 
     '''
-    Determine the Stable Voting winners for the profile while keeping track 
-    of the winners in any subprofiles checked during computation. 
+    Determine the Stable Voting winners for the margin matrix M of the candidates cands while keeping track 
+    of the winners in any subprofiles checked during computation.  Subsets of the candidates are represented 
+    as bitmasks, where bit i is set when cands[i] is in the subset, and mem_sv_winners maps the subsets that 
+    have been resolved to their winners. 
+
+    If deadline is set, raise BudgetExceeded once the cpu time (time.process_time) passes the deadline.  
+    The winners of every subprofile resolved before then are in mem_sv_winners. 
     '''
-    
-    # curr_cands is the set of candidates who have not been removed
-    curr_cands = curr_cands if not curr_cands is None else profile.candidates
-    sv_winners = list()
-    
-    if len(curr_cands) == 1: 
-        mem_sv_winners[tuple(curr_cands)] = curr_cands
-        explanations[tuple_to_str(tuple(curr_cands))] = {} 
-        return curr_cands, mem_sv_winners, explanations
-
-    sc_ws = split_cycle(profile, curr_cands = curr_cands)
-    print("sc_ws", sc_ws)
-    if len(sc_ws) == 1: 
-        mem_sv_winners[tuple(curr_cands)] = sc_ws
-        explanations[tuple_to_str(tuple(curr_cands))] = {"is_uniquely_undefeated": {
-            'winner': tuple_to_str(sc_ws),
-            'is_condorcet_winner': all([profile.margin(sc_ws[0], _c) > 0 for _c in curr_cands if sc_ws[0] != _c])}}
-        return sc_ws, mem_sv_winners, explanations
-    
-    matches = [(a, b) for a in curr_cands for b in curr_cands if a != b]    
-    margins = list(set([profile.margin(a, b) for a,b in matches]))
-    
-    for m in sorted(margins, reverse=True):
-        for a, b in [ab_match for ab_match in matches 
-                     if profile.margin(ab_match[0], ab_match[1])  == m and ab_match[0] in sc_ws]:
-            
-            if a not in sv_winners: 
-                cands_minus_b = sorted([c for c in curr_cands if c!= b])
-                if tuple(cands_minus_b) not in mem_sv_winners.keys(): 
-                    ws, mem_sv_winners, explanations = stable_voting_with_explanations_(profile, curr_cands = cands_minus_b, mem_sv_winners = mem_sv_winners, explanations = explanations)
-                    mem_sv_winners[tuple(cands_minus_b)] = ws
-                else: 
-                    ws = mem_sv_winners[tuple(cands_minus_b)]
-                
-                if a in ws:
-                    sv_winners.append(a)
-                if tuple_to_str(tuple(curr_cands)) not in explanations.keys():
-                    explanations[tuple_to_str(tuple(curr_cands))] = dict()
-                explanations[tuple_to_str(tuple(curr_cands))].update({tuple_to_str((a,b)): {
-                    'margin': str(profile.margin(a,b)), 
-                    'cands_minus_b': tuple_to_str([c for c in curr_cands if c != b]),
-                    'undefeated_cands': tuple_to_str(sc_ws),
-                    'winner': tuple_to_str(ws)}})
-
-        if len(sv_winners) > 0: 
-            return sorted(sv_winners), mem_sv_winners, explanations
+    mem_sv_winners = mem_sv_winners if mem_sv_winners is not None else dict()
+    explanations = explanations if explanations is not None else dict()
+    sc_winners = dict()
+
+    # all the matches, sorted by margin from largest to smallest
+    matches = sorted([(a, b) for a in range(len(cands)) for b in range(len(cands)) if a != b], 
+                     key = lambda ab: -M[ab])
+
+    def split_cycle_winners_(mask): 
+        if mask not in sc_winners: 
+            idxs = np.array([cidx for cidx in range(len(cands)) if mask >> cidx & 1])
+            D = split_cycle_defeat_matrix(M[np.ix_(idxs, idxs)])
+            sc_winners[mask] = idxs[~D.any(axis=0)].tolist()
+        return sc_winners[mask]
+
+    def sv_winners_(mask): 
+        if mask in mem_sv_winners: 
+            return mem_sv_winners[mask]
+
+        if deadline is not None and time.process_time() > deadline: 
+            raise BudgetExceeded()
+
+        curr_cands = members(mask, cands)
+        curr_cands_str = tuple_to_str(curr_cands)
+
+        if len(curr_cands) == 1: 
+            explanations[curr_cands_str] = {} 
+            mem_sv_winners[mask] = curr_cands
+            return curr_cands
+
+        sc_ws = split_cycle_winners_(mask)
+        if len(sc_ws) == 1: 
+            explanations[curr_cands_str] = {"is_uniquely_undefeated": {
+                'winner': str(cands[sc_ws[0]]),
+                'is_condorcet_winner': all([M[sc_ws[0], c] > 0 for c in range(len(cands)) if mask >> c & 1 and c != sc_ws[0]])}}
+            mem_sv_winners[mask] = [cands[sc_ws[0]]]
+            return mem_sv_winners[mask]
+
+        sv_winners = list()
+        curr_margin = None
+        for a, b in matches: 
+            if not (mask >> a & 1 and mask >> b & 1): 
+                continue
+            if M[a, b] != curr_margin: 
+                # all the matches with the previous margin have been checked
+                if len(sv_winners) > 0: 
+                    break
+                curr_margin = M[a, b]
+            if a not in sc_ws or cands[a] in sv_winners: 
+                continue
+
+            mask_minus_b = mask & ~(1 << b)
+            ws = sv_winners_(mask_minus_b)
+            if cands[a] in ws: 
+                sv_winners.append(cands[a])
+            explanations.setdefault(curr_cands_str, dict())[tuple_to_str((cands[a], cands[b]))] = {
+                'margin': str(M[a, b]), 
+                'cands_minus_b': tuple_to_str(members(mask_minus_b, cands)),
+                'undefeated_cands': tuple_to_str([cands[c] for c in sc_ws]),
+                'winner': tuple_to_str(ws)}
 
+        mem_sv_winners[mask] = sorted(sv_winners)
+        return mem_sv_winners[mask]
+
+    return sv_winners_((1 << len(cands)) - 1), mem_sv_winners, explanations
+
+
+def checkpoint_to_memo(checkpoint, cands): 
+    '''
+    return the winners and explanations of the subprofiles saved in a checkpoint 
+    '''
+    if checkpoint is None: 
+        return dict(), dict()
+    cand_to_cidx = {str(c): cidx for cidx, c in enumerate(cands)}
+    mem_sv_winners = {to_mask(cs.split(","), cand_to_cidx): [cands[cand_to_cidx[w]] for w in ws] 
+                      for cs, ws in checkpoint["mem_sv_winners"].items()}
+    return mem_sv_winners, dict(checkpoint["explanations"])
+
+def memo_to_checkpoint(mem_sv_winners, explanations, cands): 
+    '''
+    return a checkpoint, that can be saved in a document, with the winners and explanations of 
+    the subprofiles that have been resolved 
+    '''
+    resolved = {tuple_to_str(members(mask, cands)): [str(w) for w in ws] for mask, ws in mem_sv_winners.items()}
+    return {
+        "mem_sv_winners": resolved, 
+        "explanations": {cs: e for cs, e in explanations.items() if cs in resolved}
+        }
+
+
+#
+# The following functions are run in the worker processes of the compute service, so 
+# they take the candidates and the edges of the margin graph rather than a MarginGraph. 
+#
+
+def split_cycle_defeat_relation(cands, edges): 
+    '''
+    return the Split Cycle winners and the defeat relation
+    '''
+    D = split_cycle_defeat_matrix(margin_matrix_from_edges(cands, edges))
+    sc_winners = [str(c) for cidx, c in enumerate(cands) if not D[:, cidx].any()]
+    defeat_relation = {str(c): {str(c2): bool(D[cidx, c2idx]) for c2idx, c2 in enumerate(cands)} for cidx, c in enumerate(cands) }
+    return sc_winners, defeat_relation
+
+def split_cycle_winners(cands, edges): 
+    return split_cycle(MarginGraph(cands, edges))
+
+def stable_voting_explained(cands, edges, budget = None, checkpoint = None): 
+    '''
+    return the Stable Voting winners, the explanations and None.  
+
+    If the computation uses more than budget seconds of cpu time, stop and return None, the explanations 
+    for the subprofiles resolved so far and a checkpoint from which the computation can be resumed. 
+    '''
+    mem_sv_winners, explanations = checkpoint_to_memo(checkpoint, cands)
+    deadline = time.process_time() + budget if budget is not None else None
+    try: 
+        sv_winners, mem_sv_winners, explanations = stable_voting_with_explanations_(cands, margin_matrix_from_edges(cands, edges), mem_sv_winners = mem_sv_winners, explanations = explanations, deadline = deadline)
+    except BudgetExceeded: 
+        checkpoint = memo_to_checkpoint(mem_sv_winners, explanations, cands)
+        return None, checkpoint["explanations"], checkpoint
+    return sv_winners, explanations, None
+
+def stable_voting_winners(cands, edges): 
+    return stable_voting(MarginGraph(cands, edges))
+
+def splitting_numbers_from_margins(cands, edges): 
+    '''
+    return a dictionary associating the cycles displayed on the outcome page with their splitting numbers
+    '''
+    splitting_numbers = get_splitting_numbers(margin_matrix_from_edges(cands, edges))
+    return {tuple_to_str([cands[c] for c in cycle]): number for _, _, number, cycle in splitting_numbers if cycle is not None}
@@ -1,11 +1,14 @@
 from fastapi import APIRouter, HTTPException, BackgroundTasks
 from messages.models import ContactFormMessage, VoterEmailsData, OwnerEmailData
 from typing import Optional  # Add this import if missing
+import logging
 
 from messages.manage import send_contact_form_email, send_emails_to_voters, send_email_to_owner
 
 router = APIRouter()
 
+logger = logging.getLogger(__name__)
+
 '''
 /emails/sendmessage
 /emails/contact_form
@@ -15,9 +18,7 @@ router = APIRouter()
 
 @router.post("/emails/send_contact_form", tags=["emails"])
 async def sendmessage(contact_form_message: ContactFormMessage, background_tasks: BackgroundTasks, owner_id:Optional[str] = None, voter_id:str = None):
-    
-    print("send contact form message to stablevoting.org@gmail.com")
-    
+    logger.info("send contact form message")
     response = await send_contact_form_email(contact_form_message, background_tasks, voter_id, owner_id)
 
     if response is not None and "error" not in response.keys():
@@ -33,8 +34,7 @@ async def sendmessage(contact_form_message: ContactFormMessage, background_tasks
 
 @router.post("/emails/send_to_voters/{id}", tags=["emails"])
 async def send_voter_emails(id, emails_data: VoterEmailsData, background_tasks: BackgroundTasks, oid:Optional[str] = None):
-    print(emails_data)
-    print("send emails to voters")
+    logger.info("send emails to voters", extra={"poll_id": id, "num_emails": len(emails_data.emails)})
     response = await send_emails_to_voters(emails_data, id, background_tasks, oid)
     if response is not None and "error" not in response.keys():
         return response
@@ -49,8 +49,7 @@ async def send_voter_emails(id, emails_data: VoterEmailsData, background_tasks:
 
 @router.post("/emails/send_to_owner/{id}", tags=["emails"])
 async def send_owner_email(id, emails_data: OwnerEmailData, background_tasks: BackgroundTasks, oid:Optional[str] = None):
-    print(emails_data)
-    print("send email to owner")
+    logger.info("send email to owner", extra={"poll_id": id})
     response = await send_email_to_owner(emails_data, id, background_tasks, oid)
     if response is not None and "error" not in response.keys():
         return response
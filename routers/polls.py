@@ -2,14 +2,26 @@ from fastapi import APIRouter, HTTPException, BackgroundTasks, File, UploadFile
 from fastapi.responses import StreamingResponse  # ADD THIS
 from typing import Optional
 from io import BytesIO  # ADD THIS
+import logging
 
 from bson import ObjectId
-from polls.manage import create_poll, update_poll, delete_poll, submit_ballot, delete_ballot, add_rankings, poll_outcome, poll_information, submitted_ranking_information, poll_ranking_information, demo_poll_outcome, delete_voter, regenerate_voter_link, delete_all_ballots, delete_ballot, resend_voter_email
-from polls.models import CreatePoll, UpdatePoll, PollInfo,  Ballot, PollRankingInfo, RankingsInfo, OutcomeInfo, DemoRankingsInput
+from polls.manage import create_poll, update_poll, delete_poll, submit_ballot, delete_ballot, add_rankings, poll_outcome, poll_information, submitted_ranking_information, poll_ranking_information, demo_poll_outcome, delete_voter, regenerate_voter_link, delete_all_ballots, delete_ballot, resend_voter_email, bulk_import_progress, invitation_progress, delete_voters, regenerate_voter_links, resend_voter_emails
+from polls.models import CreatePoll, UpdatePoll, PollInfo,  Ballot, PollRankingInfo, RankingsInfo, OutcomeInfo, DemoRankingsInput, VoterIds, VoterEmails
 from polls.qr_utils import generate_poll_qr_code  # ADD THIS (note the dot for relative import)
+from polls.compute import ComputeUnavailable
 
 router = APIRouter()
 
+logger = logging.getLogger(__name__)
+
+
+def compute_unavailable(e: ComputeUnavailable):
+    return HTTPException(
+        status_code = 503,
+        detail = "The server is busy computing other outcomes, please try again later.",
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
 '''
 /poll/create
 /poll/1234?include_ranking='blah...'
@@ -30,19 +42,18 @@ async def create_a_poll(poll_data: CreatePoll, background_tasks: BackgroundTasks
     '''
     create a poll
     '''
-    print("POLL DATA")
-    print(poll_data)
     response = await create_poll(background_tasks, poll_data)
-    print("returning ", response)
+    logger.info("poll created", extra={
+        "poll_id": response.get("id") if response else None, 
+        "num_candidates": len(poll_data.candidates), 
+        "is_private": poll_data.is_private})
     if response:
         return response
     raise HTTPException(400, "Something went wrong")
 
 @router.post("/polls/update/{id}", tags=["polls"])
 async def update_a_poll(id, background_tasks: BackgroundTasks, poll_data: UpdatePoll, oid:Optional[str] = None):
-    print("update a poll ", id)
-    print("oid ", oid)
-    print("poll_data ", poll_data)
+    logger.info("update poll", extra={"poll_id": id})
     response = await update_poll(id, oid, poll_data, background_tasks)
 
     if response is not None and "error" not in response.keys():
@@ -58,8 +69,7 @@ async def update_a_poll(id, background_tasks: BackgroundTasks, poll_data: Update
 
 @router.delete("/polls/delete/{id}",  tags=["polls"])
 async def delete_a_poll(id, oid:Optional[str]=None):
-    print("delete poll ", id)
-    print("oid ", oid)
+    logger.info("delete poll", extra={"poll_id": id})
     
     response = await delete_poll(id, oid)
 
@@ -76,9 +86,6 @@ async def delete_a_poll(id, oid:Optional[str]=None):
 
 @router.get("/polls/submitted_rankings/{id}",  tags=["polls"])
 async def get_submitted_ranking_information(id, oid:Optional[str]=None) -> RankingsInfo:
-    print("getting poll data for ", id)
-    print("with vid  ", oid)
-    
     response = await submitted_ranking_information(id,  oid)
 
     if response is not None and "error" not in response.keys():
@@ -93,9 +100,6 @@ async def get_submitted_ranking_information(id, oid:Optional[str]=None) -> Ranki
 
 @router.get("/polls/data/{id}",  tags=["polls"])
 async def get_poll(id, oid:Optional[str]=None) -> PollInfo:
-    print("getting poll data for ", id)
-    print("with oid  ", oid)
-    
     response = await poll_information(id,  oid)
 
     if response is not None and "error" not in response.keys():
@@ -135,8 +139,6 @@ async def submit_a_ballot(id,
                           vid:Optional[str]=None, 
                           oid:Optional[str]=None, 
                           allowmultiplevote:Optional[str]=None):
-    
-    print("allowmultiplevote", allowmultiplevote)
     response = await submit_ballot(ballot, id, vid, allowmultiplevote)
     if response is not None and "error" not in response.keys():
         return response
@@ -150,8 +152,7 @@ async def submit_a_ballot(id,
 
 @router.delete("/polls/delete_ballot/{id}",  tags=["polls"])
 async def delete_a_ballot(id, vid:Optional[str]=None):
-    print("deleting a ballot for poll ", id)
-    print("vid ", vid)
+    logger.info("delete ballot", extra={"poll_id": id})
     response = await delete_ballot(id, vid)
     
     if response is not None and "error" not in response.keys():
@@ -166,11 +167,35 @@ async def delete_a_ballot(id, vid:Optional[str]=None):
 
 @router.post("/polls/bulk_vote/{id}", description="Upload rankings as a csv file", tags=["polls"])
 async def bulk_add_rankings(id, csv_file: UploadFile = File(...), overwrite: bool=False, oid: Optional[str] = None):
-    print("overwrite")
-    print(overwrite)
-    print(csv_file)
+    logger.info("bulk vote", extra={"poll_id": id, "csv_filename": csv_file.filename, "overwrite": overwrite})
     response = await add_rankings(id, oid, csv_file, overwrite)
-    print(response)
+    if response is not None and "error" not in response.keys():
+        return response
+    elif response is not None:
+        raise HTTPException(
+            status_code=403,
+            detail=response["error"],
+            headers={"X-Error": "Not found"},
+        )
+    raise HTTPException(400, "Something went wrong")
+
+@router.get("/polls/bulk_vote/{id}", description="Progress of the last upload of rankings", tags=["polls"])
+async def bulk_add_rankings_progress(id, oid: Optional[str] = None):
+    response = await bulk_import_progress(id, oid)
+    if response is not None and "error" not in response.keys():
+        return response
+    elif response is not None:
+        raise HTTPException(
+            status_code=403,
+            detail=response["error"],
+            headers={"X-Error": "Not found"},
+        )
+    raise HTTPException(400, "Something went wrong")
+
+
+@router.get("/polls/invitations/{id}", description="Progress of the emails sent to the voters", tags=["polls"])
+async def invitations_progress(id, oid: Optional[str] = None):
+    response = await invitation_progress(id, oid)
     if response is not None and "error" not in response.keys():
         return response
     elif response is not None:
@@ -188,11 +213,10 @@ async def get_poll_outcome(
     oid: Optional[str] = None,  # Fixed: Optional[str] instead of str=None
     vid: Optional[str] = None,  # Fixed: Optional[str] instead of str=None
 ) -> OutcomeInfo:
-    print("get poll outcome for ", id)
-    print("oid ", oid)
-    print("vid ", vid)
-    
-    response = await poll_outcome(id, oid, vid)
+    try:
+        response = await poll_outcome(id, oid, vid)
+    except ComputeUnavailable as e:
+        raise compute_unavailable(e)
 
     if response is not None and "error" not in response.keys():
         return response
@@ -206,9 +230,11 @@ async def get_poll_outcome(
 
 @router.post("/polls/demo_outcome", tags=["polls"])
 async def get_demo_poll_outcome(rankings_data: DemoRankingsInput) -> OutcomeInfo:
-    print("get poll outcome for ", rankings_data)
-    
-    response = await demo_poll_outcome(rankings_data.rankings)
+    logger.debug("demo outcome", extra={"num_rankings": len(rankings_data.rankings)})
+    try:
+        response = await demo_poll_outcome(rankings_data.rankings)
+    except ComputeUnavailable as e:
+        raise compute_unavailable(e)
 
     if response is not None and "error" not in response.keys():
         return response
@@ -251,9 +277,7 @@ async def delete_a_voter(
     oid: Optional[str] = None
 ):
     """Delete a voter from a private poll"""
-    print(f"Deleting voter {voter_id} from poll {poll_id}")
-    print(f"Owner ID: {oid}")
-    
+    logger.info("delete voter", extra={"poll_id": poll_id})
     response = await delete_voter(poll_id, voter_id, oid)
     
     if response is not None and "error" not in response.keys():
@@ -273,9 +297,7 @@ async def delete_all_ballots_endpoint(
     oid: Optional[str] = None
 ):
     """Delete all ballots from a poll"""
-    print(f"Deleting all ballots from poll {id}")
-    print(f"Owner ID: {oid}")
-    
+    logger.info("delete all ballots", extra={"poll_id": id})
     response = await delete_all_ballots(id, oid)
     
     if response is not None and "error" not in response.keys():
@@ -296,9 +318,7 @@ async def regenerate_voter_link_endpoint(
     oid: Optional[str] = None
 ):
     """Generate a new voter ID/link for an existing voter"""
-    print(f"Regenerating link for voter {voter_id} in poll {poll_id}")
-    print(f"Owner ID: {oid}")
-    
+    logger.info("regenerate voter link", extra={"poll_id": poll_id})
     response = await regenerate_voter_link(poll_id, voter_id, oid, background_tasks)
     
     if response is not None and "error" not in response.keys():
@@ -327,9 +347,7 @@ async def resend_voter_email_endpoint(
             detail="Email is required"
         )
     
-    print(f"Resending email to {email} for poll {poll_id}")
-    print(f"Owner ID: {oid}")
-    
+    logger.info("resend voter email", extra={"poll_id": poll_id})
     response = await resend_voter_email(poll_id, email, oid, background_tasks)
     
     if response is not None and "error" not in response.keys():
@@ -340,4 +358,67 @@ async def resend_voter_email_endpoint(
             detail=response["error"],
             headers={"X-Error": "Not authorized"},
         )
-    raise HTTPException(400, "Something went wrong")
\ No newline at end of file
+    raise HTTPException(400, "Something went wrong")
+
+
+@router.post("/polls/voters/{poll_id}/bulk_delete", tags=["polls"])
+async def delete_voters_endpoint(
+    poll_id: str,
+    voters: VoterIds,
+    oid: Optional[str] = None
+):
+    """Delete voters from a private poll"""
+    logger.info("delete voters", extra={"poll_id": poll_id, "num_voters": len(voters.voter_ids)})
+    response = await delete_voters(poll_id, voters.voter_ids, oid)
+
+    if response is not None and "error" not in response.keys():
+        return response
+    elif response is not None:
+        raise HTTPException(
+            status_code=403,
+            detail=response["error"],
+            headers={"X-Error": "Not authorized"},
+        )
+    raise HTTPException(400, "Something went wrong")
+
+
+@router.post("/polls/voters/{poll_id}/bulk_regenerate", tags=["polls"])
+async def regenerate_voter_links_endpoint(
+    poll_id: str,
+    voters: VoterIds,
+    oid: Optional[str] = None
+):
+    """Generate new voter IDs/links for existing voters"""
+    logger.info("regenerate voter links", extra={"poll_id": poll_id, "num_voters": len(voters.voter_ids)})
+    response = await regenerate_voter_links(poll_id, voters.voter_ids, oid)
+
+    if response is not None and "error" not in response.keys():
+        return response
+    elif response is not None:
+        raise HTTPException(
+            status_code=403,
+            detail=response["error"],
+            headers={"X-Error": "Not authorized"},
+        )
+    raise HTTPException(400, "Something went wrong")
+
+
+@router.post("/polls/voters/{poll_id}/bulk_resend", tags=["polls"])
+async def resend_voter_emails_endpoint(
+    poll_id: str,
+    voters: VoterEmails,
+    oid: Optional[str] = None
+):
+    """Resend invitation emails to voters"""
+    logger.info("resend voter emails", extra={"poll_id": poll_id, "num_voters": len(voters.emails)})
+    response = await resend_voter_emails(poll_id, voters.emails, oid)
+
+    if response is not None and "error" not in response.keys():
+        return response
+    elif response is not None:
+        raise HTTPException(
+            status_code=403,
+            detail=response["error"],
+            headers={"X-Error": "Not authorized"},
+        )
+    raise HTTPException(400, "Something went wrong")
@@ -0,0 +1,39 @@
+## Test fixtures
+#
+# The tests run against mongomock_motor, an in-memory stand-in for MongoDB, so they do not
+# need a server.  Each test gets an empty database.
+#
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('SKIP_EMAILS', 'true')
+os.environ.setdefault('ALLOW_MULTIPLE_VOTE_PWD', 'secretpwd')
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+from polls.database import database, DATABASE_NAME
+from polls.compute import compute_service
+
+
+@pytest.fixture
+def db():
+    database.client = AsyncMongoMockClient()
+    yield database.client[DATABASE_NAME]
+    database.client = None
+
+
+@pytest.fixture(scope="session", autouse=True)
+def stop_compute_service():
+    yield
+    compute_service.shutdown()
+
+
+class BackgroundTasks:
+    def __init__(self):
+        self.tasks = []
+
+    def add_task(self, fn, *args, **kwargs):
+        self.tasks.append((fn, args, kwargs))
@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+from bson import ObjectId
+
+import polls.manage as manage
+from polls.models import CreatePoll, Ballot
+
+
+async def create_public_poll(**options):
+    await manage.ensure_indexes()
+    r = await manage.create_poll(None, CreatePoll(title="t", candidates=["A", "B"], closing_datetime=None, timezone=None, **options))
+    return r["id"]
+
+
+def vote(pid, ip, ranking={"A": 1}, pwd=None):
+    return manage.submit_ballot(Ballot(ranking=ranking, ip=ip), pid, None, pwd)
+
+
+async def num_ballots(pid):
+    document = await manage.db.find_one({"_id": ObjectId(pid)})
+    return document["tally"]["num_ballots"], await manage.ballots_db.count_documents({"poll_id": ObjectId(pid)})
+
+
+@pytest.fixture
+def ip_hash_salt(monkeypatch):
+    monkeypatch.setattr(manage, "IP_HASH_SALT", "s3cret")
+
+
+def test_one_ballot_per_ip(db):
+    async def run():
+        pid = await create_public_poll()
+        assert await vote(pid, "1.1.1.1") == {"success": "Ballot submitted."}
+        assert await vote(pid, "1.1.1.1") == {"error": "Already submitted a ballot."}
+        assert await vote(pid, "n/a") == {"success": "Ballot submitted."}
+        assert await vote(pid, "n/a") == {"success": "Ballot submitted."}
+        assert await num_ballots(pid) == (3, 3)
+    asyncio.run(run())
+
+
+def test_ballot_with_password_blocks_the_ip(db):
+    async def run():
+        pid = await create_public_poll()
+        assert await vote(pid, "9.9.9.9", pwd="secretpwd") == {"success": "Ballot submitted."}
+        assert await vote(pid, "9.9.9.9", pwd="secretpwd") == {"success": "Ballot submitted."}
+        assert await vote(pid, "9.9.9.9") == {"error": "Already submitted a ballot."}
+        assert await num_ballots(pid) == (2, 2)
+    asyncio.run(run())
+
+
+def test_ballot_from_when_multiple_votes_were_allowed_blocks_the_ip(db):
+    async def run():
+        pid = await create_public_poll(allow_multiple_votes=True)
+        assert await vote(pid, "9.9.9.9") == {"success": "Ballot submitted."}
+        await manage.db.update_one({"_id": ObjectId(pid)}, {"$set": {"allow_multiple_votes": False}})
+        assert await vote(pid, "9.9.9.9") == {"error": "Already submitted a ballot."}
+    asyncio.run(run())
+
+
+def test_hashed_ips(db, ip_hash_salt):
+    async def run():
+        pid = await create_public_poll()
+        assert await vote(pid, "5.5.5.5") == {"success": "Ballot submitted."}
+        assert await vote(pid, "5.5.5.5") == {"error": "Already submitted a ballot."}
+        b = await manage.ballots_db.find_one({"poll_id": ObjectId(pid)})
+        assert b["ip"] == manage.hash_ip("5.5.5.5") != "5.5.5.5"
+        assert b["dedup_key"] == f"ip:{b['ip']}"
+        assert await vote(pid, None) == {"success": "Ballot submitted."}
+        assert await num_ballots(pid) == (2, 2)
+    asyncio.run(run())
+
+
+def test_ballots_from_before_hashing_block_the_ip(db, monkeypatch):
+    async def run():
+        pid = await create_public_poll()
+        assert await vote(pid, "5.5.5.5") == {"success": "Ballot submitted."}
+        monkeypatch.setattr(manage, "IP_HASH_SALT", "s3cret")
+        assert await vote(pid, "5.5.5.5") == {"error": "Already submitted a ballot."}
+    asyncio.run(run())
+
+
+def test_concurrent_ballots_from_the_same_ips(db):
+    async def run():
+        pid = await create_public_poll()
+        results = await asyncio.gather(*[vote(pid, f"1.2.3.{i % 50}") for i in range(1000)])
+        assert sum("success" in r for r in results) == 50
+        assert await num_ballots(pid) == (50, 50)
+    asyncio.run(run())
+
+
+def test_concurrent_ballots_of_private_voters(db):
+    async def run():
+        await manage.ensure_indexes()
+        r = await manage.create_poll(None, CreatePoll(
+            title="t", candidates=["A", "B"], closing_datetime=None, timezone=None,
+            is_private=True, voter_emails=[f"v{i}@x.org" for i in range(100)]))
+        pid = r["id"]
+        vids = [v["voter_id"] async for v in manage.voters_db.find({"poll_id": ObjectId(pid)})]
+        # every voter votes 10 times at once, each voter keeps one ballot
+        results = await asyncio.gather(*[
+            manage.submit_ballot(Ballot(ranking={"A": 1} if i % 2 else {"B": 1}, ip="n/a"), pid, vids[i % 100], None)
+            for i in range(1000)])
+        assert all("success" in r for r in results)
+        assert await num_ballots(pid) == (100, 100)
+        document = await manage.db.find_one({"_id": ObjectId(pid)})
+        ballots = await manage.ballots_db.find({"poll_id": ObjectId(pid)}).to_list(None)
+        assert document["tally"] == manage.tally_from_ballots(ballots, manage.candidate_indices(document))
+        assert await manage.submit_ballot(Ballot(ranking={"A": 1}, ip="n/a"), pid, "nope", None) == {"error": "The poll is private."}
+    asyncio.run(run())
+
+
+def test_hashed_ips_of_private_voters(db, ip_hash_salt):
+    async def run():
+        await manage.ensure_indexes()
+        r = await manage.create_poll(None, CreatePoll(
+            title="t", candidates=["A", "B"], closing_datetime=None, timezone=None,
+            is_private=True, voter_emails=["v@x.org"]))
+        vid = (await manage.voters_db.find_one({"poll_id": ObjectId(r["id"])}))["voter_id"]
+        assert await manage.submit_ballot(Ballot(ranking={"A": 1}, ip="5.5.5.5"), r["id"], vid, None) == {"success": "Ballot submitted."}
+        b = await manage.ballots_db.find_one({"poll_id": ObjectId(r["id"])})
+        assert b["ip"] == manage.hash_ip("5.5.5.5") != "5.5.5.5"
+    asyncio.run(run())
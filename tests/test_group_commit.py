@@ -0,0 +1,125 @@
+import asyncio
+import time
+
+from bson import ObjectId
+
+import polls.manage as manage
+from polls.database import database
+from polls.group_commit import vote_group_commit
+from polls.models import CreatePoll, Ballot
+
+
+async def create_poll(**options):
+    await manage.ensure_indexes()
+    r = await manage.create_poll(None, CreatePoll(title="t", candidates=["A", "B", "C"], closing_datetime=None, timezone=None, **options))
+    return r["id"]
+
+
+async def assert_tally_matches_ballots(pid):
+    document = await manage.find_poll(pid, manage.TALLY_PROFILE)
+    ballots = await manage.find_ballots(pid)
+    assert await manage.find_tally(document) == manage.tally_from_ballots(ballots, manage.candidate_indices(document))
+    return len(ballots)
+
+
+def test_failed_public_ballot_does_not_fail_the_group(db, monkeypatch):
+    hash_ip = manage.hash_ip
+
+    def failing_hash_ip(ip):
+        if ip == "6.6.6.6":
+            raise ValueError(ip)
+        return hash_ip(ip)
+
+    monkeypatch.setattr(manage, "hash_ip", failing_hash_ip)
+
+    async def run():
+        pid = await create_poll()
+        results = await asyncio.gather(*[
+            manage.submit_ballot(Ballot(ranking={"A": 1}, ip=ip), pid, None, None)
+            for ip in ["1.1.1.1", "6.6.6.6", "2.2.2.2"]])
+        assert results == [
+            {"success": "Ballot submitted."},
+            {"error": "The ballot could not be saved."},
+            {"success": "Ballot submitted."}]
+        assert await assert_tally_matches_ballots(pid) == 2
+    asyncio.run(run())
+
+
+def test_failed_private_ballot_does_not_fail_the_group(db):
+    async def run():
+        await manage.ensure_indexes()
+        r = await manage.create_poll(None, CreatePoll(
+            title="t", candidates=["A", "B"], closing_datetime=None, timezone=None,
+            is_private=True, voter_emails=["a@x.org", "b@x.org", "c@x.org"]))
+        pid = r["id"]
+        vids = [v["voter_id"] async for v in manage.voters_db.find({"poll_id": ObjectId(pid)})]
+        find_one_and_update = database.collection("Ballots").find_one_and_update
+
+        async def failing_find_one_and_update(filter, *args, **kwargs):
+            if filter.get("voter_id") == vids[1]:
+                raise RuntimeError("write failed")
+            return await find_one_and_update(filter, *args, **kwargs)
+
+        manage.ballots_db.find_one_and_update = failing_find_one_and_update
+        try:
+            results = await asyncio.gather(*[
+                manage.submit_ballot(Ballot(ranking={"A": 1}, ip="n/a"), pid, vid, None) for vid in vids])
+        finally:
+            del manage.ballots_db.find_one_and_update
+        assert results == [
+            {"success": "Ballot submitted."},
+            {"error": "The ballot could not be saved."},
+            {"success": "Ballot submitted."}]
+        assert await assert_tally_matches_ballots(pid) == 2
+    asyncio.run(run())
+
+
+def test_failed_bulk_write_resets_the_tally(db):
+    async def run():
+        pid = await create_poll()
+        assert await manage.submit_ballot(Ballot(ranking={"A": 1}, ip="1.1.1.1"), pid, None, None) == {"success": "Ballot submitted."}
+        bulk_write = database.collection("Ballots").bulk_write
+
+        async def failing_bulk_write(writes, **kwargs):
+            # the first ballot is written before the connection fails
+            await bulk_write(writes[:1], **kwargs)
+            raise ConnectionError("connection lost")
+
+        manage.ballots_db.bulk_write = failing_bulk_write
+        try:
+            results = await asyncio.gather(*[
+                manage.submit_ballot(Ballot(ranking={"B": 1}, ip=f"2.2.2.{i}"), pid, None, None) for i in range(3)])
+        finally:
+            del manage.ballots_db.bulk_write
+        assert all(r == {"error": "The ballot could not be saved."} for r in results)
+        assert (await manage.db.find_one({"_id": ObjectId(pid)})).get("tally") is None
+        assert await assert_tally_matches_ballots(pid) == 2
+        assert await manage.submit_ballot(Ballot(ranking={"A": 1}, ip="3.3.3.3"), pid, None, None) == {"success": "Ballot submitted."}
+        assert await assert_tally_matches_ballots(pid) == 3
+    asyncio.run(run())
+
+
+def test_burst_of_votes(db):
+    """500 votes in 5 seconds, 50 of them from an ip that already voted, are written in groups."""
+    async def run():
+        pid = await create_poll()
+        groups, items = vote_group_commit.groups, vote_group_commit.items
+
+        async def vote(i):
+            await asyncio.sleep(i * 0.01)
+            ranking = {"A": 1, "B": 2} if i % 2 else {"C": 1}
+            return await manage.submit_ballot(Ballot(ranking=ranking, ip=f"10.0.{i % 450 // 256}.{i % 450 % 256}"), pid, None, None)
+
+        started_at = time.perf_counter()
+        results = await asyncio.gather(*[vote(i) for i in range(500)])
+        elapsed = time.perf_counter() - started_at
+        num_groups = vote_group_commit.groups - groups
+
+        assert sum(r == {"success": "Ballot submitted."} for r in results) == 450
+        assert sum(r == {"error": "Already submitted a ballot."} for r in results) == 50
+        assert vote_group_commit.items - items == 500
+        assert num_groups < 500
+        # the votes are spread over 5 seconds and none of them waits long for its group
+        assert elapsed < 10
+        assert await assert_tally_matches_ballots(pid) == 450
+    asyncio.run(run())
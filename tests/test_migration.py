@@ -0,0 +1,126 @@
+import asyncio
+import datetime
+
+import pytest
+from bson import ObjectId
+
+import polls.manage as manage
+from polls.database import database
+
+
+async def create_legacy_poll(num_ballots, num_voters=0):
+    """A poll document as stored before the ballots and the voters had their own collections."""
+    voter_ids = [f"voter{i}" for i in range(num_voters)]
+    result = await manage.db.insert_one({
+        "title": "legacy",
+        "description": None,
+        "hide_description": True,
+        "candidates": ["A", "B"],
+        "is_private": num_voters > 0,
+        "owner_id": str(ObjectId()),
+        "show_rankings": True,
+        "closing_datetime": None,
+        "timezone": None,
+        "can_view_outcome_before_closing": True,
+        "show_outcome": True,
+        "allow_multiple_votes": False,
+        "is_completed": False,
+        "result": None,
+        "creation_dt": "January 01, 2024 @ 12:00",
+        "ballots": [{"ranking": {"A": 1} if i % 3 else {"B": 1}, "ip": f"1.1.1.{i % 5}", "voter_id": None} for i in range(num_ballots)],
+        "voter_ids": voter_ids,
+        "voter_email_map": {vid: f"{vid}@x.org" for vid in voter_ids},
+        "email_send_counts": {f"{vid}@x.org": 2 for vid in voter_ids},
+    })
+    return str(result.inserted_id)
+
+
+async def assert_migrated(pid, num_ballots, num_voters=0):
+    document = await manage.db.find_one({"_id": ObjectId(pid)})
+    assert "ballots" not in document and "voter_ids" not in document
+    assert await manage.ballots_db.count_documents({"poll_id": ObjectId(pid)}) == num_ballots
+    assert await manage.voters_db.count_documents({"poll_id": ObjectId(pid)}) == num_voters
+    if num_voters == 0:
+        # the first ballot from each ip keeps the ip from voting again
+        assert len(await manage.ballots_db.distinct("dedup_key", {"poll_id": ObjectId(pid)})) == min(num_ballots, 5)
+
+
+def test_concurrent_migrations_insert_the_ballots_once(db):
+    async def run():
+        await manage.ensure_indexes()
+        pid = await create_legacy_poll(30, num_voters=4)
+        await asyncio.gather(*[manage.find_poll(pid) for _ in range(5)])
+        await assert_migrated(pid, 30, num_voters=4)
+        assert (await manage.voters_db.find_one({"voter_id": "voter0"}))["emails_sent"] == 2
+        assert await manage.count_ballots(await manage.find_poll(pid)) == 30
+
+        pid = await create_legacy_poll(30)
+        await asyncio.gather(*[manage.find_poll(pid) for _ in range(5)])
+        await assert_migrated(pid, 30)
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("collection", ["Ballots", "Voters"])
+def test_interrupted_migration_is_done_again(db, collection):
+    async def run():
+        await manage.ensure_indexes()
+        pid = await create_legacy_poll(30, num_voters=4)
+        target, field = (manage.ballots_db, "ballots") if collection == "Ballots" else (manage.voters_db, "voter_ids")
+        insert_many = database.collection(collection).insert_many
+
+        async def interrupted_insert_many(documents, **kwargs):
+            # half of the documents are inserted before the connection fails
+            await insert_many(documents[:len(documents) // 2], **kwargs)
+            raise ConnectionError("connection lost")
+
+        target.insert_many = interrupted_insert_many
+        try:
+            with pytest.raises(ConnectionError):
+                await manage.find_poll(pid)
+        finally:
+            del target.insert_many
+        assert field in await manage.db.find_one({"_id": ObjectId(pid)})
+
+        await manage.find_poll(pid)
+        await assert_migrated(pid, 30, num_voters=4)
+    asyncio.run(run())
+
+
+def test_closing_datetimes_stored_as_strings_are_migrated_once(db):
+    async def run():
+        await manage.ensure_indexes()
+        pid = await create_legacy_poll(0)
+        await manage.db.update_one({"_id": ObjectId(pid)}, {"$set": {"closing_datetime": "2024-01-02T12:00:00-05:00"}})
+        before = await manage.poll_information(pid, None)
+        await manage.run_migrations()
+        document = await manage.db.find_one({"_id": ObjectId(pid)})
+        assert document["closing_datetime"] == datetime.datetime(2024, 1, 2, 17, 0)
+        assert (await manage.migrations_db.find_one({"_id": "closing_datetimes"}))["count"] == 1
+        # the poll reads the same and is found by the index on the closing dates
+        assert await manage.poll_information(pid, None) == before
+        assert await manage.db.count_documents({"closing_datetime": {"$lt": datetime.datetime(2024, 2, 1)}}) == 1
+
+        # a completed migration is not run again
+        await manage.db.update_one({"_id": ObjectId(pid)}, {"$set": {"closing_datetime": "2024-01-02T12:00:00-05:00"}})
+        await manage.run_migrations()
+        assert isinstance((await manage.db.find_one({"_id": ObjectId(pid)}))["closing_datetime"], str)
+    asyncio.run(run())
+
+
+def test_migrations_move_the_embedded_ballots_and_backfill_the_dedup_keys(db):
+    async def run():
+        await manage.ensure_indexes()
+        pid = await create_legacy_poll(30)
+        private_pid = await create_legacy_poll(30, num_voters=4)
+        # ballots migrated before the first ballot from each ip was given a dedup_key
+        migrated_pid = await create_legacy_poll(30)
+        await manage.find_poll(migrated_pid)
+        await manage.ballots_db.update_many({"poll_id": ObjectId(migrated_pid)}, {"$unset": {"dedup_key": ""}})
+
+        await manage.run_migrations()
+        await assert_migrated(pid, 30)
+        await assert_migrated(private_pid, 30, num_voters=4)
+        await assert_migrated(migrated_pid, 30)
+        assert (await manage.migrations_db.find_one({"_id": "embedded_ballots"}))["count"] == 2
+        assert (await manage.migrations_db.find_one({"_id": "ip_dedup_keys"}))["count"] == 5
+    asyncio.run(run())
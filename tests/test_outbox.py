@@ -0,0 +1,113 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import messages.conf as conf
+import messages.outbox as outbox
+
+
+class FakePostmark(BaseHTTPRequestHandler):
+    """
+    Answers the batch API of Postmark: emails to an address containing "inactive" are rejected for
+    good, emails to an address containing "throttled" are rejected for now, the others are accepted.
+    Fails every request while the server's fail flag is set.
+    """
+
+    def do_POST(self):
+        messages = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.server.fail:
+            self.send_response(500)
+            self.end_headers()
+            return
+        self.server.batches.append(messages)
+        responses = []
+        for i, message in enumerate(messages):
+            error_code = 406 if "inactive" in message["To"] else 429 if "throttled" in message["To"] else 0
+            responses.append({"ErrorCode": error_code, "Message": "OK" if error_code == 0 else "rejected",
+                              "MessageID": f"{len(self.server.batches)}-{i}", "To": message["To"]})
+        data = json.dumps(responses).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def postmark(db, monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakePostmark)
+    server.batches, server.fail = [], False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(conf, "POSTMARK_API_URL", f"http://127.0.0.1:{server.server_port}/")
+    monkeypatch.setattr(conf, "SKIP_EMAILS", False)
+    monkeypatch.setattr(outbox, "SKIP_EMAILS", False)
+    monkeypatch.setattr(outbox, "OUTBOX_RATE_LIMIT", 1e9)
+    monkeypatch.setattr(outbox, "OUTBOX_BASE_BACKOFF", 0)
+    monkeypatch.setattr(outbox, "OUTBOX_MAX_ATTEMPTS", 3)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+async def count_by_status():
+    return {status: await outbox.outbox_db.count_documents({"status": status})
+            for status in [outbox.PENDING, outbox.SENDING, outbox.SENT, outbox.DEAD]}
+
+
+def test_emails_are_sent_in_batches(postmark):
+    async def run():
+        await outbox.outbox.ensure_indexes()
+        emails = [outbox.email_message(f"v{i}@x.org", "s", "<p>h</p>") for i in range(1200)]
+        emails += [outbox.email_message("inactive@x.org", "s", "h"), outbox.email_message("throttled@x.org", "s", "h")]
+        await outbox.queue_emails(emails)
+        await outbox.outbox.drain()
+
+        # the throttled email is sent again alone, until it runs out of attempts
+        assert [len(batch) for batch in postmark.batches] == [500, 500, 202, 1, 1]
+        assert await count_by_status() == {"pending": 0, "sending": 0, "sent": 1200, "dead": 2}
+        inactive = await outbox.outbox_db.find_one({"to": "inactive@x.org"})
+        assert (inactive["attempts"], inactive["last_error_code"]) == (1, 406)
+        throttled = await outbox.outbox_db.find_one({"to": "throttled@x.org"})
+        assert (throttled["attempts"], throttled["last_error_code"]) == (3, 429)
+        sent = await outbox.outbox_db.find_one({"to": "v1@x.org"})
+        assert sent["message_id"] == "1-1" and "html_body" not in sent
+    asyncio.run(run())
+
+
+def test_templated_emails(postmark):
+    async def run():
+        title = outbox.escape_template("Costs $5 $link")
+        await outbox.queue_templated_emails(
+            f"Vote in {title}", f'<p>{title}</p><a href="$link">vote</a>', ["a@x.org", "b@x.org"],
+            [{"link": "https://x.org/vote/a"}, {"link": "https://x.org/vote/b"}], poll_id="p")
+        await outbox.outbox.drain()
+        messages = {m["To"]: m for batch in postmark.batches for m in batch}
+        assert messages["b@x.org"]["Subject"] == "Vote in Costs $5 $link"
+        assert messages["b@x.org"]["HtmlBody"] == '<p>Costs $5 $link</p><a href="https://x.org/vote/b">vote</a>'
+        assert "Costs $5 $link" in messages["a@x.org"]["TextBody"]
+        assert await outbox.poll_email_progress("p") == {"pending": 0, "sending": 0, "sent": 2, "dead": 0, "total": 2}
+    asyncio.run(run())
+
+
+def test_failed_batch_is_retried(postmark, monkeypatch):
+    monkeypatch.setattr(outbox, "OUTBOX_BASE_BACKOFF", 60)
+
+    async def run():
+        await outbox.queue_emails([outbox.email_message(f"v{i}@x.org", "s", "h") for i in range(3)])
+        postmark.fail = True
+        assert await outbox.outbox.drain() == 3
+        assert await count_by_status() == {"pending": 3, "sending": 0, "sent": 0, "dead": 0}
+        assert (await outbox.outbox_db.find_one({}))["attempts"] == 1
+        # not due until the backoff has passed
+        postmark.fail = False
+        assert await outbox.outbox.drain() == 0
+        await outbox.outbox_db.update_many({}, {"$set": {"next_attempt_at": outbox.utcnow()}})
+        assert await outbox.outbox.drain() == 3
+        assert await count_by_status() == {"pending": 0, "sending": 0, "sent": 3, "dead": 0}
+    asyncio.run(run())
@@ -0,0 +1,183 @@
+import asyncio
+import datetime
+import itertools
+import random
+
+import pytest
+from bson import ObjectId
+
+import polls.manage as manage
+from polls.compute import ComputeTimeout
+from polls.voting import stable_voting_explained, stable_voting_with_explanations_, margin_matrix_from_edges, memo_to_checkpoint
+from polls.models import CreatePoll, UpdatePoll, Ballot, OutcomeInfo
+
+# a cycle, so that the Stable Voting winner is selected at random when the poll closes
+CYCLE = [{"A": 1, "B": 2, "C": 3}, {"B": 1, "C": 2, "A": 3}, {"C": 1, "A": 2, "B": 3}]
+
+
+async def create_tied_poll():
+    await manage.ensure_indexes()
+    r = await manage.create_poll(None, CreatePoll(title="t", candidates=["A", "B", "C"], closing_datetime=None, timezone="UTC"))
+    await asyncio.gather(*[
+        manage.submit_ballot(Ballot(ranking=ranking, ip=f"1.1.1.{i}"), r["id"], None, None)
+        for i, ranking in enumerate(CYCLE)])
+    return r["id"], r["owner_id"]
+
+
+def test_outcome_of_open_poll_is_saved(db):
+    async def run():
+        pid, oid = await create_tied_poll()
+        outcome = await manage.poll_outcome(pid, oid, None)
+        assert outcome["sv_winners"] == ["0", "1", "2"]
+        assert outcome["selected_sv_winner"] is None
+        hits = manage.outcome_cache.hits
+        assert (await manage.poll_outcome(pid, oid, None))["sv_winners"] == ["0", "1", "2"]
+        assert manage.outcome_cache.hits == hits + 1
+    asyncio.run(run())
+
+
+def test_completed_poll_does_not_serve_open_result(db):
+    async def run():
+        pid, oid = await create_tied_poll()
+        assert (await manage.poll_outcome(pid, oid, None))["selected_sv_winner"] is None
+        await manage.update_poll(pid, oid, UpdatePoll(is_completed=True), None)
+        selected = (await manage.poll_outcome(pid, oid, None))["selected_sv_winner"]
+        assert selected in ["0", "1", "2"]
+        # the result saved when the poll closed is kept
+        for _ in range(3):
+            assert (await manage.poll_outcome(pid, oid, None))["selected_sv_winner"] == selected
+    asyncio.run(run())
+
+
+def test_poll_closed_by_time_does_not_serve_open_result(db):
+    async def run():
+        pid, oid = await create_tied_poll()
+        assert (await manage.poll_outcome(pid, oid, None))["selected_sv_winner"] is None
+        # the closing time passes without any change to the ballots
+        await db["Polls"].update_one(
+            {"_id": ObjectId(pid)},
+            {"$set": {"closing_datetime": datetime.datetime.utcnow() - datetime.timedelta(minutes=1)}})
+        outcome = await manage.poll_outcome(pid, oid, None)
+        assert outcome["is_closed"]
+        assert outcome["selected_sv_winner"] in ["0", "1", "2"]
+        assert (await db["Polls"].find_one({"_id": ObjectId(pid)}))["is_completed"]
+        assert (await manage.poll_outcome(pid, oid, None))["selected_sv_winner"] == outcome["selected_sv_winner"]
+    asyncio.run(run())
+
+
+@pytest.fixture
+def explanations_timeout(monkeypatch):
+    """Stable Voting with explanations runs out of cpu time until the fixture is turned off."""
+    run = manage.compute_service.run
+    state = {"timeout": True}
+
+    async def run_with_timeout(fn, *args, **kwargs):
+        if fn is stable_voting_explained and state["timeout"]:
+            raise ComputeTimeout()
+        return await run(fn, *args, **kwargs)
+
+    monkeypatch.setattr(manage.compute_service, "run", run_with_timeout)
+    return state
+
+
+def test_outcome_after_timeout_is_not_saved(db, explanations_timeout):
+    async def run():
+        pid, oid = await create_tied_poll()
+        outcome = await manage.poll_outcome(pid, oid, None)
+        assert outcome["sv_winners"] == ["0", "1", "2"]
+        assert outcome["explanations"] == {} and not outcome["explanations_complete"]
+        # the routes return an OutcomeInfo, which keeps the flag
+        assert not OutcomeInfo(**outcome).explanations_complete
+        hits = manage.outcome_cache.hits
+        assert not (await manage.poll_outcome(pid, oid, None))["explanations_complete"]
+        assert manage.outcome_cache.hits == hits
+
+        explanations_timeout["timeout"] = False
+        outcome = await manage.poll_outcome(pid, oid, None)
+        assert outcome["explanations"] != {} and outcome["explanations_complete"]
+    asyncio.run(run())
+
+
+def test_completed_poll_after_timeout_keeps_its_winner(db, explanations_timeout):
+    async def run():
+        pid, oid = await create_tied_poll()
+        await manage.update_poll(pid, oid, UpdatePoll(is_completed=True), None)
+        outcome = await manage.poll_outcome(pid, oid, None)
+        assert not outcome["explanations_complete"]
+        selected = outcome["selected_sv_winner"]
+        assert selected in ["0", "1", "2"]
+
+        explanations_timeout["timeout"] = False
+        outcome = await manage.poll_outcome(pid, oid, None)
+        assert outcome["explanations"] != {} and outcome["explanations_complete"]
+        assert outcome["selected_sv_winner"] == selected
+    asyncio.run(run())
+
+
+def test_large_checkpoint_is_trimmed(db, monkeypatch):
+    rng = random.Random(0)
+    cands = [str(i) for i in range(12)]
+    edges = [(c1, c2, m) if rng.random() < 0.5 else (c2, c1, m)
+             for c1, c2, m in [(c1, c2, rng.randrange(2, 60, 2)) for c1, c2 in itertools.combinations(cands, 2)]]
+    sv_winners, explanations, _ = stable_voting_explained(cands, edges)
+    # a checkpoint with every subprofile resolved by the computation
+    _, mem_sv_winners, memo_explanations = stable_voting_with_explanations_(cands, margin_matrix_from_edges(cands, edges))
+    sv_checkpoint = memo_to_checkpoint(mem_sv_winners, memo_explanations, cands)
+    max_bytes = manage.bson_size(sv_checkpoint) // 4
+    monkeypatch.setattr(manage, "SV_CHECKPOINT_MAX_BYTES", max_bytes)
+
+    async def run():
+        result = await manage.db.insert_one({"revision": 3})
+        await manage.save_sv_checkpoint({"_id": result.inserted_id, "revision": 3}, sv_checkpoint)
+        saved = (await manage.db.find_one({"_id": result.inserted_id}))["sv_checkpoint"]
+        assert 0 < len(saved["mem_sv_winners"]) < len(sv_checkpoint["mem_sv_winners"])
+        assert manage.bson_size(saved) <= max_bytes + 100
+        # the computation resumes from the subprofiles that were kept
+        resumed = stable_voting_explained(cands, edges, None, saved)
+        assert resumed[0] == sv_winners and resumed[1] == explanations
+    asyncio.run(run())
+
+
+def test_large_explanations_are_trimmed(db, monkeypatch):
+    async def run():
+        pid, oid = await create_tied_poll()
+        explanations = (await manage.poll_outcome(pid, oid, None))["explanations"]
+        assert len(explanations) > 1
+        max_bytes = manage.bson_size({"0,1,2": explanations["0,1,2"]})
+        monkeypatch.setattr(manage, "EXPLANATIONS_MAX_BYTES", max_bytes)
+
+        pid, oid = await create_tied_poll()
+        outcome = await manage.poll_outcome(pid, oid, None)
+        assert outcome["explanations_trimmed"] and outcome["explanations_complete"]
+        # the explanation of the whole profile is kept
+        assert outcome["explanations"] == {"0,1,2": explanations["0,1,2"]}
+    asyncio.run(run())
+
+
+def test_outcome_too_large_is_not_saved(db, monkeypatch):
+    monkeypatch.setattr(manage, "RESULT_MAX_BYTES", 100)
+
+    async def run():
+        pid, oid = await create_tied_poll()
+        assert (await manage.poll_outcome(pid, oid, None))["sv_winners"] == ["0", "1", "2"]
+        assert (await manage.db.find_one({"_id": ObjectId(pid)}))["result"] is None
+
+        await manage.update_poll(pid, oid, UpdatePoll(is_completed=True), None)
+        selected = (await manage.poll_outcome(pid, oid, None))["selected_sv_winner"]
+        # only the selected winner is saved, the rest of the outcome is computed again for each view
+        assert (await manage.db.find_one({"_id": ObjectId(pid)}))["result"] == {"selected_sv_winner": selected, "explanations_complete": False}
+        for _ in range(3):
+            outcome = await manage.poll_outcome(pid, oid, None)
+            assert outcome["selected_sv_winner"] == selected and outcome["sv_winners"] == ["0", "1", "2"]
+    asyncio.run(run())
+
+
+def test_checkpoint_of_current_revision_is_read(db):
+    async def run():
+        sv_checkpoint = {"mem_sv_winners": {"0": ["0"]}, "explanations": {"0": {}}, "revision": 2}
+        result = await manage.db.insert_one({"revision": 2, "sv_checkpoint": sv_checkpoint})
+        assert await manage.find_sv_checkpoint({"_id": result.inserted_id, "revision": 2}) == sv_checkpoint
+        assert await manage.find_sv_checkpoint({"_id": result.inserted_id, "revision": 3}) is None
+        await manage.save_sv_checkpoint({"_id": result.inserted_id, "revision": 3}, None)
+        assert "sv_checkpoint" not in await manage.db.find_one({"_id": result.inserted_id})
+    asyncio.run(run())
@@ -0,0 +1,79 @@
+import asyncio
+import random
+
+import bson
+from bson import ObjectId
+
+import polls.manage as manage
+from polls.database import database
+from polls.models import CreatePoll, Ballot
+
+NUM_BALLOTS = 50000
+CANDIDATES = [f"Candidate {c}" for c in "ABCDEFGH"]
+
+
+async def create_large_poll():
+    """
+    A public poll with the tally of NUM_BALLOTS ballots and the saved outcome.  Only the poll document is
+    read by the requests measured, so the ballots themselves are not inserted.
+    """
+    await manage.ensure_indexes()
+    r = await manage.create_poll(None, CreatePoll(title="t", candidates=CANDIDATES, closing_datetime=None, timezone=None))
+    pid = ObjectId(r["id"])
+    rng = random.Random(0)
+    ballots = [{"ranking": {c: rank + 1 for rank, c in enumerate(rng.sample(CANDIDATES, rng.randint(1, 8)))}}
+               for _ in range(NUM_BALLOTS)]
+    document = await manage.find_poll(r["id"])
+    await manage.db.update_one({"_id": pid}, {"$set": {"tally": manage.tally_from_ballots(ballots, manage.candidate_indices(document))}})
+    await manage.poll_outcome(r["id"], r["owner_id"], None)
+    return r["id"], r["owner_id"]
+
+
+def test_bytes_read_per_request(db):
+    async def run():
+        pid, oid = await create_large_poll()
+        # a large checkpoint of the Stable Voting computation, saved for an earlier revision of the ballots
+        sv_checkpoint = {"mem_sv_winners": {f"{i},{i + 1}": [str(i)] for i in range(20000)}, "explanations": {}, "revision": -1}
+        await manage.db.update_one({"_id": ObjectId(pid)}, {"$set": {"sv_checkpoint": sv_checkpoint}})
+        document = await manage.db.find_one({"_id": ObjectId(pid)})
+        document_bytes = len(bson.encode(document))
+        tally_bytes = len(bson.encode({"tally": document["tally"]}))
+        result_bytes = len(bson.encode({"result": document["result"]}))
+        assert document_bytes > 1000000 and tally_bytes > 100000
+
+        find_one = database.collection("Polls").find_one
+        reads = []
+
+        async def recording_find_one(*args, **kwargs):
+            document = await find_one(*args, **kwargs)
+            reads.append(0 if document is None else len(bson.encode(document)))
+            return document
+
+        async def bytes_read(request):
+            reads.clear()
+            await request
+            return sum(reads)
+
+        manage.db.find_one = recording_find_one
+        try:
+            read = {
+                "poll_outcome": await bytes_read(manage.poll_outcome(pid, oid, None)),
+                "poll_information": await bytes_read(manage.poll_information(pid, oid)),
+                "poll_ranking_information": await bytes_read(manage.poll_ranking_information(pid, None, None)),
+                "submit_ballot": await bytes_read(manage.submit_ballot(Ballot(ranking={"Candidate A": 1}, ip="1.1.1.1"), pid, None, None)),
+                "submitted_ranking_information": await bytes_read(manage.submitted_ranking_information(pid, oid)),
+                # the ballots changed, so the outcome is computed again from the tally
+                "poll_outcome_computed": await bytes_read(manage.poll_outcome(pid, oid, None)),
+                "delete_poll": await bytes_read(manage.delete_poll(pid, oid)),
+            }
+        finally:
+            del manage.db.find_one
+
+        assert read["poll_outcome"] < result_bytes + 1000
+        assert read["poll_outcome_computed"] < result_bytes + tally_bytes + 1000
+        assert read["poll_information"] < 1000
+        assert read["poll_ranking_information"] < 1000
+        assert read["submit_ballot"] < 1000
+        assert read["submitted_ranking_information"] < tally_bytes + 1000
+        assert read["delete_poll"] < 100
+    asyncio.run(run())
@@ -0,0 +1,145 @@
+import asyncio
+import io
+
+from bson import ObjectId
+
+import polls.manage as manage
+from polls.database import database
+from polls.models import CreatePoll, UpdatePoll, Ballot
+
+
+class UploadedCsv:
+    def __init__(self, text, filename="rankings.csv"):
+        self.file = io.BytesIO(text.encode())
+        self.filename = filename
+
+
+async def create_poll(**options):
+    await manage.ensure_indexes()
+    r = await manage.create_poll(None, CreatePoll(title="t", candidates=["A", "B"], closing_datetime=None, timezone=None, **options))
+    return r["id"], r["owner_id"]
+
+
+def vote(pid, ip, ranking={"A": 1}):
+    return manage.submit_ballot(Ballot(ranking=ranking, ip=ip), pid, None, None)
+
+
+async def assert_tally_matches_ballots(pid):
+    document = await manage.db.find_one({"_id": ObjectId(pid)})
+    ballots = await manage.find_ballots(pid)
+    assert await manage.find_tally(document) == manage.tally_from_ballots(ballots, manage.candidate_indices(document))
+    return document["tally"]["num_ballots"]
+
+
+def vote_after_delete_many(pid, ip):
+    """A ballots delete_many that lets a vote in right after the ballots are deleted."""
+    delete_many = database.collection("Ballots").delete_many
+
+    async def delete_many_then_vote(filter, *args, **kwargs):
+        result = await delete_many(filter, *args, **kwargs)
+        assert await vote(pid, ip) == {"success": "Ballot submitted."}
+        return result
+    return delete_many_then_vote
+
+
+def test_backfill_counts_the_ballots_submitted_meanwhile(db, monkeypatch):
+    async def run():
+        pid, oid = await create_poll()
+        for i in range(3):
+            await vote(pid, f"1.1.1.{i}")
+        # a poll from before tallies were stored
+        await manage.db.update_one({"_id": ObjectId(pid)}, {"$unset": {"tally": ""}})
+        find_ballots = manage.find_ballots
+        calls = []
+
+        async def find_ballots_then_vote(id):
+            ballots = await find_ballots(id)
+            if len(calls) == 0:
+                calls.append(id)
+                assert await vote(pid, "2.2.2.2") == {"success": "Ballot submitted."}
+            return ballots
+
+        monkeypatch.setattr(manage, "find_ballots", find_ballots_then_vote)
+        document = await manage.find_poll(pid, manage.TALLY_PROFILE)
+        assert (await manage.find_tally(document))["num_ballots"] == 4
+        monkeypatch.undo()
+        assert await assert_tally_matches_ballots(pid) == 4
+        assert await vote(pid, "3.3.3.3") == {"success": "Ballot submitted."}
+        assert await assert_tally_matches_ballots(pid) == 5
+    asyncio.run(run())
+
+
+def test_vote_while_all_ballots_are_deleted(db):
+    async def run():
+        pid, oid = await create_poll()
+        for i in range(3):
+            await vote(pid, f"1.1.1.{i}")
+        manage.ballots_db.delete_many = vote_after_delete_many(pid, "2.2.2.2")
+        try:
+            assert await manage.delete_all_ballots(pid, oid) == {"success": "Successfully deleted 3 ballot(s)."}
+        finally:
+            del manage.ballots_db.delete_many
+        assert await assert_tally_matches_ballots(pid) == 1
+        assert await vote(pid, "3.3.3.3") == {"success": "Ballot submitted."}
+        assert await assert_tally_matches_ballots(pid) == 2
+    asyncio.run(run())
+
+
+def test_vote_while_rankings_are_replaced(db):
+    async def run():
+        pid, oid = await create_poll()
+        await vote(pid, "1.1.1.1")
+        manage.ballots_db.delete_many = vote_after_delete_many(pid, "2.2.2.2")
+        try:
+            result = await manage.add_rankings(pid, oid, UploadedCsv("A,B\n1,2,5\n2,1,3\n"), True)
+        finally:
+            del manage.ballots_db.delete_many
+        assert result == {"success": "Replaced all the ballots with 8 ballots in the poll: t."}
+        assert await assert_tally_matches_ballots(pid) == 9
+    asyncio.run(run())
+
+
+def test_vote_while_candidates_are_changed(db, monkeypatch):
+    async def run():
+        pid, oid = await create_poll()
+        has_ballots = manage.has_ballots
+
+        async def has_ballots_then_vote(id):
+            result = await has_ballots(id)
+            assert await vote(pid, "2.2.2.2", {"B": 1}) == {"success": "Ballot submitted."}
+            return result
+
+        monkeypatch.setattr(manage, "has_ballots", has_ballots_then_vote)
+        await manage.update_poll(pid, oid, UpdatePoll(candidates=["B", "C", "A"]), None)
+        monkeypatch.undo()
+        assert await assert_tally_matches_ballots(pid) == 1
+        assert await vote(pid, "3.3.3.3", {"C": 1}) == {"success": "Ballot submitted."}
+        assert await assert_tally_matches_ballots(pid) == 2
+    asyncio.run(run())
+
+
+def test_failed_import_is_reported(db, monkeypatch):
+    async def run():
+        pid, oid = await create_poll()
+        monkeypatch.setattr(manage, "BULK_BATCH_SIZE", 1)
+        insert_many = database.collection("Ballots").insert_many
+        num_batches = 0
+
+        async def insert_many_then_fail(documents, *args, **kwargs):
+            nonlocal num_batches
+            num_batches += 1
+            if num_batches == 2:
+                raise ConnectionError("connection lost")
+            return await insert_many(documents, *args, **kwargs)
+
+        manage.ballots_db.insert_many = insert_many_then_fail
+        try:
+            result = await manage.add_rankings(pid, oid, UploadedCsv("A,B\n1,2,5\n2,1,3\n1,2,1\n"), False)
+        finally:
+            del manage.ballots_db.insert_many
+        assert result == {"error": "The import failed after 1 of 3 rows were added."}
+        progress = await manage.bulk_import_progress(pid, oid)
+        assert progress["status"] == "failed" and progress["error"] == "connection lost"
+        assert (progress["imported_rows"], progress["imported_ballots"]) == (1, 5)
+        assert await assert_tally_matches_ballots(pid) == 5
+    asyncio.run(run())
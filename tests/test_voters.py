@@ -0,0 +1,77 @@
+import asyncio
+
+from bson import ObjectId
+
+import polls.manage as manage
+from polls.database import database
+from polls.models import CreatePoll, Ballot
+
+
+async def create_private_poll(num_voters):
+    await manage.ensure_indexes()
+    r = await manage.create_poll(None, CreatePoll(
+        title="t", candidates=["A", "B"], closing_datetime=None, timezone=None,
+        is_private=True, voter_emails=[f"v{i}@x.org" for i in range(num_voters)]))
+    vids = [v["voter_id"] async for v in manage.voters_db.find({"poll_id": ObjectId(r["id"])})]
+    return r["id"], r["owner_id"], vids
+
+
+async def vote(pid, vids):
+    return await asyncio.gather(*[
+        manage.submit_ballot(Ballot(ranking={"A": 1} if i % 2 else {"B": 1}, ip="n/a"), pid, vid, None)
+        for i, vid in enumerate(vids)])
+
+
+async def assert_tally_matches_ballots(pid):
+    document = await manage.find_poll(pid, manage.TALLY_PROFILE)
+    ballots = await manage.find_ballots(pid)
+    assert await manage.find_tally(document) == manage.tally_from_ballots(ballots, manage.candidate_indices(document))
+    return len(ballots)
+
+
+def test_bulk_voter_operations(db):
+    async def run():
+        pid, oid, vids = await create_private_poll(20)
+        await vote(pid, vids[:10])
+        assert await manage.delete_voters(pid, vids[:2], "not the owner") == {"error": "Not authorized."}
+
+        res = await manage.regenerate_voter_links(pid, vids[:5] + ["nope"], oid)
+        assert res["num_succeeded"] == 5
+        assert res["results"][-1] == {"voter_id": "nope", "error": "Voter not found."}
+        new_vids = [r["new_voter_id"] for r in res["results"][:5]]
+        assert await manage.ballots_db.count_documents({"poll_id": ObjectId(pid), "voter_id": {"$in": new_vids}}) == 5
+
+        res = await manage.resend_voter_emails(pid, ["v19@x.org", "z@x.org"], oid)
+        assert res["results"] == [
+            {"email": "v19@x.org", "success": "Email resent to v19@x.org. Total emails sent: 2"},
+            {"email": "z@x.org", "error": "Voter email not found."}]
+
+        res = await manage.delete_voters(pid, new_vids + vids[5:8] + ["nope"], oid)
+        assert res["num_succeeded"] == 8
+        assert await manage.voters_db.count_documents({"poll_id": ObjectId(pid)}) == 12
+        assert await assert_tally_matches_ballots(pid) == 2
+    asyncio.run(run())
+
+
+def test_concurrent_deletion_of_ballots_resets_the_tally(db):
+    async def run():
+        pid, oid, vids = await create_private_poll(4)
+        await vote(pid, vids)
+        delete_many = database.collection("Ballots").delete_many
+
+        async def concurrent_delete_many(filter, *args, **kwargs):
+            # another request deletes one of the ballots first
+            await delete_many({"poll_id": ObjectId(pid), "voter_id": vids[0]})
+            return await delete_many(filter, *args, **kwargs)
+
+        manage.ballots_db.delete_many = concurrent_delete_many
+        try:
+            res = await manage.delete_voters(pid, vids[:2], oid)
+        finally:
+            del manage.ballots_db.delete_many
+        assert res["num_succeeded"] == 2
+        # the tally is removed rather than set to null, which the $inc of the next vote could not update
+        assert "tally" not in await manage.db.find_one({"_id": ObjectId(pid)})
+        assert await vote(pid, vids[2:3]) == [{"success": "Ballot submitted."}]
+        assert await assert_tally_matches_ballots(pid) == 2
+    asyncio.run(run())
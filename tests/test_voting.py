@@ -0,0 +1,103 @@
+import asyncio
+import itertools
+import random
+
+from pref_voting.profiles_with_ties import ProfileWithTies
+from pref_voting.weighted_majority_graphs import MarginGraph
+from pref_voting.voting_methods import split_cycle_defeat, stable_voting
+
+import polls.manage as manage
+from polls.voting import (
+    is_linear, rank_array, support_matrix, margin_matrix, split_cycle_defeat_matrix,
+    condorcet_winner_from_margins, linear_order_from_margins, stable_voting_explained,
+    generate_columns, iter_csv_rows)
+
+
+def random_rankings(rng, cands, max_voters=12):
+    """Rankings of some of the candidates, with ties."""
+    return [{c: rng.randint(1, 3) for c in rng.sample(cands, rng.randint(0, len(cands)))}
+            for _ in range(rng.randint(1, max_voters))]
+
+
+def test_margins_and_defeats_match_pref_voting():
+    rng = random.Random(0)
+    for _ in range(300):
+        cands = [str(i) for i in range(rng.randint(1, 7))]
+        rankings = random_rankings(rng, cands)
+        prof = ProfileWithTies(rankings, candidates=cands)
+        M = margin_matrix(support_matrix(rank_array(rankings, cands)))
+        assert M.tolist() == [[prof.margin(c1, c2) for c2 in cands] for c1 in cands]
+
+        mg = MarginGraph(cands, [(c1, c2, prof.margin(c1, c2)) for c1 in cands for c2 in cands if prof.margin(c1, c2) > 0])
+        defeat = split_cycle_defeat(mg)
+        D = split_cycle_defeat_matrix(M)
+        assert D.tolist() == [[defeat.has_edge(c1, c2) for c2 in cands] for c1 in cands]
+        assert condorcet_winner_from_margins(cands, M) == mg.condorcet_winner()
+        assert linear_order_from_margins(cands, M) == is_linear(mg)
+
+
+def test_support_is_weighted_by_the_counts():
+    # unranked candidates are not ranked below the ranked ones
+    rankings = [{"A": 1, "B": 2}, {"B": 1, "A": 2}, {"B": 1}, {"A": 1, "B": 1}]
+    S = support_matrix(rank_array(rankings, ["A", "B"]), counts=[3, 2, 4, 5])
+    assert S.tolist() == [[0, 3], [2, 0]]
+
+
+def random_margin_graph(rng, cands, margins=(0, 2, 4, 6)):
+    """A margin graph where every margin is even, as for an even number of voters."""
+    edges = []
+    for c1, c2 in itertools.combinations(cands, 2):
+        margin = rng.choice(margins)
+        if margin > 0:
+            edges.append((c1, c2, margin) if rng.random() < 0.5 else (c2, c1, margin))
+    return edges
+
+
+def test_stable_voting_matches_pref_voting():
+    rng = random.Random(0)
+    for _ in range(300):
+        cands = [str(i) for i in range(rng.randint(1, 7))]
+        edges = random_margin_graph(rng, cands)
+        sv_winners, explanations, checkpoint = stable_voting_explained(cands, edges)
+        assert checkpoint is None
+        assert sv_winners == sorted(stable_voting(MarginGraph(cands, edges)))
+        assert ",".join(cands) in explanations
+
+
+def test_stable_voting_resumes_from_checkpoints():
+    rng = random.Random(1)
+    cands = [str(i) for i in range(12)]
+    edges = random_margin_graph(rng, cands, margins=range(2, 60, 2))
+    sv_winners, explanations, _ = stable_voting_explained(cands, edges)
+
+    views, checkpoint, resumed_winners = 0, None, None
+    while resumed_winners is None:
+        views += 1
+        resumed_winners, resumed_explanations, checkpoint = stable_voting_explained(cands, edges, 0.005, checkpoint)
+    assert views > 1
+    assert checkpoint is None
+    assert (resumed_winners, resumed_explanations) == (sv_winners, explanations)
+
+
+def test_rankings_table_and_csv_data():
+    rankings_counts = [({"A": 2, "B": 4}, 1), ({"C": 1}, 2), ({"B": 2, "A": 1}, 3), ({"A": 1, "B": 2}, 4)]
+    columns, max_rank = generate_columns(rankings_counts)
+    assert max_rank == 4
+    assert columns == [["1", "", "A", "", "B"], ["2", "C", "", "", ""], ["7", "A", "B", "", ""]]
+    # the ranks are normalized, so the first ranking is counted with the last two
+    assert list(iter_csv_rows(["A", "B", "C"], rankings_counts, {"A": "a", "B": "b", "C": "c"})) == [
+        ["a", "b", "c", ""], [1, 2, "", 8], ["", "", 1, 2]]
+
+
+def test_demo_outcome_matches_pref_voting():
+    rng = random.Random(2)
+    for _ in range(30):
+        rankings = [r for r in random_rankings(rng, ["A", "B", "C", "D"]) if len(r) > 0] or [{"A": 1}]
+        counts = [rng.randint(1, 3) for _ in rankings]
+        result = asyncio.run(manage.demo_poll_outcome([{"ranking": r, "num": n} for r, n in zip(rankings, counts)]))
+        prof = ProfileWithTies(rankings, rcounts=counts)
+        cmap = result["cmap"]
+        assert {cmap[c1]: {cmap[c2]: m for c2, m in row.items()} for c1, row in result["margins"].items()} == {
+            c1: {c2: prof.margin(c1, c2) for c2 in prof.candidates} for c1 in prof.candidates}
+        winner = result["condorcet_winner"]
+        assert (cmap[int(winner)] if winner is not None else None) == prof.condorcet_winner()